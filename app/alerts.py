@@ -0,0 +1,200 @@
+import os
+import math
+import itertools
+
+from datetime import datetime
+from typing import Iterator, Optional
+
+from live import alert_message, hub
+
+RULE_KINDS = ("above", "below", "zscore", "rate")
+
+# Samples the rolling mean and variance effectively remember
+STATS_WINDOW = int(os.getenv("ALERT_STATS_WINDOW", "100"))
+# Smoothing factor of the exponentially weighted moving average
+EWMA_ALPHA = float(os.getenv("ALERT_EWMA_ALPHA", "0.1"))
+# Readings needed before z-scores are trusted
+MIN_ZSCORE_SAMPLES = 10
+
+
+class StreamStats:
+    """
+    Constant-memory rolling statistics for one sensor's readings.
+
+    Mean and variance use Welford's update with the sample count capped at
+    STATS_WINDOW, which turns it into an exponentially forgetting estimate
+    once the window fills, so the baseline follows slow drift. Rate of
+    change is per second between consecutive readings in timestamp order.
+    """
+    __slots__ = ("count", "mean", "m2", "ewma", "last_value", "last_time", "rate")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewma: Optional[float] = None
+        self.last_value: Optional[float] = None
+        self.last_time: Optional[datetime] = None
+        self.rate: Optional[float] = None
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def zscore(self, value: float) -> Optional[float]:
+        if self.count < MIN_ZSCORE_SAMPLES:
+            return None
+        deviation = math.sqrt(self.variance)
+        if deviation == 0:
+            return None
+        return (value - self.mean) / deviation
+
+    def update(self, value: float, timestamp: datetime):
+        if self.count < STATS_WINDOW:
+            self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.count == STATS_WINDOW:
+            # Keep m2 scaled to the capped count so old samples decay
+            self.m2 *= (STATS_WINDOW - 1) / STATS_WINDOW
+
+        self.ewma = value if self.ewma is None else self.ewma + EWMA_ALPHA * (value - self.ewma)
+
+        # A late reading still counts toward the baseline, but not toward the rate
+        if self.last_time is None or timestamp > self.last_time:
+            if self.last_time is not None:
+                self.rate = (value - self.last_value) / (timestamp - self.last_time).total_seconds()
+            self.last_value = value
+            self.last_time = timestamp
+
+
+class Rule:
+    __slots__ = ("id", "sensor_id", "user_id", "kind", "threshold", "active")
+
+    def __init__(self, id: int, sensor_id: int, user_id: int, kind: str, threshold: float):
+        self.id = id
+        self.sensor_id = sensor_id
+        self.user_id = user_id
+        self.kind = kind
+        self.threshold = threshold
+        # Whether the rule is currently breached; alerts fire on the transition
+        self.active = False
+
+    def score(self, value: float, stats: StreamStats) -> Optional[float]:
+        """The quantity this rule compares against its threshold, None if unknown."""
+        if self.kind in ("above", "below"):
+            return value
+        if self.kind == "zscore":
+            return stats.zscore(value)
+        return stats.rate
+
+    def breached(self, score: Optional[float]) -> bool:
+        if score is None:
+            return False
+        if self.kind == "above":
+            return score > self.threshold
+        if self.kind == "below":
+            return score < self.threshold
+        return abs(score) > self.threshold
+
+
+class AlertEngine:
+    """
+    Evaluates alert rules against readings as they are ingested.
+
+    Rules and statistics are held in memory by sensor ID, so evaluation
+    never touches the database. Alerts are published to the live hub
+    straight away and queued for the alerts table.
+    """
+
+    def __init__(self):
+        self.stats: dict[int, StreamStats] = {}
+        self.rules: dict[int, list[Rule]] = {}
+        self.pending: list[tuple] = []
+
+    def clear(self):
+        self.stats.clear()
+        self.rules.clear()
+        self.pending.clear()
+
+    def load(self, rules: list[dict]):
+        self.rules.clear()
+        for rule in rules:
+            self.add_rule(rule)
+
+    def add_rule(self, rule: dict):
+        self.rules.setdefault(rule["sensor_id"], []).append(
+            Rule(rule["id"], rule["sensor_id"], rule["user_id"], rule["kind"], rule["threshold"])
+        )
+
+    def remove_rule(self, rule_id: int):
+        for sensor_id, rules in list(self.rules.items()):
+            rules[:] = [rule for rule in rules if rule.id != rule_id]
+            if not rules:
+                del self.rules[sensor_id]
+
+    def remove_sensor(self, sensor_id: int):
+        self.rules.pop(sensor_id, None)
+        self.stats.pop(sensor_id, None)
+
+    def reset_sensor(self, sensor_id: int):
+        """Forget a sensor's statistics, e.g. once it points at a different device."""
+        self.stats.pop(sensor_id, None)
+        for rule in self.rules.get(sensor_id, ()):
+            rule.active = False
+
+    def observe(self, sensor_id: int, value: float, timestamp: datetime, record: bool = True, event_id: Optional[int] = None):
+        """
+        Evaluate rules for one reading, then fold it into the sensor's statistics.
+
+        With record False, alerts are still published to this process's live
+        hub but not queued for the alerts table, for readings another worker
+        ingested and records alerts for. Alerts are published with the event
+        IDs following the reading's, when it has one.
+        """
+        alert_ids = itertools.count(event_id + 1) if event_id is not None else None
+        stats = self.stats.get(sensor_id)
+        if stats is None:
+            stats = self.stats[sensor_id] = StreamStats()
+
+        rules = self.rules.get(sensor_id, ())
+        for rule in rules:
+            # Scores are taken against the statistics before this reading
+            if rule.kind == "rate":
+                continue
+            self._evaluate(rule, value, timestamp, rule.score(value, stats), record, alert_ids)
+
+        stats.update(value, timestamp)
+
+        for rule in rules:
+            if rule.kind == "rate" and stats.last_time == timestamp:
+                self._evaluate(rule, value, timestamp, stats.rate, record, alert_ids)
+
+    def _evaluate(self, rule: Rule, value: float, timestamp: datetime, score: Optional[float], record: bool, alert_ids: Optional[Iterator[int]]):
+        if not rule.breached(score):
+            rule.active = False
+            return
+        if rule.active:
+            return
+
+        rule.active = True
+        if record:
+            self.pending.append((rule.id, rule.sensor_id, rule.user_id, value, score, timestamp))
+        hub.publish(rule.sensor_id, alert_message({
+            "rule_id": rule.id,
+            "sensor_id": rule.sensor_id,
+            "kind": rule.kind,
+            "threshold": rule.threshold,
+            "value": value,
+            "score": score,
+            "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        }), next(alert_ids) if alert_ids is not None else None)
+
+    def drain(self) -> list[tuple]:
+        """Take the alerts raised since the last call, for writing to the alerts table."""
+        alerts, self.pending = self.pending, []
+        return alerts
+
+
+alert_engine = AlertEngine()
@@ -0,0 +1,198 @@
+import io
+import csv
+import json
+import codecs
+
+from typing import AsyncIterator, Optional, Union
+
+IMPORT_FORMATS = {
+    "text/csv": "csv",
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+# Largest single JSON record accepted before the stream is considered malformed
+MAX_RECORD_CHARS = 64 * 1024
+EXPORT_CHUNK_CHARS = 64 * 1024
+
+
+class ImportFormatError(ValueError):
+    """Raised when an import stream cannot be parsed any further"""
+    pass
+
+
+def detect_format(content_type: Optional[str]) -> Optional[str]:
+    """Map a request Content-Type header to an import format."""
+    if not content_type:
+        return None
+    return IMPORT_FORMATS.get(content_type.split(";")[0].strip().lower())
+
+
+async def iter_text(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Decode a byte stream as UTF-8 without splitting multi-byte characters."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    async for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into lines as it arrives."""
+    pending = ""
+    async for text in iter_text(chunks):
+        lines = (pending + text).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, Union[dict, Exception]]]:
+    line_number = 0
+    async for line in iter_lines(chunks):
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, e
+
+
+async def iter_csv(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, Union[dict, Exception]]]:
+    """Parse CSV with a header row. Quoted fields may not span lines."""
+    header = None
+    line_number = 0
+    async for line in iter_lines(chunks):
+        line_number += 1
+        if not line.strip():
+            continue
+
+        row = next(csv.reader([line]))
+        if header is None:
+            header = [column.strip() for column in row]
+            continue
+
+        if len(row) != len(header):
+            yield line_number, ValueError(f"Expected {len(header)} columns, got {len(row)}")
+            continue
+        yield line_number, dict(zip(header, row))
+
+
+async def iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, Union[dict, Exception]]]:
+    """
+    Incrementally parse a top level JSON array, yielding each element once
+    it has fully arrived. Positions are element indexes starting at 1.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    finished = False
+    index = 0
+
+    async def more() -> bool:
+        nonlocal buffer
+        async for text in texts:
+            buffer += text
+            return True
+        return False
+
+    texts = iter_text(chunks)
+    while not finished:
+        buffer = buffer.lstrip()
+        if not buffer:
+            if not await more():
+                break
+            continue
+
+        if not started:
+            if buffer[0] != "[":
+                raise ImportFormatError("Expected a JSON array")
+            buffer = buffer[1:]
+            started = True
+            continue
+
+        if buffer[0] == "]":
+            finished = True
+            break
+        if buffer[0] == ",":
+            buffer = buffer[1:]
+            continue
+
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            # The element is probably split across chunks
+            if len(buffer) > MAX_RECORD_CHARS or not await more():
+                raise ImportFormatError(f"Malformed JSON near element {index + 1}")
+            continue
+
+        # A bare number or literal at the end of the buffer may continue in the next chunk
+        if end == len(buffer) and not isinstance(record, (dict, list, str)) and await more():
+            continue
+
+        index += 1
+        buffer = buffer[end:]
+        yield index, record
+
+    if not finished:
+        raise ImportFormatError("Unterminated JSON array")
+
+
+def iter_records(chunks: AsyncIterator[bytes], format: str) -> AsyncIterator[tuple[int, Union[dict, Exception]]]:
+    """
+    Parse an import stream into records without buffering it whole.
+
+    Yields:
+        (position, record) where position is the line number (CSV, NDJSON)
+        or element index (JSON) and record is either a dict or the
+        exception raised while parsing that record
+    """
+    parsers = {"csv": iter_csv, "json": iter_json_array, "ndjson": iter_ndjson}
+    return parsers[format](chunks)
+
+
+async def encode_records(records: AsyncIterator[dict], format: str, fields: tuple) -> AsyncIterator[str]:
+    """
+    Encode records as CSV, a JSON array or NDJSON, yielding text in
+    chunks of roughly EXPORT_CHUNK_CHARS rather than one write per record.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    if format == "csv":
+        writer.writerow(fields)
+    elif format == "json":
+        buffer.write("[")
+
+    first = True
+    async for record in records:
+        if format == "csv":
+            writer.writerow([record.get(field) for field in fields])
+        else:
+            if format == "json" and not first:
+                buffer.write(",")
+            buffer.write(json.dumps({field: record.get(field) for field in fields}))
+            if format == "ndjson":
+                buffer.write("\n")
+        first = False
+
+        if buffer.tell() >= EXPORT_CHUNK_CHARS:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if format == "json":
+        buffer.write("]")
+    yield buffer.getvalue()
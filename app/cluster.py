@@ -0,0 +1,122 @@
+import json
+import time
+import socket
+import asyncio
+import logging
+
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Events are newline delimited JSON arrays of [kind, fields]
+READY_EVENT = "ready"
+
+_handlers: dict[str, Callable] = {}
+_channel: Optional[socket.socket] = None
+_writer: Optional[asyncio.StreamWriter] = None
+_listener: Optional[asyncio.Task] = None
+_started_at: Optional[float] = None
+_size = 1
+# Events published from a worker thread started by run_in_thread, applied once it returns
+_deferred: ContextVar[Optional[list]] = ContextVar("cluster_deferred", default=None)
+
+
+def on(kind: str) -> Callable:
+    """Register the function that applies events of this kind to this process's state."""
+    def register(func: Callable) -> Callable:
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def attach(channel: socket.socket, size: int):
+    """Join a cluster of `size` workers through a socket to the supervisor. Called in a worker straight after it is forked."""
+    global _channel, _started_at, _size
+    _channel = channel
+    _started_at = time.monotonic()
+    _size = size
+
+
+def is_attached() -> bool:
+    return _channel is not None
+
+
+def size() -> int:
+    """How many workers share the load, 1 outside a cluster."""
+    return _size
+
+
+def send(kind: str, **fields):
+    """Send an event to the other workers only."""
+    if _writer is not None:
+        _writer.write(json.dumps([kind, fields], separators=(",", ":")).encode() + b"\n")
+
+
+def publish(kind: str, **fields):
+    """
+    Apply an event here, then send it to the other workers. Inside
+    run_in_thread this waits until the thread is done.
+    """
+    deferred = _deferred.get()
+    if deferred is not None:
+        deferred.append((kind, fields))
+        return
+    _handlers[kind](**fields)
+    send(kind, **fields)
+
+
+async def run_in_thread(func: Callable, *args, **kwargs):
+    """
+    Run a blocking function in a worker thread. Handlers and the channel
+    belong to the event loop, so events it publishes are applied and sent
+    from there once it returns, before the caller resumes.
+    """
+    events = []
+
+    def run():
+        _deferred.set(events)
+        return func(*args, **kwargs)
+
+    try:
+        return await asyncio.to_thread(run)
+    finally:
+        for kind, fields in events:
+            publish(kind, **fields)
+
+
+async def _listen(reader: asyncio.StreamReader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            logger.error("Lost the connection to the supervisor")
+            return
+        kind, fields = json.loads(line)
+        try:
+            _handlers[kind](**fields)
+        except Exception as e:
+            logger.error(f"Failed to apply {kind} event: {e}")
+
+
+async def start():
+    """
+    Start applying other workers' events and tell the supervisor this worker
+    is ready. Called at the end of startup, once caches are loaded; events
+    sent meanwhile wait in the socket. Does nothing outside a cluster.
+    """
+    global _writer, _listener
+    if _channel is None or _writer is not None:
+        return
+    reader, _writer = await asyncio.open_connection(sock=_channel, limit=2 ** 24)
+    _listener = asyncio.create_task(_listen(reader))
+    send(READY_EVENT, startup_seconds=round(time.monotonic() - _started_at, 3))
+
+
+async def stop():
+    global _writer, _listener
+    if _listener is not None:
+        _listener.cancel()
+        _listener = None
+    if _writer is not None:
+        _writer.close()
+        _writer = None
@@ -1,11 +1,28 @@
 import os
 import time
 import logging
+import itertools
+import threading
 import mysql.connector
 
-from typing import Optional
+from collections import deque
+from contextvars import ContextVar
+from typing import Iterator, NamedTuple, Optional
+from datetime import datetime
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from mysql.connector import Error
+from mysql.connector import Error, IntegrityError, InterfaceError, OperationalError
+
+import querylog
+import cluster
+
+from search import clothes_index
+from alerts import alert_engine
+from live import hub
+from history import recent_readings
+from registry import sensor_registry
+from devicekeys import device_keys
+from metrics import current_accessor, db_accessor, record_db_connect, record_query
 
 load_dotenv()
 
@@ -18,29 +35,177 @@ class DatabaseConnectionError(Exception):
     pass
 
 
+class SensorExistsError(Exception):
+    """Raised when a sensor would share its address and type with another"""
+    pass
+
+
+# Idle connections kept open for reuse, per database server
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+# Read replicas as comma separated host[:port], e.g. "replica-1,replica-2:3307"
+MYSQL_REPLICAS = [replica.strip() for replica in os.getenv("MYSQL_REPLICAS", "").split(",") if replica.strip()]
+# Replicas further behind the primary than this are not read from. Keep it
+# below DB_REPLICA_STICKY_SECONDS so a user's writes are on every replica
+# they read from once their sticky window is over
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "1"))
+# How long after a user's write their reads go to the primary
+DB_REPLICA_STICKY_SECONDS = float(os.getenv("DB_REPLICA_STICKY_SECONDS", "5"))
+# How often each replica's lag is measured
+DB_REPLICA_LAG_CHECK_SECONDS = float(os.getenv("DB_REPLICA_LAG_CHECK_SECONDS", "2"))
+# Replicas have the primary to fall back on, so connecting to one gives up quickly
+DB_REPLICA_CONNECT_TIMEOUT_SECONDS = int(os.getenv("DB_REPLICA_CONNECT_TIMEOUT_SECONDS", "2"))
+
+# Columns that may be requested through field projection
+SENSOR_FIELDS = ("id", "user_id", "type", "units", "address")
+CLOTHES_FIELDS = ("id", "user_id", "name", "type", "image_address")
+
+
+def _select_columns(fields: Optional[list[str]], allowed: tuple) -> str:
+    """
+    Build the column list for a projected SELECT.
+
+    The id column is always included since it is the keyset cursor.
+
+    Raises:
+        ValueError: if a requested field is not an allowed column
+    """
+    if not fields:
+        return ", ".join(allowed)
+
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+    columns = ["id"] + [field for field in allowed if field in fields and field != "id"]
+    return ", ".join(columns)
+
+
+def _keyset_query(table: str, columns: str, type: Optional[str], after: Optional[int], limit: Optional[int]) -> str:
+    """Build a per-user SELECT ordered by id, filtered by type and an exclusive id cursor."""
+    query = f"SELECT {columns} FROM {table} WHERE user_id = %(user_id)s"
+    if type:
+        query += " AND type = %(type)s"
+    if after is not None:
+        query += " AND id > %(after)s"
+    query += " ORDER BY id"
+    if limit is not None:
+        query += " LIMIT %(limit)s"
+    return query
+
+
+# In-memory caches are changed through cluster events, applied here and, in
+# a multi-worker server, in every other worker too
+
+@cluster.on("user_deleted")
+def _user_deleted(user_id: int):
+    clothes_index.drop_user(user_id)
+    device_keys.invalidate_user(user_id)
+    for sensor_id in sensor_registry.remove_user(user_id):
+        _forget_sensor(sensor_id)
+
+
+@cluster.on("sensor_added")
+def _sensor_added(sensor: dict):
+    sensor_registry.add(sensor)
+
+
+@cluster.on("sensor_updated")
+def _sensor_updated(sensor_id: int, type: Optional[str], address: Optional[str]):
+    sensor_registry.update(sensor_id, type=type, address=address)
+    alert_engine.reset_sensor(sensor_id)
+
+
+@cluster.on("sensor_deleted")
+def _sensor_deleted(sensor_id: int):
+    sensor_registry.remove(sensor_id)
+    _forget_sensor(sensor_id)
+
+
+def _forget_sensor(sensor_id: int):
+    alert_engine.remove_sensor(sensor_id)
+    hub.remove_sensor(sensor_id)
+    recent_readings.remove_sensor(sensor_id)
+
+
+@cluster.on("clothes_added")
+def _clothes_added(clothes: dict):
+    clothes_index.add(clothes)
+
+
+@cluster.on("clothes_updated")
+def _clothes_updated(clothes_id: int, name: Optional[str], type: Optional[str], image_address: Optional[str]):
+    clothes_index.update(clothes_id, name=name, type=type, image_address=image_address)
+
+
+@cluster.on("clothes_deleted")
+def _clothes_deleted(clothes_id: int):
+    clothes_index.remove(clothes_id)
+
+
+@cluster.on("user_clothes_changed")
+def _user_clothes_changed(user_id: int):
+    # Rebuilt from the database on the user's next search
+    clothes_index.drop_user(user_id)
+
+
+@cluster.on("alert_rule_added")
+def _alert_rule_added(rule: dict):
+    alert_engine.add_rule(rule)
+
+
+@cluster.on("alert_rule_deleted")
+def _alert_rule_deleted(rule_id: int):
+    alert_engine.remove_rule(rule_id)
+
+
+@cluster.on("device_key_revoked")
+def _device_key_revoked(key_id: int):
+    device_keys.invalidate(key_id)
+
+
+@cluster.on("user_wrote")
+def _user_wrote(user_id: int):
+    _last_writes[user_id] = time.monotonic()
+
+
+def _ssl_options() -> dict:
+    """Verify the server certificate when a CA is configured; local databases run without TLS."""
+    ssl_ca = os.getenv('MYSQL_SSL_CA')
+    if not ssl_ca:
+        return {}
+    return {"ssl_ca": ssl_ca, "ssl_verify_identity": True}
+
+
 def get_db_connection(
     max_retries: int = 12,  # 12 retries = 1 minute total (12 * 5 seconds)
     retry_delay: int = 5,  # 5 seconds between retries
+    host: Optional[str] = None,
+    port: Optional[int] = None,
+    connection_timeout: Optional[int] = None,
 ) -> mysql.connector.MySQLConnection:
-    """Create database connection with retry mechanism."""
+    """Create database connection with retry mechanism, to MYSQL_HOST unless another host is given."""
+    timeout = {"connection_timeout": connection_timeout} if connection_timeout else {}
     connection: Optional[mysql.connector.MySQLConnection] = None
     attempt = 1
     last_error = None
 
     while attempt <= max_retries:
         try:
+            started = time.perf_counter()
             connection = mysql.connector.connect(
-                host=os.getenv("MYSQL_HOST"),
+                host=host or os.getenv("MYSQL_HOST"),
                 user=os.getenv("MYSQL_USER"),
                 password=os.getenv("MYSQL_PASSWORD"),
                 database=os.getenv("MYSQL_DATABASE"),
-                port=int(os.getenv('MYSQL_PORT')),
-                ssl_ca=os.getenv('MYSQL_SSL_CA'),
-                ssl_verify_identity=True
+                port=port or int(os.getenv('MYSQL_PORT')),
+                **timeout,
+                **_ssl_options()
             )
 
             # Test the connection
             connection.ping(reconnect=True, attempts=1, delay=0)
+            record_db_connect(time.perf_counter() - started)
             logger.info("Database connection established successfully")
             return connection
 
@@ -68,10 +233,383 @@ def get_db_connection(
         f"Last error: {last_error}"
     )
 
-async def setup_database(initial_users: dict = None):
-    connection = None
-    cursor = None
 
+class QueryResult(NamedTuple):
+    """Everything a caller may need back from one executed statement."""
+    rows: list[dict]
+    rowcount: int
+    lastrowid: Optional[int]
+
+    def first(self) -> Optional[dict]:
+        return self.rows[0] if self.rows else None
+
+
+class ConnectionPool:
+    """
+    Open connections kept for reuse, so most statements skip connecting.
+
+    There is no cap on connections in use: when none is idle a new one is
+    opened, and on release it is kept only if fewer than `size` are idle.
+    Released connections are rolled back, so none carries an open
+    transaction or a stale snapshot to its next user. The pool is safe to
+    use from threads, and starts empty in a forked child rather than
+    sharing its parent's sockets.
+    """
+
+    def __init__(self, size: int, host: Optional[str] = None, port: Optional[int] = None, connect_timeout: Optional[int] = None):
+        self.size = size
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.idle: deque = deque()
+        self.in_use = 0
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _take_idle(self) -> Optional[mysql.connector.MySQLConnection]:
+        with self._lock:
+            if self._pid != os.getpid():
+                # Inherited across a fork; the parent still owns these sockets
+                self.idle.clear()
+                self.in_use = 0
+                self._pid = os.getpid()
+            while self.idle:
+                connection = self.idle.pop()
+                if connection.is_connected():
+                    self.in_use += 1
+                    self.reused += 1
+                    return connection
+                self.discarded += 1
+        return None
+
+    def acquire(self, max_retries: int = 12) -> mysql.connector.MySQLConnection:
+        connection = self._take_idle()
+        if connection is not None:
+            return connection
+
+        connection = get_db_connection(max_retries=max_retries, host=self.host, port=self.port, connection_timeout=self.connect_timeout)
+        with self._lock:
+            self.in_use += 1
+            self.opened += 1
+        return connection
+
+    def release(self, connection: mysql.connector.MySQLConnection, reusable: bool = True):
+        if reusable:
+            try:
+                connection.rollback()
+            except Error:
+                reusable = False
+
+        with self._lock:
+            self.in_use -= 1
+            if reusable and len(self.idle) < self.size and self._pid == os.getpid():
+                self.idle.append(connection)
+                return
+            self.discarded += 1
+        try:
+            connection.close()
+        except Error:
+            pass
+
+    def clear(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self.idle = list(self.idle), deque()
+        for connection in idle:
+            try:
+                connection.close()
+            except Error:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": len(self.idle),
+            "in_use": self.in_use,
+            "opened": self.opened,
+            "reused": self.reused,
+            "discarded": self.discarded,
+        }
+
+
+class ReplicaPool(ConnectionPool):
+    """
+    Connections to a read replica, and whether it is close enough behind
+    the primary to read from.
+
+    Lag is measured with SHOW REPLICA STATUS every
+    DB_REPLICA_LAG_CHECK_SECONDS by a background thread, see
+    start_replica_monitor, so reads never wait on it. A replica that
+    cannot be reached, is not replicating, is too far behind or has not
+    been measured lately is skipped until a later check finds it healthy.
+    """
+
+    def __init__(self, size: int, host: str, port: Optional[int] = None):
+        super().__init__(size, host, port, DB_REPLICA_CONNECT_TIMEOUT_SECONDS)
+        self.lag: Optional[float] = None
+        self.checked_at = float("-inf")
+
+    @property
+    def name(self) -> str:
+        return f"{self.host}:{self.port}" if self.port else self.host
+
+    def acquire(self, max_retries: int = 1) -> mysql.connector.MySQLConnection:
+        # Reads have the primary to fall back on, so a replica gets one attempt
+        return super().acquire(max_retries)
+
+    def measure_lag(self):
+        self.lag = self._measure_lag()
+        self.checked_at = time.monotonic()
+
+    def _measure_lag(self) -> Optional[float]:
+        try:
+            with _connection(self) as connection:
+                status = _run(connection, "SHOW REPLICA STATUS", None, False, False, 0.0).first()
+        except Exception as e:
+            logger.warning(f"Could not check replica {self.name}: {e}")
+            return None
+        if status is None or status.get("Seconds_Behind_Source") is None:
+            logger.warning(f"{self.name} is not replicating")
+            return None
+        return float(status["Seconds_Behind_Source"])
+
+    def usable(self) -> bool:
+        # A measurement the monitor has not renewed, stuck connecting say, is not trusted
+        fresh = time.monotonic() - self.checked_at < 3 * DB_REPLICA_LAG_CHECK_SECONDS
+        return fresh and self.lag is not None and self.lag <= DB_REPLICA_MAX_LAG_SECONDS
+
+    def failed(self, error: Exception):
+        """Stop reading from this replica until its next lag check."""
+        logger.warning(f"Read from replica {self.name} failed, using the primary: {error}")
+        self.lag = None
+
+    def stats(self) -> dict:
+        return {"replica": self.name, "lag_seconds": self.lag, **super().stats()}
+
+
+def _replica_pool(address: str) -> ReplicaPool:
+    host, _, port = address.partition(":")
+    return ReplicaPool(DB_POOL_SIZE, host, int(port) if port else None)
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE)
+replica_pools = [_replica_pool(address) for address in MYSQL_REPLICAS]
+_next_replica = itertools.cycle(replica_pools)
+_replica_monitor_stop: Optional[threading.Event] = None
+
+
+def start_replica_monitor():
+    """Start measuring replica lag in a background thread. Until the first measurements, reads go to the primary."""
+    global _replica_monitor_stop
+    if not replica_pools or _replica_monitor_stop is not None:
+        return
+    stop = _replica_monitor_stop = threading.Event()
+
+    def monitor():
+        while True:
+            for pool in replica_pools:
+                pool.measure_lag()
+            if stop.wait(DB_REPLICA_LAG_CHECK_SECONDS):
+                return
+
+    threading.Thread(target=monitor, name="replica-monitor", daemon=True).start()
+
+
+def stop_replica_monitor():
+    global _replica_monitor_stop
+    if _replica_monitor_stop is not None:
+        _replica_monitor_stop.set()
+        _replica_monitor_stop = None
+
+# Users' last writes by monotonic time, and whether the request being
+# handled must read from the primary to see its user's writes
+_last_writes: dict[int, float] = {}
+_read_primary: ContextVar[bool] = ContextVar("read_primary", default=False)
+
+
+def read_as(user_id: int, writing: bool = False):
+    """
+    Route the rest of the current request's reads for a user.
+
+    A request that writes, and every request in the following
+    DB_REPLICA_STICKY_SECONDS, reads from the primary so the user sees
+    their own changes; otherwise reads may go to a replica. Writes are
+    relayed to the other workers, which will serve the user's next requests.
+
+    Args:
+        user_id: ID of the user the request acts for
+        writing: Whether the request may change the user's data
+    """
+    if not replica_pools:
+        return
+    if writing:
+        cluster.publish("user_wrote", user_id=user_id)
+    last_write = _last_writes.get(user_id)
+    if last_write is not None and time.monotonic() - last_write >= DB_REPLICA_STICKY_SECONDS:
+        del _last_writes[user_id]
+        last_write = None
+    _read_primary.set(last_write is not None)
+
+
+def _read_pool() -> ConnectionPool:
+    """A replica to read from, or the primary if none will do."""
+    if replica_pools and not _read_primary.get():
+        for _ in range(len(replica_pools)):
+            pool = next(_next_replica)
+            if pool.usable():
+                return pool
+    return db_pool
+
+
+@contextmanager
+def _connection(pool: ConnectionPool = db_pool, max_retries: Optional[int] = None) -> Iterator[mysql.connector.MySQLConnection]:
+    """Borrow a pooled connection for statements that need to share one."""
+    connection = pool.acquire() if max_retries is None else pool.acquire(max_retries)
+    reusable = False
+    try:
+        yield connection
+        reusable = True
+    finally:
+        pool.release(connection, reusable and connection.is_connected())
+
+
+def wait_for_database():
+    """Block until the database accepts connections, retrying as get_db_connection does."""
+    db_pool.release(db_pool.acquire())
+
+
+def ping_database() -> bool:
+    """Check the database answers, with one connection attempt and no retries."""
+    try:
+        connection = db_pool.acquire(max_retries=1)
+    except DatabaseConnectionError:
+        return False
+
+    try:
+        connection.ping(reconnect=False)
+    except Error:
+        db_pool.release(connection, reusable=False)
+        return False
+    db_pool.release(connection)
+    return True
+
+
+def _explain(connection: mysql.connector.MySQLConnection, query: str, params) -> Optional[list[dict]]:
+    """Capture the query plan of a SELECT on the connection it just ran on."""
+    if not query.lstrip().upper().startswith("SELECT"):
+        return None
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute(f"EXPLAIN {query}", params)
+        return cursor.fetchall()
+    except Error as e:
+        return [{"error": str(e)}]
+    finally:
+        cursor.close()
+
+
+def _run(
+    connection: mysql.connector.MySQLConnection,
+    query: str,
+    params,
+    many: bool,
+    commit: bool,
+    connect_seconds: float,
+) -> QueryResult:
+    cursor = connection.cursor(dictionary=True)
+    try:
+        started = time.perf_counter()
+        if many:
+            cursor.executemany(query, params)
+        else:
+            cursor.execute(query, params)
+        rows = cursor.fetchall() if cursor.with_rows else []
+        if commit:
+            connection.commit()
+        execute_seconds = time.perf_counter() - started
+        result = QueryResult(rows, cursor.rowcount, cursor.lastrowid)
+    finally:
+        cursor.close()
+
+    row_count = max(result.rowcount, len(rows), 0)
+    accessor = current_accessor()
+    key = querylog.record(query, accessor, row_count, connect_seconds, execute_seconds)
+    record_query()
+    if querylog.is_slow(execute_seconds) and not many:
+        querylog.record_slow(key, accessor, row_count, execute_seconds, _explain(connection, query, params))
+    return result
+
+
+def _execute(
+    query: str,
+    params=None,
+    *,
+    connection: Optional[mysql.connector.MySQLConnection] = None,
+    many: bool = False,
+    commit: bool = False,
+    replica: bool = False,
+    max_retries: Optional[int] = None,
+) -> QueryResult:
+    """
+    Execute one statement and record it in the query log.
+
+    Every accessor goes through here so each statement is fingerprinted
+    and timed, with connect time kept separate from execute time. Slow
+    SELECTs are logged along with their EXPLAIN output.
+
+    Args:
+        query:      SQL statement with %s or %(name)s placeholders
+        params:     Statement parameters, or a list of them when many is set
+        connection: Connection to run on; one is borrowed from the pool if None
+        many:       Run the statement once per parameter set with executemany
+        commit:     Commit after executing. Without it, a borrowed connection
+                    is rolled back as it goes back to the pool
+        replica:    Read from a replica when one is usable and the request
+                    need not see its user's recent writes, see read_as.
+                    A read that fails to reach the replica is retried on the primary
+        max_retries: Connection attempts if a new connection is needed, the
+                     pool's default if None
+
+    Returns:
+        QueryResult: Fetched rows as dictionaries, affected row count and last insert ID
+    """
+    if connection is not None:
+        return _run(connection, query, params, many, commit, 0.0)
+
+    pool = _read_pool() if replica else db_pool
+    if pool is not db_pool:
+        try:
+            return _execute_on(pool, query, params, many, commit)
+        except (InterfaceError, OperationalError, DatabaseConnectionError) as e:
+            # The replica is unreachable or went away; errors in the statement itself are the caller's
+            pool.failed(e)
+    return _execute_on(db_pool, query, params, many, commit, max_retries)
+
+
+def _execute_on(pool: ConnectionPool, query: str, params, many: bool, commit: bool, max_retries: Optional[int] = None) -> QueryResult:
+    started = time.perf_counter()
+    with _connection(pool, max_retries) as connection:
+        return _run(connection, query, params, many, commit, time.perf_counter() - started)
+
+
+def _read_row(query: str, params) -> Optional[dict]:
+    """
+    Look a row up by key on a replica, checking the primary if it is not
+    there: a key a client was just handed, such as a new session ID, may
+    not have reached the replica yet.
+    """
+    result = _execute(query, params, replica=True).first()
+    if result is None and replica_pools:
+        result = _execute(query, params).first()
+    return result
+
+
+@db_accessor
+def setup_database(initial_users: dict = None):
     # Define table schemas
     table_schemas = {
         "users": """
@@ -99,6 +637,8 @@ async def setup_database(initial_users: dict = None):
                 type VARCHAR(255) NOT NULL,
                 units VARCHAR(255) NOT NULL,
                 address VARCHAR(255) NOT NULL,
+                INDEX idx_sensors_user_id (user_id, id),
+                UNIQUE INDEX uq_sensors_address_type (address, type),
                 FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
             )
         """,
@@ -109,112 +649,133 @@ async def setup_database(initial_users: dict = None):
                 name VARCHAR(255) NOT NULL,
                 type VARCHAR(255) NOT NULL,
                 image_address VARCHAR(255),
+                INDEX idx_clothes_user_id (user_id, id),
                 FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
             )
         """,
         "data": """
             CREATE TABLE data (
                 id INT AUTO_INCREMENT PRIMARY KEY,
-                address VARCHAR(255) NOT NULL,
-                type VARCHAR(255) NOT NULL,
+                sensor_id INT NOT NULL,
                 value FLOAT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                seq INT UNSIGNED,
+                INDEX idx_data_sensor_timestamp (sensor_id, timestamp),
+                UNIQUE INDEX uq_data_sensor_seq (sensor_id, seq, timestamp),
+                FOREIGN KEY (sensor_id) REFERENCES sensors(id) ON DELETE CASCADE
+            )
+        """,
+        "alert_rules": """
+            CREATE TABLE alert_rules (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                sensor_id INT NOT NULL,
+                user_id INT NOT NULL,
+                kind VARCHAR(16) NOT NULL,
+                threshold DOUBLE NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                INDEX idx_alert_rules_sensor_id (sensor_id, id),
+                FOREIGN KEY (sensor_id) REFERENCES sensors(id) ON DELETE CASCADE,
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        """,
+        "alerts": """
+            CREATE TABLE alerts (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                rule_id INT NOT NULL,
+                sensor_id INT NOT NULL,
+                user_id INT NOT NULL,
+                value FLOAT NOT NULL,
+                score DOUBLE NOT NULL,
+                timestamp TIMESTAMP NOT NULL,
+                INDEX idx_alerts_user_id (user_id, id)
+            )
+        """,
+        "device_keys": """
+            CREATE TABLE device_keys (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                address VARCHAR(255) NOT NULL,
+                name VARCHAR(255) NOT NULL,
+                key_hash CHAR(64) NOT NULL UNIQUE,
+                prefix VARCHAR(16) NOT NULL,
+                tier VARCHAR(32) NOT NULL DEFAULT 'standard',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                revoked_at TIMESTAMP NULL,
+                INDEX idx_device_keys_user_id (user_id, id),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
             )
         """,
     }
 
     try:
-        # Get database connection
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
-        # Drop and recreate tables one by one
-        for table_name in ["data", "clothes", "sensors", "sessions", "users"]:
-            # Drop table if exists
-            logger.info(f"Dropping table {table_name} if exists...")
-            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
-            connection.commit()
+        with _connection() as connection:
+            # Drop and recreate tables one by one
+            for table_name in ["device_keys", "alerts", "alert_rules", "data", "clothes", "sensors", "sessions", "users"]:
+                # Drop table if exists
+                logger.info(f"Dropping table {table_name} if exists...")
+                _execute(f"DROP TABLE IF EXISTS {table_name}", connection=connection, commit=True)
+
+            # Recreate tables one by one
+            for table_name, create_query in table_schemas.items():
+                try:
+                    # Create table
+                    logger.info(f"Creating table {table_name}...")
+                    _execute(create_query, connection=connection, commit=True)
+                    logger.info(f"Table {table_name} created successfully")
 
-        # Recreate tables one by one
-        for table_name, create_query in table_schemas.items():
-            try:
-                # Create table
-                logger.info(f"Creating table {table_name}...")
-                cursor.execute(create_query)
-                connection.commit()
-                logger.info(f"Table {table_name} created successfully")
-
-            except Error as e:
-                logger.error(f"Error creating table {table_name}: {e}")
-                raise
+                except Error as e:
+                    logger.error(f"Error creating table {table_name}: {e}")
+                    raise
 
-        # Insert initial users if provided
-        if initial_users:
-            try:
-                insert_query = "INSERT INTO users (username, password, email, location) VALUES (%s, %s, %s, %s)"
-                for username, password, email, location in initial_users:
-                    cursor.execute(insert_query, (username, password, email, location))
-                connection.commit()
-                logger.info(f"Inserted {len(initial_users)} initial users")
-            except Error as e:
-                logger.error(f"Error inserting initial users: {e}")
-                raise
+            # Insert initial users if provided
+            if initial_users:
+                try:
+                    _execute(
+                        "INSERT INTO users (username, password, email, location) VALUES (%s, %s, %s, %s)",
+                        list(initial_users),
+                        connection=connection,
+                        many=True,
+                        commit=True,
+                    )
+                    logger.info(f"Inserted {len(initial_users)} initial users")
+                except Error as e:
+                    logger.error(f"Error inserting initial users: {e}")
+                    raise
+
+        logger.info("Database connection closed")
+        clothes_index.clear()
+        sensor_registry.clear()
+        device_keys.clear()
+        alert_engine.clear()
+        recent_readings.clear()
 
     except Exception as e:
         logger.error(f"Database setup failed: {e}")
         raise
 
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-            logger.info("Database connection closed")
-
 
-async def create_session(user_id: int, session_id: str) -> bool:
+@db_accessor
+def create_session(user_id: int, session_id: str) -> bool:
     """Create a new session in the database."""
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute(
-            "INSERT INTO sessions (id, user_id) VALUES (%s, %s)", (session_id, user_id)
-        )
-        connection.commit()
-        return True
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    _execute("INSERT INTO sessions (id, user_id) VALUES (%s, %s)", (session_id, user_id), commit=True)
+    return True
 
 
-async def get_session(session_id: str) -> Optional[dict]:
+@db_accessor
+def get_session(session_id: str) -> Optional[dict]:
     """Retrieve session from database."""
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(
-            """
-            SELECT *
-            FROM sessions s
-            WHERE s.id = %s;
-            """,
-            (session_id,)
-        )
-        return cursor.fetchone()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    return _read_row(
+        """
+        SELECT *
+        FROM sessions s
+        WHERE s.id = %s;
+        """,
+        (session_id,)
+    )
 
 
-async def extend_session(session_id: str) -> bool:
+@db_accessor
+def extend_session(session_id: str) -> bool:
     """
     Extend session lifetime.
 
@@ -224,66 +785,38 @@ async def extend_session(session_id: str) -> bool:
     Returns:
         bool: whether the session successfully extended
     """
-    connection = None
-    cursor = None
     try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(
+        result = _execute(
             """
             UPDATE sessions
             SET last_access = CURRENT_TIMESTAMP
             WHERE id = %s;
             """,
-            (session_id,)
+            (session_id,),
+            commit=True
         )
-        connection.commit()
-        return cursor.rowcount > 0
+        return result.rowcount > 0
     except Exception as e:
         logger.exception(f"Error extending session: {e}")
         return False
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
 
 
-async def delete_session_by_id(session_id: str) -> bool:
+@db_accessor
+def delete_session_by_id(session_id: str) -> bool:
     """Delete a session from the database."""
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute("DELETE FROM sessions WHERE id = %s", (session_id,))
-        connection.commit()
-        return True
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    _execute("DELETE FROM sessions WHERE id = %s", (session_id,), commit=True)
+    return True
 
 
-async def delete_session_by_user_id(user_id: str) -> bool:
+@db_accessor
+def delete_session_by_user_id(user_id: str) -> bool:
     """Delete a session from the database."""
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute("DELETE FROM sessions WHERE user_id = %s", (user_id,))
-        connection.commit()
-        return True
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    _execute("DELETE FROM sessions WHERE user_id = %s", (user_id,), commit=True)
+    return True
 
 
-async def get_user_by_id(user_id: int) -> Optional[dict]:
+@db_accessor
+def get_user_by_id(user_id: int) -> Optional[dict]:
     """
     Retrieve user from database by ID.
 
@@ -293,119 +826,78 @@ async def get_user_by_id(user_id: int) -> Optional[dict]:
     Returns:
         Optional[dict]: User data if found, None otherwise
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-        return cursor.fetchone()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    return _read_row("SELECT * FROM users WHERE id = %s", (user_id,))
 
 
-async def get_user_by_username(username: str) -> Optional[dict]:
+@db_accessor
+def get_user_by_username(username: str) -> Optional[dict]:
     """Retrieve user from database by username."""
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
-        return cursor.fetchone()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    return _read_row("SELECT * FROM users WHERE username = %s", (username,))
 
 
-async def create_user(username: str, password: str, email: str, location: str) -> Optional[int]:
+@db_accessor
+def create_user(username: str, password: str, email: str, location: str) -> Optional[int]:
     """
     Create a new user in the database.
     
     Args:
         username: Username of the new user
-        password: Password of the new user
+        password: Hashed password of the new user, see passwords.hash_password
         email:    Email of the new user
         location: Location of the new user
 
     Returns:
         Optional[int]: New user ID if successful, None otherwise
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute(
-            "INSERT INTO users (username, password, email, location) VALUES (%s, %s, %s, %s)", (username, password, email, location)
-        )
-        connection.commit()
-        return cursor.lastrowid
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    return _execute(
+        "INSERT INTO users (username, password, email, location) VALUES (%s, %s, %s, %s)",
+        (username, password, email, location),
+        commit=True
+    ).lastrowid
 
 
-async def update_user_by_id(user_id: int, new_username: Optional[str], new_password: Optional[str], new_email: Optional[str], new_location: Optional[str]) -> bool:
+@db_accessor
+def update_user_by_id(user_id: int, new_username: Optional[str], new_password: Optional[str], new_email: Optional[str], new_location: Optional[str]) -> bool:
     """
     Update a user in the database.
     
     Args:
         user_id: ID of the user to delete
-        new_password: New password
+        new_password: New hashed password
         new_email: New email
         new_location: New Location
 
     Returns:
         bool: True if successful, False if failed
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
+    if not new_username and not new_password and not new_email and not new_location:
+        return True
     
-        if not new_username and not new_password and not new_email and not new_location:
-            return True
-        
-        fields = []
-        values = {"id": user_id}
+    fields = []
+    values = {"id": user_id}
 
-        if new_username:
-            fields.append("username = %(username)s")
-            values["username"] = new_username
+    if new_username:
+        fields.append("username = %(username)s")
+        values["username"] = new_username
 
-        if new_password:
-            fields.append("password = %(password)s")
-            values["password"] = new_password
+    if new_password:
+        fields.append("password = %(password)s")
+        values["password"] = new_password
 
-        if new_email:
-            fields.append("email = %(email)s")
-            values["email"] = new_email
+    if new_email:
+        fields.append("email = %(email)s")
+        values["email"] = new_email
 
-        if new_location:
-            fields.append("location = %(location)s")
-            values["location"] = new_location
+    if new_location:
+        fields.append("location = %(location)s")
+        values["location"] = new_location
 
-        cursor.execute(f"UPDATE users SET {', '.join(fields)} WHERE id = %(id)s", values)
-
-        connection.commit()
-        return cursor.rowcount > 0
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    result = _execute(f"UPDATE users SET {', '.join(fields)} WHERE id = %(id)s", values, commit=True)
+    return result.rowcount > 0
 
 
-async def delete_user_by_id(user_id: int) -> bool:
+@db_accessor
+def delete_user_by_id(user_id: int) -> bool:
     """
     Delete a user in the database.
     
@@ -415,70 +907,55 @@ async def delete_user_by_id(user_id: int) -> bool:
     Returns:
         bool: True if successful, False if failed
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute(
-            "DELETE FROM users WHERE id = %s", (user_id,)
-        )
-        connection.commit()
-        return cursor.rowcount > 0
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    result = _execute("DELETE FROM users WHERE id = %s", (user_id,), commit=True)
+    cluster.publish("user_deleted", user_id=int(user_id))
+    return result.rowcount > 0
 
 
-async def get_sensor_by_id(sensor_id: str) -> Optional[dict]:
+@db_accessor
+def get_sensor_by_id(sensor_id: str) -> Optional[dict]:
     """Retrieve sensor from database by ID."""
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT * FROM sensors WHERE id = %s",
-            (sensor_id,)
-        )
-        return cursor.fetchone()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    return _read_row("SELECT * FROM sensors WHERE id = %s", (sensor_id,))
 
 
-async def get_sensors_by_user_id(user_id: int) -> list[int]:
+@db_accessor
+def get_all_sensors() -> list[dict]:
+    """Get the ID, owner, type and address of every sensor, for the sensor registry."""
+    # From the primary: the registry is kept current by events from here on, so must not start behind
+    return _execute("SELECT id, user_id, type, address FROM sensors").rows
+
+
+@db_accessor
+def get_sensors_by_user_id(
+    user_id: int,
+    limit: Optional[int] = None,
+    after: Optional[int] = None,
+    type: Optional[str] = None,
+    fields: Optional[list[str]] = None,
+) -> list[dict]:
     """
-    Get all sensors belonging to a user.
+    Get sensors belonging to a user, ordered by ID.
     
     Args:
         user_id:    ID of the user
+        limit:      Maximum number of sensors to return, all if None
+        after:      Only return sensors with an ID greater than this
+        type:       Only return sensors of this type
+        fields:     Columns to return, all if None (id is always included)
 
     Returns:
-        list[int]: List of all sensors belonging to the user
+        list[dict]: List of sensors belonging to the user
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT * FROM sensors WHERE user_id = %s",
-            (user_id,)
-        )
-        return cursor.fetchall()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    columns = _select_columns(fields, SENSOR_FIELDS)
+    return _execute(
+        _keyset_query("sensors", columns, type, after, limit),
+        {"user_id": user_id, "type": type, "after": after, "limit": limit},
+        replica=True
+    ).rows
 
 
-async def add_sensor(user_id: int, type: str, units: str, address: str) -> Optional[int]:
+@db_accessor
+def add_sensor(user_id: int, type: str, units: str, address: str) -> Optional[int]:
     """
     Add a sensor to the database.
     
@@ -490,26 +967,26 @@ async def add_sensor(user_id: int, type: str, units: str, address: str) -> Optio
 
     Returns:
         Optional[int]: New sensor ID if successful, None otherwise
+
+    Raises:
+        SensorExistsError: if a sensor with this address and type exists
     """
-    connection = None
-    cursor = None
     try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute(
+        sensor_id = _execute(
             "INSERT INTO sensors (user_id, type, units, address) VALUES (%s, %s, %s, %s)",
-            (user_id, type, units, address)
-        )
-        connection.commit()
-        return cursor.lastrowid
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-
-
-async def update_sensor(sensor_id: int, new_type: Optional[str] = None, new_units: Optional[str] = None, new_address: Optional[str] = None) -> bool:
+            (user_id, type, units, address),
+            commit=True
+        ).lastrowid
+    except IntegrityError as e:
+        # Another request registered the same address and type first
+        raise SensorExistsError(f"A sensor of type {type} already exists at {address}") from e
+    if sensor_id:
+        cluster.publish("sensor_added", sensor={"id": sensor_id, "user_id": int(user_id), "type": type, "address": address})
+    return sensor_id
+
+
+@db_accessor
+def update_sensor(sensor_id: int, new_type: Optional[str] = None, new_units: Optional[str] = None, new_address: Optional[str] = None) -> bool:
     """
     Add a sensor to the database.
     
@@ -521,44 +998,42 @@ async def update_sensor(sensor_id: int, new_type: Optional[str] = None, new_unit
 
     Returns:
         True if successful, False otherwise
-    """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
-        if not new_type and not new_units and not new_address:
-            return True
-        
-        fields = []
-        values = {"id": sensor_id}
 
-        if new_type:
-            fields.append("type = %(type)s")
-            values["type"] = new_type
-
-        if new_units:
-            fields.append("units = %(units)s")
-            values["units"] = new_units
+    Raises:
+        SensorExistsError: if the sensor would share its address and type with another
+    """
+    if not new_type and not new_units and not new_address:
+        return True
+    
+    fields = []
+    values = {"id": sensor_id}
 
-        if new_address:
-            fields.append("address = %(address)s")
-            values["address"] = new_address
+    if new_type:
+        fields.append("type = %(type)s")
+        values["type"] = new_type
 
-        cursor.execute(
-            f"UPDATE sensors SET {', '.join(fields)} WHERE id = %(id)s", values
-        )
-        connection.commit()
-        return cursor.rowcount > 0
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    if new_units:
+        fields.append("units = %(units)s")
+        values["units"] = new_units
 
+    if new_address:
+        fields.append("address = %(address)s")
+        values["address"] = new_address
 
-async def delete_sensor(sensor_id: int) -> bool:
+    previous = _execute("SELECT user_id, address FROM sensors WHERE id = %s", (sensor_id,)).first() if new_address else None
+    try:
+        result = _execute(f"UPDATE sensors SET {', '.join(fields)} WHERE id = %(id)s", values, commit=True)
+    except IntegrityError as e:
+        raise SensorExistsError("A sensor of that type already exists at that address") from e
+    if result.rowcount > 0 and (new_type or new_address):
+        cluster.publish("sensor_updated", sensor_id=int(sensor_id), type=new_type, address=new_address)
+    if previous is not None and previous["address"] != new_address:
+        _revoke_unused_device_keys(previous["user_id"], previous["address"])
+    return result.rowcount > 0
+
+
+@db_accessor
+def delete_sensor(sensor_id: int) -> bool:
     """
     Delete a sensor from the database.
     
@@ -568,71 +1043,76 @@ async def delete_sensor(sensor_id: int) -> bool:
     Returns:
         bool: True if successful, False otherwise
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute(
-            "DELETE FROM sensors WHERE id = %s",
-            (sensor_id,)
-        )
-        connection.commit()
-        return cursor.rowcount > 0
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    sensor = _execute("SELECT user_id, address FROM sensors WHERE id = %s", (sensor_id,)).first()
+    result = _execute("DELETE FROM sensors WHERE id = %s", (sensor_id,), commit=True)
+    cluster.publish("sensor_deleted", sensor_id=int(sensor_id))
+    if sensor is not None:
+        _revoke_unused_device_keys(sensor["user_id"], sensor["address"])
+    return result.rowcount > 0
 
 
-async def get_clothes_by_id(clothes_id: int) -> Optional[dict]:
+def _revoke_unused_device_keys(user_id: int, address: str):
+    """
+    Revoke a user's device keys for an address they no longer have a
+    sensor at, so the keys cannot send readings for whoever registers the
+    address next.
+    """
+    if _execute("SELECT 1 FROM sensors WHERE user_id = %s AND address = %s LIMIT 1", (user_id, address)).rows:
+        return
+
+    key_ids = [row["id"] for row in _execute(
+        "SELECT id FROM device_keys WHERE user_id = %s AND address = %s AND revoked_at IS NULL",
+        (user_id, address)
+    ).rows]
+    if not key_ids:
+        return
+
+    _execute(
+        "UPDATE device_keys SET revoked_at = CURRENT_TIMESTAMP WHERE user_id = %s AND address = %s AND revoked_at IS NULL",
+        (user_id, address),
+        commit=True
+    )
+    for key_id in key_ids:
+        cluster.publish("device_key_revoked", key_id=key_id)
+
+
+@db_accessor
+def get_clothes_by_id(clothes_id: int) -> Optional[dict]:
     """Retrieve article of clothing by ID"""
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT * FROM clothes WHERE id = %s",
-            (clothes_id,)
-        )
-        return cursor.fetchone()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    return _read_row("SELECT * FROM clothes WHERE id = %s", (clothes_id,))
 
 
-async def get_clothes_by_user_id(user_id: int) -> list[dict]:
+@db_accessor
+def get_clothes_by_user_id(
+    user_id: int,
+    limit: Optional[int] = None,
+    after: Optional[int] = None,
+    type: Optional[str] = None,
+    fields: Optional[list[str]] = None,
+) -> list[dict]:
     """
-    Get all clothing items belonging to a user.
+    Get clothing items belonging to a user, ordered by ID.
     
     Args:
         user_id:    ID of the user
+        limit:      Maximum number of items to return, all if None
+        after:      Only return items with an ID greater than this
+        type:       Only return items of this type
+        fields:     Columns to return, all if None (id is always included)
 
     Returns:
-        list[int]: List of all clothing items belonging to the user
+        list[dict]: List of clothing items belonging to the user
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT * FROM clothes WHERE user_id = %s",
-            (user_id,)
-        )
-        return cursor.fetchall()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    columns = _select_columns(fields, CLOTHES_FIELDS)
+    return _execute(
+        _keyset_query("clothes", columns, type, after, limit),
+        {"user_id": user_id, "type": type, "after": after, "limit": limit},
+        replica=True
+    ).rows
 
 
-async def add_clothes(user_id: int, name: str, type: str, image_address: str) -> Optional[int]:
+@db_accessor
+def add_clothes(user_id: int, name: str, type: str, image_address: str) -> Optional[int]:
     """
     Add an article of clothing to the database.
     
@@ -645,25 +1125,49 @@ async def add_clothes(user_id: int, name: str, type: str, image_address: str) ->
     Returns:
         Optional[int]: New clothing ID if successful, None otherwise
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute(
-            "INSERT INTO clothes (user_id, name, type, image_address) VALUES (%s, %s, %s, %s)",
-            (user_id, name, type, image_address)
-        )
-        connection.commit()
-        return cursor.lastrowid
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    clothes_id = _execute(
+        "INSERT INTO clothes (user_id, name, type, image_address) VALUES (%s, %s, %s, %s)",
+        (user_id, name, type, image_address),
+        commit=True
+    ).lastrowid
+    cluster.publish("clothes_added", clothes={
+        "id": clothes_id,
+        "user_id": int(user_id),
+        "name": name,
+        "type": type,
+        "image_address": image_address,
+    })
+    return clothes_id
+
+
+@db_accessor
+def add_clothes_batch(user_id: int, clothes: list[tuple[str, str, str]]) -> int:
+    """
+    Add many articles of clothing to the database in one transaction.
+    
+    Args:
+        user_id:    ID of the user to add the clothing to
+        clothes:    (name, type, image_address) of each article of clothing
 
+    Returns:
+        int: Number of articles of clothing added
+    """
+    if not clothes:
+        return 0
+
+    # A failed batch is never committed, so none of it is kept
+    result = _execute(
+        "INSERT INTO clothes (user_id, name, type, image_address) VALUES (%s, %s, %s, %s)",
+        [(user_id, name, type, image_address) for name, type, image_address in clothes],
+        many=True,
+        commit=True
+    )
+    cluster.publish("user_clothes_changed", user_id=int(user_id))
+    return result.rowcount
 
-async def update_clothes(clothes_id: int, new_name: Optional[str], new_type: Optional[str], new_image_address: Optional[str]) -> bool:
+
+@db_accessor
+def update_clothes(clothes_id: int, new_name: Optional[str], new_type: Optional[str], new_image_address: Optional[str]) -> bool:
     """
     Update an article of clothing in the database.
     
@@ -676,43 +1180,31 @@ async def update_clothes(clothes_id: int, new_name: Optional[str], new_type: Opt
     Returns:
         Optional[int]: New clothing ID if successful, None otherwise
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
-        if not new_name and not new_type and not new_image_address:
-            return True
-        
-        fields = []
-        values = {"id": clothes_id}
+    if not new_name and not new_type and not new_image_address:
+        return True
+    
+    fields = []
+    values = {"id": clothes_id}
 
-        if new_name:
-            fields.append("name = %(name)s")
-            values["name"] = new_name
+    if new_name:
+        fields.append("name = %(name)s")
+        values["name"] = new_name
 
-        if new_type:
-            fields.append("type = %(type)s")
-            values["type"] = new_type
+    if new_type:
+        fields.append("type = %(type)s")
+        values["type"] = new_type
 
-        if new_image_address:
-            fields.append("image_address = %(image_address)s")
-            values["image_address"] = new_image_address
+    if new_image_address:
+        fields.append("image_address = %(image_address)s")
+        values["image_address"] = new_image_address
 
-        cursor.execute(
-            f"UPDATE clothes SET {', '.join(fields)} WHERE id = %(id)s", values
-        )
-        connection.commit()
-        return cursor.rowcount > 0
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    result = _execute(f"UPDATE clothes SET {', '.join(fields)} WHERE id = %(id)s", values, commit=True)
+    cluster.publish("clothes_updated", clothes_id=int(clothes_id), name=new_name, type=new_type, image_address=new_image_address)
+    return result.rowcount > 0
 
 
-async def delete_clothes(clothes_id: int) -> True:
+@db_accessor
+def delete_clothes(clothes_id: int) -> True:
     """
     Delete an article of clothing from the database.
     
@@ -722,55 +1214,41 @@ async def delete_clothes(clothes_id: int) -> True:
     Returns:
         bool: True if successful, False otherwise
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute(
-            "DELETE FROM clothes WHERE id = %s",
-            (clothes_id,)
-        )
-        connection.commit()
-        return cursor.rowcount > 0
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    result = _execute("DELETE FROM clothes WHERE id = %s", (clothes_id,), commit=True)
+    cluster.publish("clothes_deleted", clothes_id=int(clothes_id))
+    return result.rowcount > 0
 
 
-async def add_data(value: float, type: str, address: str) -> Optional[int]:
+@db_accessor
+def add_data_batch(readings: list[tuple[int, float, datetime, Optional[int]]]) -> int:
     """
-    Add sensor data to the database.
-    
+    Add many sensor readings to the database in one statement.
+
+    Readings repeating the (sensor_id, seq, timestamp) of one already
+    stored are skipped, so retried deliveries are only stored once.
+    Connecting is tried once: the ingest writer retries failed batches
+    with its own backoff.
+
     Args:
-        value:      Value of sensor reading
-        type:       Type of sensor
-        address:    Address of the sensor
+        readings:   (sensor_id, value, timestamp, seq) of each reading
 
     Returns:
-        Optional[int]: New data ID if successful, None otherwise
+        int: Number of readings added
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        cursor.execute(
-            "INSERT INTO data (value, type, address) VALUES (%s, %s, %s)",
-            (value, type, address)
-        )
-        connection.commit()
-        return cursor.lastrowid
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    if not readings:
+        return 0
+
+    return _execute(
+        "INSERT IGNORE INTO data (sensor_id, value, timestamp, seq) VALUES (%s, %s, %s, %s)",
+        readings,
+        many=True,
+        commit=True,
+        max_retries=1
+    ).rowcount
 
 
-async def get_data_by_sensor_id(sensor_id: int, limit: int = 20) -> list[dict]:
+@db_accessor
+def get_data_by_sensor_id(sensor_id: int, limit: int = 20) -> list[dict]:
     """
     Get data belonging to a sensor.
     
@@ -780,33 +1258,20 @@ async def get_data_by_sensor_id(sensor_id: int, limit: int = 20) -> list[dict]:
     Returns:
         list[int]: List of all data belonging to that sensor
     """
-    connection = None
-    cursor = None
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM sensors WHERE id = %s", (sensor_id,))
-        sensor = cursor.fetchone()
-        sensor_address = sensor.get('address')
-
-        cursor.execute(
-            '''
-            SELECT * FROM data
-            WHERE address = %s
-            ORDER BY timestamp DESC
-            LIMIT %s;
-            ''',
-            (sensor_address, limit)
-        )
-        return cursor.fetchall()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-
-
-async def get_recent_data(sensor_id: int) -> Optional[dict]:
+    return _execute(
+        '''
+        SELECT * FROM data
+        WHERE sensor_id = %s
+        ORDER BY timestamp DESC
+        LIMIT %s;
+        ''',
+        (sensor_id, limit),
+        replica=True
+    ).rows
+
+
+@db_accessor
+def get_recent_data(sensor_id: int) -> Optional[dict]:
     """
     Get most recent data belonging to a sensor.
     
@@ -816,23 +1281,278 @@ async def get_recent_data(sensor_id: int) -> Optional[dict]:
     Returns:
         Optional[dict]: Most recent data belonging to that sensor or None
     """
+    return _execute(
+        '''
+        SELECT * FROM data
+        WHERE sensor_id = %s
+        ORDER BY timestamp DESC
+        LIMIT 1;
+        ''',
+        (sensor_id,),
+        replica=True
+    ).first()
+
+
+def iter_data_by_sensor_id(
+    sensor_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    chunk_size: int = 10000,
+) -> Iterator[list[tuple[datetime, float]]]:
+    """
+    Stream data belonging to a sensor in timestamp order.
+
+    Rows are read through an unbuffered cursor and fetched in chunks, so
+    memory stays flat however large the range is. This is a plain
+    generator so callers can iterate it off the event loop. Reads from a
+    replica when one is usable, see read_as.
+
+    Args:
+        sensor_id:  ID of the sensor
+        start:      Only include data at or after this time
+        end:        Only include data before this time
+        chunk_size: Number of rows fetched per round trip
+
+    Yields:
+        list[tuple[datetime, float]]: Chunks of (timestamp, value) rows
+    """
+    query = """
+        SELECT timestamp, value FROM data
+        WHERE sensor_id = %(sensor_id)s
+    """
+    if start is not None:
+        query += " AND timestamp >= %(start)s"
+    if end is not None:
+        query += " AND timestamp < %(end)s"
+    query += " ORDER BY timestamp"
+
+    pool = _read_pool()
     connection = None
     cursor = None
+    finished = False
+    row_count = 0
+    connect_seconds = execute_seconds = 0.0
+    accessor = current_accessor() or "iter_data_by_sensor_id"
     try:
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(
-            '''
-            SELECT d.* FROM data d
-            JOIN sensors s ON s.address = d.address AND s.type = d.type
-            WHERE s.id = %s 
-            ORDER BY d.timestamp DESC
-            LIMIT 1;
-            ''', (sensor_id,)
-        )
-        return cursor.fetchone()
+        started = time.perf_counter()
+        try:
+            connection = pool.acquire()
+        except DatabaseConnectionError as e:
+            if pool is db_pool:
+                raise
+            pool.failed(e)
+            pool = db_pool
+            connection = pool.acquire()
+        connect_seconds = time.perf_counter() - started
+
+        # Execute time covers fetching every chunk but not the time the
+        # consumer spends encoding and sending them
+        started = time.perf_counter()
+        cursor = connection.cursor(buffered=False)
+        cursor.execute(query, {"sensor_id": sensor_id, "start": start, "end": end})
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            execute_seconds += time.perf_counter() - started
+            if not rows:
+                finished = True
+                break
+            row_count += len(rows)
+            yield rows
+            started = time.perf_counter()
     finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
\ No newline at end of file
+        if connection is not None:
+            querylog.record(query, accessor, row_count, connect_seconds, execute_seconds)
+        try:
+            if cursor:
+                cursor.close()
+        except Error:
+            pass
+        if connection is not None:
+            # If the consumer stopped before reading every row, the unread
+            # result is dropped along with the connection
+            pool.release(connection, finished and connection.is_connected())
+
+
+@db_accessor
+def get_alert_rules() -> list[dict]:
+    """Get every alert rule."""
+    # From the primary: the alert engine is kept current by events from here on, so must not start behind
+    return _execute("SELECT id, sensor_id, user_id, kind, threshold FROM alert_rules").rows
+
+
+@db_accessor
+def get_alert_rules_by_sensor_id(sensor_id: int) -> list[dict]:
+    """Get the alert rules of a sensor, ordered by ID."""
+    return _execute(
+        "SELECT id, sensor_id, kind, threshold, created_at FROM alert_rules WHERE sensor_id = %s ORDER BY id",
+        (sensor_id,),
+        replica=True
+    ).rows
+
+
+@db_accessor
+def get_alert_rule_by_id(rule_id: int) -> Optional[dict]:
+    """Retrieve alert rule from database by ID."""
+    return _read_row("SELECT * FROM alert_rules WHERE id = %s", (rule_id,))
+
+
+@db_accessor
+def add_alert_rule(sensor_id: int, user_id: int, kind: str, threshold: float) -> Optional[int]:
+    """
+    Add an alert rule to a sensor and start evaluating it.
+
+    Args:
+        sensor_id:  ID of the sensor the rule watches
+        user_id:    ID of the user owning the sensor
+        kind:       One of alerts.RULE_KINDS
+        threshold:  Value, z-score or rate per second the rule fires beyond
+
+    Returns:
+        Optional[int]: New rule ID if successful, None otherwise
+    """
+    rule_id = _execute(
+        "INSERT INTO alert_rules (sensor_id, user_id, kind, threshold) VALUES (%s, %s, %s, %s)",
+        (sensor_id, user_id, kind, threshold),
+        commit=True
+    ).lastrowid
+
+    if rule_id:
+        cluster.publish("alert_rule_added", rule={
+            "id": rule_id,
+            "sensor_id": int(sensor_id),
+            "user_id": int(user_id),
+            "kind": kind,
+            "threshold": threshold,
+        })
+    return rule_id
+
+
+@db_accessor
+def delete_alert_rule(rule_id: int) -> bool:
+    """
+    Delete an alert rule and stop evaluating it.
+
+    Args:
+        rule_id:    ID of the rule to delete
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    result = _execute("DELETE FROM alert_rules WHERE id = %s", (rule_id,), commit=True)
+    cluster.publish("alert_rule_deleted", rule_id=int(rule_id))
+    return result.rowcount > 0
+
+
+@db_accessor
+def add_alerts_batch(alerts: list[tuple[int, int, int, float, float, datetime]]) -> int:
+    """
+    Add many raised alerts to the database in one statement. Connecting
+    is tried once, so an outage does not hold up the ingest writer.
+
+    Args:
+        alerts:     (rule_id, sensor_id, user_id, value, score, timestamp) of each alert
+
+    Returns:
+        int: Number of alerts added
+    """
+    if not alerts:
+        return 0
+
+    return _execute(
+        "INSERT INTO alerts (rule_id, sensor_id, user_id, value, score, timestamp) VALUES (%s, %s, %s, %s, %s, %s)",
+        alerts,
+        many=True,
+        commit=True,
+        max_retries=1
+    ).rowcount
+
+
+@db_accessor
+def get_alerts_by_user_id(user_id: int, limit: int = 50, before: Optional[int] = None) -> list[dict]:
+    """
+    Get alerts raised for a user's sensors, newest first.
+
+    Args:
+        user_id:    ID of the user
+        limit:      Maximum number of alerts to return
+        before:     Only return alerts with an ID less than this
+
+    Returns:
+        list[dict]: List of alerts belonging to the user
+    """
+    query = "SELECT * FROM alerts WHERE user_id = %(user_id)s"
+    if before is not None:
+        query += " AND id < %(before)s"
+    query += " ORDER BY id DESC LIMIT %(limit)s"
+    return _execute(query, {"user_id": user_id, "before": before, "limit": limit}, replica=True).rows
+
+
+@db_accessor
+def add_device_key(user_id: int, address: str, name: str, key_hash: str, prefix: str) -> Optional[int]:
+    """
+    Add a device key to the database.
+
+    Args:
+        user_id:    ID of the user owning the device
+        address:    Address of the device the key may send readings for
+        name:       Label for the key
+        key_hash:   Hash of the key, see devicekeys.hash_key
+        prefix:     Start of the key, kept to tell keys apart
+
+    Returns:
+        Optional[int]: New key ID if successful, None otherwise
+    """
+    return _execute(
+        "INSERT INTO device_keys (user_id, address, name, key_hash, prefix) VALUES (%s, %s, %s, %s, %s)",
+        (user_id, address, name, key_hash, prefix),
+        commit=True
+    ).lastrowid
+
+
+@db_accessor
+def get_device_key_by_hash(key_hash: str) -> Optional[dict]:
+    """Retrieve an unrevoked device key by the hash of the key."""
+    # From the primary, so a key revoked moments ago is not cached again from a replica
+    return _execute(
+        "SELECT id, user_id, address, tier FROM device_keys WHERE key_hash = %s AND revoked_at IS NULL",
+        (key_hash,)
+    ).first()
+
+
+@db_accessor
+def get_device_key_by_id(key_id: int) -> Optional[dict]:
+    """Retrieve device key from database by ID."""
+    return _read_row(
+        "SELECT id, user_id, address, name, prefix, tier, created_at, revoked_at FROM device_keys WHERE id = %s",
+        (key_id,)
+    )
+
+
+@db_accessor
+def get_device_keys_by_user_id(user_id: int) -> list[dict]:
+    """Get the device keys of a user, revoked ones included, ordered by ID."""
+    return _execute(
+        "SELECT id, address, name, prefix, tier, created_at, revoked_at FROM device_keys WHERE user_id = %s ORDER BY id",
+        (user_id,),
+        replica=True
+    ).rows
+
+
+@db_accessor
+def revoke_device_key(key_id: int) -> bool:
+    """
+    Revoke a device key, refusing it from now on.
+
+    Args:
+        key_id:     ID of the key to revoke
+
+    Returns:
+        bool: True if successful, False if the key was already revoked or does not exist
+    """
+    result = _execute(
+        "UPDATE device_keys SET revoked_at = CURRENT_TIMESTAMP WHERE id = %s AND revoked_at IS NULL",
+        (key_id,),
+        commit=True
+    )
+    cluster.publish("device_key_revoked", key_id=int(key_id))
+    return result.rowcount > 0
@@ -11,17 +11,79 @@ import uuid
 import time
 import json
 from datetime import datetime, timedelta
+import os
 from pydantic import BaseModel
 import asyncio
 
 from database import (
     get_session,
     get_user_by_id,
-    extend_session
+    extend_session,
+    read_as
 )
+from metrics import record_auth
 
 SESSION_EXPIRY_HOURS = 24
 
+# Bearer token for the metrics and debug routes; without it only local clients may use them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+LOOPBACK_HOSTS = ("127.0.0.1", "::1")
+
+async def get_session_user_id(sessionId: Optional[str]) -> Optional[int]:
+    """
+    Resolve a session cookie to its user's ID and extend the session, for
+    routes such as websockets that cannot use auth_required.
+    Returns None if the session is missing or expired.
+    """
+    if not sessionId:
+        return None
+
+    session = await get_session(sessionId)
+    if not session:
+        return None
+
+    expiry_threshold = datetime.now() - timedelta(hours=SESSION_EXPIRY_HOURS)
+    if session.get("last_access") < expiry_threshold:
+        return None
+
+    read_as(session.get("user_id"))
+    await extend_session(sessionId)
+    return session.get("user_id")
+
+async def _authenticate(request: Request) -> Optional[dict]:
+    """
+    Resolve the session cookie to its user, extend the session and set the
+    user in request state. Returns None if the session is missing or expired.
+    """
+    sessionId = request.cookies.get("sessionId")
+    if not sessionId:
+        return None
+
+    session = await get_session(sessionId)
+    if not session:
+        return None
+
+    # Handle expired session
+    expiry_threshold = datetime.now() - timedelta(hours=SESSION_EXPIRY_HOURS)
+    if session.get("last_access") < expiry_threshold:
+        return None
+
+    # Requests that may write, and the user's requests shortly after, read from the primary
+    read_as(session.get("user_id"), writing=request.method not in ("GET", "HEAD"))
+
+    user = await get_user_by_id(session.get("user_id"))
+    if not user:
+        return None
+
+    # Set user in request state for later access
+    request.state.username = str(user.get("username"))
+    request.state.userId = user.get("id")
+    request.state.user = user
+
+    # Extend session
+    await extend_session(sessionId)
+    return user
+
 def auth_required(func: Callable) -> Callable:
     """
     Universal authentication decorator for FastAPI route handlers.
@@ -61,33 +123,13 @@ def auth_required(func: Callable) -> Callable:
             # Get response from kwargs or create new one
             response = kwargs.get('response', None)
             
-            redirect = RedirectResponse("/login")
-
-            # Check if user is authenticated
-            sessionId = request.cookies.get("sessionId")
-            if not sessionId:
-                return redirect
-            
-            session = await get_session(sessionId)
-            if not session:
-                return redirect
-            
-            # Handle expired session
-            lastAccess = session.get("last_access")
-            expiry_threshold = expiry_threshold = datetime.now() - timedelta(hours=SESSION_EXPIRY_HOURS)
-            if lastAccess < expiry_threshold:
+            started = time.perf_counter()
+            try:
+                user = await _authenticate(request)
+            finally:
+                record_auth(time.perf_counter() - started)
+            if user is None:
                 return RedirectResponse("/login")
-
-            user = await get_user_by_id(session.get("user_id"))
-            if not user:
-                return redirect
-
-            # Set user in request state for later access
-            request.state.username = str(user.get("username"))
-            request.state.userId = user.get("id")
-            
-            # Extend session
-            await extend_session(sessionId)
             
             # Continue with the original function
             return await func(*args, **kwargs)
@@ -124,6 +166,8 @@ def auth_required(func: Callable) -> Callable:
                 session = loop.run_until_complete(asyncio.to_thread(get_session, sessionId))
                 if not session:
                     return redirect
+
+                read_as(session.get("user_id"), writing=request.method not in ("GET", "HEAD"))
                 
                 user = loop.run_until_complete(asyncio.to_thread(get_user_by_id, session.get("user_id")))
                 if not user:
@@ -143,3 +187,37 @@ def auth_required(func: Callable) -> Callable:
         return sync_wrapper
 
 
+
+
+def admin_required(func: Callable) -> Callable:
+    """
+    Restrict an async route handler to operators: requests bearing ADMIN_TOKEN,
+    or, when no token is configured, requests made directly from this host.
+
+    Usage:
+    ```
+    @app.get("/debug/thing")
+    @admin_required
+    async def debug_thing(request: Request):
+        return {...}
+    ```
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        request = next((arg for arg in args if isinstance(arg, Request)), kwargs.get('request'))
+        if not request:
+            raise HTTPException(status_code=500, detail="Request object not found in function arguments")
+
+        if ADMIN_TOKEN:
+            scheme, _, token = request.headers.get("authorization", "").partition(" ")
+            if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+                raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
+        else:
+            # A proxy in front of the app connects from loopback too, so forwarded requests are not local
+            client = request.client.host if request.client else None
+            if client not in LOOPBACK_HOSTS or "x-forwarded-for" in request.headers:
+                raise HTTPException(status_code=403, detail="Forbidden")
+
+        return await func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,126 @@
+import time
+import hashlib
+import secrets
+
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+KEY_PREFIX = "wdk_"
+# Characters of a key kept in the clear so owners can tell their keys apart
+DISPLAY_PREFIX_LENGTH = 12
+
+# Bound on verified keys held; the least recently used are dropped first
+MAX_CACHED_KEYS = 100_000
+# How long a key that failed verification is refused without asking the database again
+REJECTED_TTL_SECONDS = 60
+MAX_REJECTED_KEYS = 10_000
+
+
+class DeviceKey(NamedTuple):
+    id: int
+    user_id: int
+    address: str
+    tier: str
+
+
+def generate_key() -> str:
+    """A new device key. Only its hash is stored, so it can be shown once."""
+    return KEY_PREFIX + secrets.token_urlsafe(32)
+
+
+def hash_key(key: str) -> str:
+    # Keys are 256 random bits, so a fast unsalted hash is as strong as a slow one
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def display_prefix(key: str) -> str:
+    return key[:DISPLAY_PREFIX_LENGTH]
+
+
+class DeviceKeyCache:
+    """
+    Verified device keys held in memory, along with each key's ingest usage.
+
+    A key is hashed and looked up in the database only the first time it
+    is seen; after that verification is a dict lookup. Keys that failed
+    verification are remembered briefly so a device retrying a bad key
+    does not cost a query per request. Revoking a key drops it from the
+    cache straight away.
+    """
+
+    def __init__(self):
+        self.verified: OrderedDict[str, DeviceKey] = OrderedDict()
+        self.by_id: dict[int, str] = {}
+        # key -> monotonic time the rejection expires
+        self.rejected: OrderedDict[str, float] = OrderedDict()
+        # key id -> [requests, readings, last seen]
+        self.usage: dict[int, list] = {}
+
+    def clear(self):
+        self.verified.clear()
+        self.by_id.clear()
+        self.rejected.clear()
+        self.usage.clear()
+
+    def get(self, key: str) -> Optional[DeviceKey]:
+        device_key = self.verified.get(key)
+        if device_key is not None:
+            self.verified.move_to_end(key)
+        return device_key
+
+    def is_rejected(self, key: str) -> bool:
+        expires = self.rejected.get(key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self.rejected[key]
+            return False
+        return True
+
+    def add(self, key: str, device_key: DeviceKey):
+        self.verified[key] = device_key
+        self.by_id[device_key.id] = key
+        if len(self.verified) > MAX_CACHED_KEYS:
+            _, evicted = self.verified.popitem(last=False)
+            self.by_id.pop(evicted.id, None)
+
+    def reject(self, key: str):
+        self.rejected[key] = time.monotonic() + REJECTED_TTL_SECONDS
+        self.rejected.move_to_end(key)
+        if len(self.rejected) > MAX_REJECTED_KEYS:
+            self.rejected.popitem(last=False)
+
+    def invalidate(self, key_id: int):
+        key = self.by_id.pop(key_id, None)
+        if key is not None:
+            self.verified.pop(key, None)
+
+    def invalidate_user(self, user_id: int):
+        for device_key in [device_key for device_key in self.verified.values() if device_key.user_id == user_id]:
+            self.invalidate(device_key.id)
+            self.usage.pop(device_key.id, None)
+
+    def record(self, key_id: int, readings: int):
+        usage = self.usage.get(key_id)
+        if usage is None:
+            usage = self.usage[key_id] = [0, 0, None]
+        usage[0] += 1
+        usage[1] += readings
+        usage[2] = datetime.now()
+
+    def usage_of(self, key_id: int) -> dict:
+        requests, readings, last_seen = self.usage.get(key_id, (0, 0, None))
+        return {
+            "requests": requests,
+            "readings": readings,
+            "last_seen": last_seen.strftime("%Y-%m-%d %H:%M:%S") if last_seen else None,
+        }
+
+    def busiest(self, limit: int = 100) -> list[dict]:
+        """Device keys by readings sent since startup, most first."""
+        ranked = sorted(self.usage.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [{"id": key_id, **self.usage_of(key_id)} for key_id, _ in ranked]
+
+
+device_keys = DeviceKeyCache()
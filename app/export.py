@@ -0,0 +1,101 @@
+from datetime import datetime
+from typing import Iterable, Iterator
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Rows fetched from the database per round trip, and per Parquet row group
+EXPORT_CHUNK_ROWS = 10000
+
+
+def encode_csv(chunks: Iterable[list[tuple[datetime, float]]]) -> Iterator[bytes]:
+    """
+    Encode chunks of (timestamp, value) rows as CSV, one output chunk per
+    input chunk. Neither column can need quoting, so lines are formatted
+    directly instead of going through the csv module.
+    """
+    yield b"timestamp,value\n"
+    for rows in chunks:
+        yield "".join(f"{timestamp.isoformat()},{value!r}\n" for timestamp, value in rows).encode()
+
+
+def encode_ndjson(chunks: Iterable[list[tuple[datetime, float]]]) -> Iterator[bytes]:
+    """Encode chunks of (timestamp, value) rows as newline delimited JSON."""
+    for rows in chunks:
+        yield "".join(
+            f'{{"timestamp": "{timestamp.isoformat()}", "value": {value!r}}}\n'
+            for timestamp, value in rows
+        ).encode()
+
+
+class _DrainableSink:
+    """
+    Write-only file that hands written bytes back through `drain()`.
+
+    Parquet records absolute offsets in its footer, so `tell()` keeps
+    counting every byte written even after it has been drained.
+    """
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def encode_parquet(chunks: Iterable[list[tuple[datetime, float]]]) -> Iterator[bytes]:
+    """
+    Encode chunks of (timestamp, value) rows as a Parquet file, writing one
+    row group per chunk so only a single chunk is held in memory.
+
+    Raises:
+        ImportError: if pyarrow is not installed
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([("timestamp", pa.timestamp("s")), ("value", pa.float32())])
+    sink = _DrainableSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="zstd")
+    try:
+        for rows in chunks:
+            if not rows:
+                continue
+            timestamps, values = zip(*rows)
+            writer.write_table(pa.table(
+                [pa.array(timestamps, pa.timestamp("s")), pa.array(values, pa.float32())],
+                schema=schema,
+            ))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {
+    "csv": encode_csv,
+    "ndjson": encode_ndjson,
+    "parquet": encode_parquet,
+}
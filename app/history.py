@@ -0,0 +1,116 @@
+import os
+
+from array import array
+from datetime import datetime
+from typing import Iterable, Optional
+
+# Readings kept per sensor, enough to draw a dashboard chart in full
+RECENT_READINGS = int(os.getenv("RECENT_READINGS", "20"))
+
+# Stored in place of a missing sequence number
+NO_SEQ = -1
+
+
+class RecentReadings:
+    """
+    The last readings received from one sensor, in fixed size arrays used
+    as a ring: appending overwrites the oldest reading once it is full.
+    """
+
+    __slots__ = ("values", "timestamps", "seqs", "start", "count")
+
+    def __init__(self, size: int):
+        self.values = array("d", bytes(8 * size))
+        # Seconds since the epoch, from naive local datetimes like the data table's
+        self.timestamps = array("d", bytes(8 * size))
+        self.seqs = array("q", bytes(8 * size))
+        self.start = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, value: float, timestamp: datetime, seq: Optional[int]):
+        size = len(self.values)
+        if self.count < size:
+            index = (self.start + self.count) % size
+            self.count += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % size
+        self.values[index] = value
+        self.timestamps[index] = timestamp.timestamp()
+        self.seqs[index] = NO_SEQ if seq is None else seq
+
+    def readings(self) -> list[dict]:
+        """Readings held, oldest first."""
+        size = len(self.values)
+        indexes = sorted(((self.start + offset) % size for offset in range(self.count)), key=self.timestamps.__getitem__)
+        return [
+            {
+                "value": self.values[index],
+                "timestamp": datetime.fromtimestamp(self.timestamps[index]),
+                "seq": None if self.seqs[index] == NO_SEQ else self.seqs[index],
+            }
+            for index in indexes
+        ]
+
+
+class RecentHistory:
+    """
+    The last RECENT_READINGS readings of every sensor, filled by ingest so
+    live views can show a full chart the moment they open without reading
+    the data table.
+
+    After a restart a sensor's buffer only holds what has arrived since;
+    the first time it is read it is seeded once from the database.
+    """
+
+    def __init__(self, size: int = RECENT_READINGS):
+        self.size = size
+        self.buffers: dict[int, RecentReadings] = {}
+        self.seeded: set[int] = set()
+
+    def clear(self):
+        self.buffers.clear()
+        self.seeded.clear()
+
+    def record(self, sensor_id: int, value: float, timestamp: datetime, seq: Optional[int]):
+        buffer = self.buffers.get(sensor_id)
+        if buffer is None:
+            buffer = self.buffers[sensor_id] = RecentReadings(self.size)
+        buffer.append(value, timestamp, seq)
+
+    def is_seeded(self, sensor_id: int) -> bool:
+        return sensor_id in self.seeded
+
+    def seed(self, sensor_id: int, rows: Iterable[dict]):
+        """
+        Put stored readings under whatever arrived since startup. Stored
+        readings from the same second as the oldest one held or later are
+        skipped, since those were written since and are already held; the
+        data table does not keep fractions of a second.
+        """
+        buffer = self.buffers.get(sensor_id)
+        recent = buffer.readings() if buffer is not None else []
+        stored = sorted(rows, key=lambda row: row["timestamp"])
+        if recent:
+            oldest = recent[0]["timestamp"].replace(microsecond=0)
+            stored = [row for row in stored if row["timestamp"] < oldest]
+
+        merged = RecentReadings(self.size)
+        for row in stored + recent:
+            merged.append(row["value"], row["timestamp"], row.get("seq"))
+        self.buffers[sensor_id] = merged
+        self.seeded.add(sensor_id)
+
+    def get(self, sensor_id: int) -> list[dict]:
+        buffer = self.buffers.get(sensor_id)
+        return buffer.readings() if buffer is not None else []
+
+    def remove_sensor(self, sensor_id: int):
+        self.buffers.pop(sensor_id, None)
+        self.seeded.discard(sensor_id)
+
+
+recent_readings = RecentHistory()
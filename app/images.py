@@ -0,0 +1,146 @@
+import io
+import os
+import re
+import asyncio
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+IMAGE_DIR = os.getenv("IMAGE_DIR", "images")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# Square bounding boxes (in pixels) thumbnails are generated for
+THUMBNAIL_SIZES = (120, 240, 480)
+THUMBNAIL_QUALITY = 80
+
+IMAGE_FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+IMAGE_NAME_PATTERN = re.compile(r"^([0-9a-f]{64})\.(jpg|png|webp|gif)$")
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Content addressed files never change, so clients may cache them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+class InvalidImageError(ValueError):
+    """Raised when uploaded bytes are not a supported image"""
+    pass
+
+
+def image_path(digest: str, extension: str) -> str:
+    return os.path.join(IMAGE_DIR, digest[:2], f"{digest}.{extension}")
+
+
+def thumbnail_path(digest: str, size: int) -> str:
+    return os.path.join(IMAGE_DIR, digest[:2], f"{digest}_{size}.webp")
+
+
+def image_url(digest: str, extension: str) -> str:
+    return f"/images/{digest}.{extension}"
+
+
+def thumbnail_url(digest: str, size: int) -> str:
+    return f"/images/{digest}/{size}.webp"
+
+
+def _write_atomic(path: str, data: bytes):
+    """Write a file so concurrent readers never see it partially written."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+
+def _process_image(data: bytes) -> tuple[str, str]:
+    """
+    Hash, validate and store an image with its thumbnails.
+
+    Runs in a worker process, so hashing, decoding and encoding never
+    block the event loop. Files that already exist are not rewritten.
+
+    Returns:
+        tuple[str, str]: SHA-256 digest and file extension of the original
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    digest = hashlib.sha256(data).hexdigest()
+
+    # Duplicate uploads skip decoding entirely
+    if all(os.path.exists(thumbnail_path(digest, size)) for size in THUMBNAIL_SIZES):
+        for extension in IMAGE_FORMATS.values():
+            if os.path.exists(image_path(digest, extension)):
+                return digest, extension
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        extension = IMAGE_FORMATS.get(image.format)
+        if extension is None:
+            raise InvalidImageError(f"Unsupported image format: {image.format}")
+        image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        # Images with far more pixels than Image.MAX_IMAGE_PIXELS are refused before decoding
+        raise InvalidImageError(f"Invalid image: {e}")
+
+    original_path = image_path(digest, extension)
+    if not os.path.exists(original_path):
+        _write_atomic(original_path, data)
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    for size in THUMBNAIL_SIZES:
+        path = thumbnail_path(digest, size)
+        if os.path.exists(path):
+            continue
+
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size))
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, "WEBP", quality=THUMBNAIL_QUALITY, method=4)
+        _write_atomic(path, buffer.getvalue())
+
+    return digest, extension
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+async def store_image(data: bytes) -> dict:
+    """
+    Store an uploaded image content-addressed and generate its thumbnails.
+
+    Args:
+        data:   Raw bytes of the uploaded image
+
+    Returns:
+        dict: URLs of the original image and of each thumbnail size
+
+    Raises:
+        InvalidImageError: if the bytes are not a supported image
+    """
+    if len(data) > MAX_IMAGE_BYTES:
+        raise InvalidImageError("Image too large")
+
+    loop = asyncio.get_running_loop()
+    digest, extension = await loop.run_in_executor(get_executor(), _process_image, data)
+
+    return {
+        "image_address": image_url(digest, extension),
+        "thumbnails": {str(size): thumbnail_url(digest, size) for size in THUMBNAIL_SIZES},
+    }
@@ -0,0 +1,266 @@
+import os
+import time
+import asyncio
+import logging
+
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+import metrics
+import cluster
+
+from alerts import alert_engine
+from live import hub, reading_message
+from database import add_alerts_batch, add_data_batch
+from registry import sensor_registry
+from history import recent_readings
+
+logger = logging.getLogger(__name__)
+
+# Readings whose device timestamp is older than this are rejected as too late
+INGEST_WINDOW_SECONDS = float(os.getenv("INGEST_WINDOW_SECONDS", "300"))
+# How far ahead of our clock a device timestamp may be before it is rejected
+MAX_CLOCK_SKEW_SECONDS = float(os.getenv("MAX_CLOCK_SKEW_SECONDS", "60"))
+
+# Queued readings are written in batches of up to INGEST_BATCH_SIZE, at least every INGEST_FLUSH_MS
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "1000"))
+INGEST_FLUSH_MS = float(os.getenv("INGEST_FLUSH_MS", "100"))
+# Readings queued beyond this are refused until the writer catches up
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "100000"))
+# Batches that fail to write are retried this many times in all, waiting INGEST_RETRY_SECONDS, doubling each time
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "5"))
+INGEST_RETRY_SECONDS = float(os.getenv("INGEST_RETRY_SECONDS", "1"))
+# A worker with this many readings queued reports itself not ready, so load balancers send ingest elsewhere
+INGEST_HIGH_WATER = int(os.getenv("INGEST_HIGH_WATER", str(INGEST_MAX_PENDING * 8 // 10)))
+
+# Bound on sequence numbers remembered for deduplication
+MAX_TRACKED_SEQUENCES = 1_000_000
+
+metrics.register_counter("ingest_readings_total", "Sensor readings received by outcome")
+
+
+class Reading(NamedTuple):
+    sensor_id: int
+    value: float
+    timestamp: datetime
+    seq: Optional[int]
+
+
+class IngestFullError(Exception):
+    """Raised when the ingest queue is at capacity"""
+    pass
+
+
+class IngestQueue:
+    """
+    Validates, deduplicates and buffers readings, writing them to the
+    database in batches.
+
+    Every reading is stored with the time it was taken: the device
+    timestamp if one was sent, otherwise the time it reached us. Queueing
+    therefore never shifts readings in time, and late or out-of-order
+    arrivals land in the right place in the series. Retries are dropped by
+    remembering each (sensor, seq) seen within the ingest window; the data
+    table's unique key catches any that get past a restart, which also
+    makes it safe to retry a batch that failed to write; failed batches
+    are kept and retried with backoff, up to INGEST_MAX_ATTEMPTS. Readings are
+    matched to sensors through the sensor registry, and those from
+    unregistered devices are counted there rather than stored. Accepted
+    readings also go to the in-memory recent history as they arrive.
+
+    In a multi-worker server each worker sends the readings it accepts to
+    the others, which remember their seqs and update their alert
+    statistics, recent history and live subscribers with them but leave
+    writing them to this worker.
+    """
+
+    def __init__(self, batch_size: int, flush_seconds: float, max_pending: int):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.pending: list[Reading] = []
+        # [batch, attempts so far, monotonic time of the next attempt] of batches that failed to write
+        self.retrying: deque[list] = deque()
+        self.retrying_readings = 0
+        # (sensor_id, seq, device timestamp) -> monotonic time first seen, oldest first
+        self.seen: OrderedDict[tuple, float] = OrderedDict()
+        self._ready: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.pending) + self.retrying_readings
+
+    def _is_duplicate(self, sensor_id: int, seq: Optional[int], timestamp: Optional[datetime]) -> bool:
+        if seq is None:
+            return False
+
+        now = time.monotonic()
+        while self.seen:
+            key, first_seen = next(iter(self.seen.items()))
+            if now - first_seen < INGEST_WINDOW_SECONDS and len(self.seen) < MAX_TRACKED_SEQUENCES:
+                break
+            self.seen.popitem(last=False)
+
+        key = (sensor_id, seq, timestamp)
+        if key in self.seen:
+            return True
+        self.seen[key] = now
+        return False
+
+    def submit(self, readings: list[tuple[float, str, str, Optional[datetime], Optional[int]]]) -> dict:
+        """
+        Queue (value, type, address, device timestamp, seq) readings for writing.
+
+        Device timestamps must be naive local times, like the data table.
+
+        Returns:
+            dict: How many readings were accepted, dropped as duplicates,
+                  rejected for being outside the ingest window, or came
+                  from an unregistered device
+
+        Raises:
+            IngestFullError: if the queue cannot take the readings
+        """
+        if len(self) + len(readings) > self.max_pending:
+            metrics.increment("ingest_readings_total", 'outcome="refused"', len(readings))
+            raise IngestFullError(f"{len(self)} readings already queued")
+
+        now = datetime.now()
+        earliest = now - timedelta(seconds=INGEST_WINDOW_SECONDS)
+        latest = now + timedelta(seconds=MAX_CLOCK_SKEW_SECONDS)
+        counts = {"accepted": 0, "duplicate": 0, "late": 0, "future": 0, "unknown": 0}
+        replicated = [] if cluster.is_attached() else None
+
+        for value, type, address, timestamp, seq in readings:
+            sensor_id = sensor_registry.resolve(address, type)
+            if sensor_id is None:
+                sensor_registry.note_unknown(address, type)
+                counts["unknown"] += 1
+                continue
+
+            if timestamp is not None:
+                if timestamp < earliest:
+                    counts["late"] += 1
+                    continue
+                if timestamp > latest:
+                    counts["future"] += 1
+                    continue
+
+            if self._is_duplicate(sensor_id, seq, timestamp):
+                counts["duplicate"] += 1
+                continue
+
+            reading = Reading(sensor_id, value, timestamp or now, seq)
+            event_id = hub.next_event_id()
+            self.pending.append(reading)
+            self._observe(reading, True, event_id)
+            if replicated is not None:
+                replicated.append((sensor_id, value, reading.timestamp.isoformat(), seq, event_id, timestamp is not None))
+            counts["accepted"] += 1
+
+        if replicated:
+            cluster.send("readings", readings=replicated)
+
+        for outcome, count in counts.items():
+            if count:
+                metrics.increment("ingest_readings_total", f'outcome="{outcome}"', count)
+
+        if self._ready is not None and len(self.pending) >= self.batch_size:
+            self._ready.set()
+        return counts
+
+    def _observe(self, reading: Reading, record: bool, event_id: int):
+        alert_engine.observe(reading.sensor_id, reading.value, reading.timestamp, record, event_id)
+        recent_readings.record(reading.sensor_id, reading.value, reading.timestamp, reading.seq)
+        if hub.is_watched(reading.sensor_id):
+            message = reading_message(reading.sensor_id, reading.value, reading.timestamp, reading.seq)
+            hub.publish(reading.sensor_id, message, event_id)
+
+    def replicate(self, readings: list[list]):
+        """
+        Observe readings another worker accepted and is writing, given as
+        (sensor_id, value, ISO timestamp, seq, event ID, whether the device
+        sent the timestamp). Their seqs are remembered too, so a retry
+        that reaches this worker is dropped as a duplicate.
+        """
+        for sensor_id, value, timestamp, seq, event_id, device_timed in readings:
+            timestamp = datetime.fromisoformat(timestamp)
+            # Both workers took the same retry at once; this one has observed it already
+            if self._is_duplicate(sensor_id, seq, timestamp if device_timed else None):
+                continue
+            self._observe(Reading(sensor_id, value, timestamp, seq), False, event_id)
+
+    async def flush(self, retry_all: bool = False):
+        """
+        Write everything queued so far, and any alerts it raised, along
+        with failed batches due for another attempt, or all of them if
+        retry_all is set.
+
+        Writes run in worker threads and try to connect only once, so an
+        outage costs neither the event loop nor the retry schedule.
+        """
+        alerts = alert_engine.drain()
+        if alerts:
+            try:
+                await add_alerts_batch(alerts)
+            except Exception as e:
+                logger.error(f"Failed to write {len(alerts)} alerts: {e}")
+
+        now = time.monotonic()
+        retries = [retry for retry in self.retrying if retry_all or retry[2] <= now]
+        self.retrying = deque(retry for retry in self.retrying if not (retry_all or retry[2] <= now))
+        self.retrying_readings -= sum(len(batch) for batch, _, _ in retries)
+
+        queued, self.pending = self.pending, []
+        retries += [[queued[start:start + self.batch_size], 0, now] for start in range(0, len(queued), self.batch_size)]
+        for batch, attempts, _ in retries:
+            try:
+                written = await add_data_batch(batch)
+            except Exception as e:
+                attempts += 1
+                if attempts >= INGEST_MAX_ATTEMPTS:
+                    metrics.increment("ingest_readings_total", 'outcome="failed"', len(batch))
+                    logger.error(f"Failed to write {len(batch)} readings after {attempts} attempts, dropping them: {e}")
+                    continue
+                delay = INGEST_RETRY_SECONDS * 2 ** (attempts - 1)
+                logger.warning(f"Failed to write {len(batch)} readings, retrying in {delay:g}s: {e}")
+                self.retrying.append([batch, attempts, time.monotonic() + delay])
+                self.retrying_readings += len(batch)
+                continue
+
+            metrics.increment("ingest_readings_total", 'outcome="written"', written)
+            if written < len(batch):
+                # Retries the window no longer remembered, caught by the unique key
+                metrics.increment("ingest_readings_total", 'outcome="duplicate"', len(batch) - written)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()
+            await self.flush()
+
+    def start(self):
+        if self._writer is None:
+            self._ready = asyncio.Event()
+            self._writer = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer, writing whatever is still queued."""
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        await self.flush(retry_all=True)
+        if self.retrying_readings:
+            logger.error(f"Stopping with {self.retrying_readings} readings that could not be written")
+
+
+ingest_queue = IngestQueue(INGEST_BATCH_SIZE, INGEST_FLUSH_MS / 1000, INGEST_MAX_PENDING)
+cluster.on("readings")(ingest_queue.replicate)
@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import asyncio
+
+from collections import deque
+from datetime import datetime
+from typing import Iterable, Optional
+
+import cluster
+
+# Messages buffered per subscriber before the oldest are dropped
+MAX_QUEUED_MESSAGES = 256
+
+# Version of the /ws message protocol, sent as "v" in every message
+PROTOCOL_VERSION = 1
+# Updates arriving within this long of each other are sent as one message
+BATCH_SECONDS = float(os.getenv("WS_BATCH_MS", "250")) / 1000
+# A ping is sent after this long without sending anything else
+HEARTBEAT_SECONDS = float(os.getenv("WS_HEARTBEAT_SECONDS", "30"))
+# Sockets the client has sent nothing on, not even a pong, for this long are closed
+IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "90"))
+
+# Messages kept per watched sensor for clients resuming a stream with Last-Event-ID
+REPLAY_MESSAGES = int(os.getenv("LIVE_REPLAY_MESSAGES", "200"))
+# How long Server-Sent Events clients wait before reconnecting
+SSE_RETRY_MS = 3000
+# Event IDs taken per reading: its own, then those of alerts it raises
+EVENT_ID_STEP = 16
+
+
+class LiveHub:
+    """
+    Fans live messages out to subscribers by sensor ID.
+
+    Publishing never blocks: a subscriber that falls behind loses its
+    oldest messages rather than slowing ingest down.
+
+    Every message published for a sensor anyone has subscribed to since
+    startup is given an event ID and kept in a short per-sensor replay
+    buffer, so a client that reconnects can pick up where it left off
+    without a query.
+
+    Event IDs are taken from the wall clock in microseconds by the worker
+    that accepted the reading, and travel with it to the other workers
+    (see ingest.py), so a client may resume on any worker. Alerts a
+    reading raises take the IDs following the reading's. A sensor
+    subscribed to on one worker is buffered on all of them.
+    """
+
+    def __init__(self):
+        self._subscribers: dict[int, set[asyncio.Queue]] = {}
+        self._subscriptions: dict[asyncio.Queue, set[int]] = {}
+        self._replay: dict[int, deque] = {}
+        self._last_event_id = 0
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def subscribe(self, sensor_ids: Iterable[int], queue: asyncio.Queue = None) -> asyncio.Queue:
+        """Subscribe a queue, new if None, to messages for these sensors."""
+        if queue is None:
+            queue = asyncio.Queue(MAX_QUEUED_MESSAGES)
+        subscribed = self._subscriptions.setdefault(queue, set())
+        for sensor_id in sensor_ids:
+            subscribed.add(sensor_id)
+            self._subscribers.setdefault(sensor_id, set()).add(queue)
+            if sensor_id not in self._replay:
+                cluster.publish("sensor_watched", sensor_id=sensor_id)
+        return queue
+
+    def watch(self, sensor_id: int):
+        """Start buffering a sensor's messages for clients resuming a stream."""
+        if sensor_id not in self._replay:
+            self._replay[sensor_id] = deque(maxlen=REPLAY_MESSAGES)
+
+    def unsubscribe(self, queue: asyncio.Queue, sensor_ids: Iterable[int] = None):
+        """Unsubscribe a queue from these sensors, or from everything if None."""
+        subscribed = self._subscriptions.get(queue)
+        if subscribed is None:
+            return
+
+        for sensor_id in list(subscribed if sensor_ids is None else sensor_ids):
+            subscribed.discard(sensor_id)
+            queues = self._subscribers.get(sensor_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[sensor_id]
+
+        if sensor_ids is None:
+            del self._subscriptions[queue]
+
+    def is_watched(self, sensor_id: int) -> bool:
+        """Whether messages for this sensor are wanted, by subscribers now or on reconnecting."""
+        return sensor_id in self._replay
+
+    def next_event_id(self) -> int:
+        """An event ID for a reading, above every ID this hub has used or seen."""
+        self._last_event_id = max(time.time_ns() // 1000, self._last_event_id + EVENT_ID_STEP)
+        return self._last_event_id
+
+    def replay(self, sensor_ids: Iterable[int], after: int) -> list[dict]:
+        """Buffered messages for these sensors with event IDs after this one, oldest first."""
+        missed = []
+        for sensor_id in sensor_ids:
+            missed.extend(message for message in self._replay.get(sensor_id, ()) if message["id"] > after)
+        missed.sort(key=lambda message: message["id"])
+        return missed
+
+    def subscriptions(self, queue: asyncio.Queue) -> set[int]:
+        return self._subscriptions.get(queue, set())
+
+    def remove_sensor(self, sensor_id: int):
+        """Tell a deleted sensor's subscribers it is gone and unsubscribe them."""
+        self.publish(sensor_id, removed_message(sensor_id))
+        for queue in list(self._subscribers.get(sensor_id, ())):
+            self.unsubscribe(queue, (sensor_id,))
+        self._replay.pop(sensor_id, None)
+
+    def publish(self, sensor_id: int, message: dict, event_id: Optional[int] = None):
+        """Send a message to a sensor's subscribers, with this event ID or a new one."""
+        if event_id is None:
+            event_id = self.next_event_id()
+        else:
+            self._last_event_id = max(self._last_event_id, event_id)
+
+        replay = self._replay.get(sensor_id)
+        if replay is None:
+            # Nobody has ever subscribed, so nobody can be waiting for it
+            return
+        message["id"] = event_id
+        replay.append(message)
+
+        for queue in self._subscribers.get(sensor_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+
+hub = LiveHub()
+cluster.on("sensor_watched")(hub.watch)
+
+
+def reading_message(sensor_id: int, value: float, timestamp: datetime, seq: Optional[int] = None) -> dict:
+    return {
+        "type": "reading",
+        "sensor_id": sensor_id,
+        "reading": {"value": value, "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"), "seq": seq},
+    }
+
+
+def alert_message(alert: dict) -> dict:
+    return {"type": "alert", "sensor_id": alert["sensor_id"], "alert": alert}
+
+
+def removed_message(sensor_id: int) -> dict:
+    return {"type": "removed", "sensor_id": sensor_id}
+
+
+def sse_event(message: dict) -> str:
+    """Encode a hub message as a Server-Sent Event named after its type."""
+    if message["type"] == "reading":
+        data = {"sensor_id": message["sensor_id"], **message["reading"]}
+    elif message["type"] == "alert":
+        data = message["alert"]
+    else:
+        data = {"sensor_id": message["sensor_id"]}
+    return f"id: {message['id']}\nevent: {message['type']}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def _position(reading: dict) -> tuple[str, int]:
+    """
+    Where a reading falls in its sensor's order. Timestamps only go to the
+    second, so a device's seq orders readings within one; readings without
+    a seq cannot be told apart within a second.
+    """
+    seq = reading.get("seq")
+    return reading["timestamp"], -1 if seq is None else seq
+
+
+class Deltas:
+    """
+    Turns hub messages into /ws protocol messages for one socket, sending
+    each sensor's readings only when they are newer than the last one sent.
+    """
+
+    def __init__(self):
+        # sensor ID -> position of the last reading sent, see _position
+        self.sent: dict[int, tuple[str, int]] = {}
+
+    def mark_sent(self, sensor_id: int, timestamp: str, seq: Optional[int] = None):
+        """Record that the client already has a sensor's readings up to this one."""
+        self.sent[sensor_id] = _position({"timestamp": timestamp, "seq": seq})
+
+    def forget(self, sensor_ids: Iterable[int]):
+        for sensor_id in sensor_ids:
+            self.sent.pop(sensor_id, None)
+
+    def encode(self, messages: list[dict]) -> list[dict]:
+        """
+        Coalesce a batch of hub messages into at most one readings message,
+        holding each sensor's new readings oldest first, one alerts message
+        and one removed message listing sensors deleted since the last batch.
+        """
+        by_sensor: dict[int, list[dict]] = {}
+        alerts = []
+        removed = []
+        for message in messages:
+            if message["type"] == "alert":
+                alerts.append(message["alert"])
+            elif message["type"] == "removed":
+                removed.append(message["sensor_id"])
+            else:
+                by_sensor.setdefault(message["sensor_id"], []).append(message["reading"])
+
+        for sensor_id in removed:
+            by_sensor.pop(sensor_id, None)
+        self.forget(removed)
+
+        readings = {}
+        for sensor_id, batch in by_sensor.items():
+            # Timestamps are fixed width, so they compare correctly as strings
+            last = self.sent.get(sensor_id, ("", -1))
+            new = []
+            for reading in sorted(batch, key=_position):
+                if _position(reading) > last:
+                    new.append(reading)
+                    last = _position(reading)
+            if new:
+                self.sent[sensor_id] = last
+                readings[str(sensor_id)] = new
+
+        encoded = []
+        if readings:
+            encoded.append({"v": PROTOCOL_VERSION, "type": "readings", "readings": readings})
+        if alerts:
+            encoded.append({"v": PROTOCOL_VERSION, "type": "alerts", "alerts": alerts})
+        if removed:
+            encoded.append({"v": PROTOCOL_VERSION, "type": "removed", "sensors": removed})
+        return encoded
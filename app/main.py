@@ -1,22 +1,45 @@
-from fastapi import FastAPI, Request, HTTPException, WebSocket
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response
+from fastapi import FastAPI, Request, HTTPException, WebSocket, Query, UploadFile
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from starlette.websockets import WebSocketState
+from starlette.websockets import WebSocketDisconnect, WebSocketState
 from typing import Optional
-from pydantic import BaseModel
+from datetime import datetime
+from pydantic import BaseModel, Field
 from contextlib import asynccontextmanager
 import uvicorn
 import asyncio
 import uuid
+import math
 import os
-import requests
+import threading
 import json
-from geopy.geocoders import Nominatim
 from dotenv import load_dotenv
 
-from decorators import auth_required
+from decorators import auth_required, admin_required, get_session_user_id
+from search import clothes_index
+import images
+import passwords
+import weather
+import cluster
+import ingest
+import database
+import bulk
+import export
+import metrics
+import querylog
+from ingest import ingest_queue, IngestFullError
+from alerts import RULE_KINDS, alert_engine
+import live
+from live import hub
+from registry import sensor_registry
+from history import recent_readings
+from ratelimit import ingest_limiter, RateLimitedError
+from devicekeys import KEY_PREFIX, DeviceKey, device_keys, generate_key, hash_key, display_prefix
 from database import (
     setup_database,
+    wait_for_database,
+    SensorExistsError,
+    ping_database,
 
     get_user_by_id,
     get_user_by_username,
@@ -30,6 +53,7 @@ from database import (
     delete_session_by_user_id,
 
     get_sensor_by_id,
+    get_all_sensors,
     get_sensors_by_user_id,
     add_sensor,
     update_sensor,
@@ -38,16 +62,28 @@ from database import (
     get_clothes_by_id,
     get_clothes_by_user_id,
     add_clothes,
+    add_clothes_batch,
     update_clothes,
     delete_clothes,
 
     get_data_by_sensor_id,
-    add_data,
-    get_recent_data
+    iter_data_by_sensor_id,
+
+    get_alert_rules,
+    get_alert_rules_by_sensor_id,
+    get_alert_rule_by_id,
+    add_alert_rule,
+    delete_alert_rule,
+    get_alerts_by_user_id,
+
+    add_device_key,
+    get_device_key_by_hash,
+    get_device_key_by_id,
+    get_device_keys_by_user_id,
+    revoke_device_key
 )
 
 load_dotenv()
-API_KEY = os.getenv('API_KEY')
 
 INIT_USERS = [
     ("nathan", "password", "email", "San Diego"),
@@ -62,29 +98,106 @@ INIT_CLOTHES = [
     (2, "Black Shirt 2", "shirt", "./static/shirt.png"),
 ]
 
+# /readyz fails when the database takes longer than this to answer, or the loop lags more than this
+READY_DB_TIMEOUT_SECONDS = float(os.getenv("READY_DB_TIMEOUT_SECONDS", "2"))
+READY_MAX_LOOP_LAG_MS = float(os.getenv("READY_MAX_LOOP_LAG_MS", "500"))
+
+# Live connections open on this worker, by kind
+open_streams = {"websocket": 0, "sse": 0}
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+IMPORT_BATCH_SIZE = 500
+MAX_IMPORT_ERRORS = 100
+EXPORT_CLOTHES_FIELDS = ("id", "name", "type", "image_address")
+
+async def initialize_database():
+    """Create the tables and add the initial users, sensors and clothes."""
+    await setup_database(INIT_USERS)  # Make sure setup_database is async
+    for user_id, type, units, address in INIT_SENSORS:
+        await add_sensor(user_id, type, units, address)
+    print("Added sensors successfully")
+    
+    for user_id, name, type, image_address in INIT_CLOTHES:
+        await add_clothes(user_id, name, type, image_address)
+    print("Added clothes successfully")
+
+    print("Database setup completed")
+
+async def start_up():
+    """
+    Wait for the database, then load what the app holds in memory and
+    start writing ingested readings. Until this is done /readyz fails and
+    ingest is refused.
+    """
+    # Connecting retries for up to a minute; in a thread the loop keeps answering /healthz meanwhile
+    await asyncio.to_thread(wait_for_database)
+    if not cluster.is_attached():
+        await initialize_database()
+    sensor_registry.load(await get_all_sensors())
+    alert_engine.load(await get_alert_rules())
+    database.start_replica_monitor()
+    ingest_queue.start()
+    await cluster.start()
+
+def startup_state() -> tuple[bool, Optional[str]]:
+    """Whether start_up has finished, and why it failed if it did."""
+    task = getattr(app.state, "startup", None)
+    if task is None or not task.done():
+        return False, None
+    if task.cancelled():
+        return True, "cancelled"
+    error = task.exception()
+    return True, f"{type(error).__name__}: {error}" if error else None
+
+def is_ready() -> bool:
+    done, error = startup_state()
+    return done and error is None
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     Lifespan context manager for managing application startup and shutdown.
     Handles database setup and cleanup in a more structured way.
+
+    The server starts answering straight away while start_up runs in the
+    background, so orchestrators can probe /healthz and /readyz during a
+    slow start; every other request gets a 503 until it is done, see
+    startup_gate. Workers of the multi-worker server (see server.py) skip
+    database setup, which the supervisor has done once before forking them.
     """
     # Startup: Setup resources
+    startup = None
     try:
-        await setup_database(INIT_USERS)  # Make sure setup_database is async
-        for user_id, type, units, address in INIT_SENSORS:
-            await add_sensor(user_id, type, units, address)
-        print("Added sensors successfully")
-        
-        for user_id, name, type, image_address in INIT_CLOTHES:
-            await add_clothes(user_id, name, type, image_address)
-        print("Added clothes successfully")
-
-        print("Database setup completed")
+        metrics.start_profiler()
+        metrics.loop_monitor.start()
+        startup = app.state.startup = asyncio.create_task(start_up())
         yield
     finally:
+        if startup is not None:
+            startup.cancel()
+        await cluster.stop()
+        await ingest_queue.stop()
+        metrics.loop_monitor.stop()
+        metrics.stop_profiler()
+        database.stop_replica_monitor()
+        images.shutdown()
+        passwords.shutdown()
         print("Shutdown completed")
 
 app = FastAPI(lifespan=lifespan)
+app.middleware("http")(metrics.metrics_middleware)
+
+# Answered while starting up; everything else waits for the tables and caches
+STARTUP_PATHS = ("/healthz", "/readyz")
+
+@app.middleware("http")
+async def startup_gate(request: Request, call_next):
+    """Refuse requests until start_up is done, rather than serve them from half created tables and empty caches."""
+    if not is_ready() and request.url.path not in STARTUP_PATHS:
+        return Response(content="Starting up", status_code=503, headers={"Retry-After": "5"})
+    return await call_next(request)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -94,38 +207,252 @@ def serve_content(file: str, username: str):
         return html.read().replace("{username}", username)
 
 
-''' API Routes '''
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    # accept the websocket connection
-    await websocket.accept()
+async def get_recent_readings(sensor_id: int) -> list[dict]:
+    """A sensor's last readings from the in-memory history, seeded from the database the first time."""
+    if not recent_readings.is_seeded(sensor_id):
+        recent_readings.seed(sensor_id, await get_data_by_sensor_id(sensor_id, limit=recent_readings.size))
+    return recent_readings.get(sensor_id)
+
 
-    subscribed_sensors = []
+def parse_fields(fields: Optional[str]) -> Optional[list[str]]:
+    """Split a comma separated `fields` query parameter into column names."""
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
 
-    async def get_all_recent_data():
-        nonlocal subscribed_sensors
-        data = {}
-        for sensor_id in subscribed_sensors:
-            data[sensor_id] = await get_recent_data(sensor_id)
-            if data[sensor_id]:
-                data[sensor_id]['timestamp'] = data[sensor_id]['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
 
-        return data
+async def paginate(accessor, user_id: int, limit: int, after: Optional[int], type: Optional[str], fields: Optional[str]) -> dict:
+    """
+    Fetch one keyset page from a per-user accessor.
 
+    One extra row is requested to tell whether another page exists, in
+    which case `next` holds the cursor to pass as `after`.
+    """
     try:
-        subscribed_sensors = await websocket.receive_json()
+        rows = await accessor(user_id, limit=limit + 1, after=after, type=type, fields=parse_fields(fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["id"]
+
+    return {"items": rows, "next": next_cursor}
+
+
+''' API Routes '''
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """
+    Live readings and alerts for the signed in user's sensors.
+
+    Every message is a JSON object carrying the protocol version "v" and
+    a "type". The client sends subscribe or unsubscribe with a list of
+    "sensors", ping, and pong in answer to the server's pings. The server
+    answers with subscribed (current subscriptions, plus any sensors
+    refused as "denied"), readings (sensor ID -> readings newer than any
+    already sent, oldest first), alerts, removed (subscribed sensors that
+    were since deleted), ping, pong and error.
+
+    Newly subscribed sensors start with a snapshot of their recent
+    history. A subscribe may carry "after", sensor ID -> the last reading
+    the client already has as {"timestamp", "seq"} or just its timestamp
+    (from /api/dashboard, say), so the snapshot holds only what it is
+    missing.
+
+    The session is resolved once, at the handshake. Ownership is checked
+    against the sensor registry, which the sensor accessors keep current,
+    so authorizing a subscription costs no query and updates cost no
+    check at all.
+
+    Updates are pushed as they are ingested and batched for
+    live.BATCH_SECONDS. An idle socket only sees a ping every
+    live.HEARTBEAT_SECONDS, and is closed if the client goes quiet for
+    live.IDLE_TIMEOUT_SECONDS.
+    """
+    if not is_ready():
+        # Try again later
+        await websocket.close(code=1013)
+        return
+
+    user_id = await get_session_user_id(websocket.cookies.get("sessionId"))
+    if user_id is None:
+        await websocket.close(code=4401)
+        return
+
+    await websocket.accept()
+    open_streams["websocket"] += 1
+
+    loop = asyncio.get_running_loop()
+    queue = hub.subscribe(())
+    deltas = live.Deltas()
+    send_lock = asyncio.Lock()
+    last_heard = last_sent = loop.time()
+
+    async def send(message: dict):
+        nonlocal last_sent
+        async with send_lock:
+            await websocket.send_json(message)
+        last_sent = loop.time()
+
+    async def subscribe(sensor_ids: list[int], after: dict):
+        owned, denied = [], []
+        for sensor_id in sensor_ids:
+            (owned if sensor_registry.owns(user_id, sensor_id) else denied).append(sensor_id)
+
+        new = [sensor_id for sensor_id in owned if sensor_id not in hub.subscriptions(queue)]
+        hub.subscribe(owned, queue)
+        for sensor_id in new:
+            # The client already has readings up to this one, from /api/dashboard say
+            last = after.get(str(sensor_id))
+            if isinstance(last, str):
+                deltas.mark_sent(sensor_id, last)
+            elif isinstance(last, dict) and isinstance(last.get("timestamp"), str):
+                seq = last.get("seq")
+                deltas.mark_sent(sensor_id, last["timestamp"], seq if isinstance(seq, int) else None)
+        await send({"v": live.PROTOCOL_VERSION, "type": "subscribed", "sensors": sorted(hub.subscriptions(queue)), "denied": denied})
+
+        # Start new subscribers off with each sensor's recent history, enough to fill a chart
+        snapshot = []
+        for sensor_id in new:
+            for reading in await get_recent_readings(sensor_id):
+                snapshot.append(live.reading_message(sensor_id, reading["value"], reading["timestamp"], reading["seq"]))
+        for message in deltas.encode(snapshot):
+            await send(message)
+
+    async def receive_commands():
+        nonlocal last_heard
         while True:
-            if subscribed_sensors:
-                data = await get_all_recent_data()
-                if data:
-                    await websocket.send_json(data)
-                await asyncio.sleep(3)
-    except Exception as e:
-        print(e)
+            message = await websocket.receive_json()
+            last_heard = loop.time()
+
+            if not isinstance(message, dict) or message.get("v") != live.PROTOCOL_VERSION:
+                await send({"v": live.PROTOCOL_VERSION, "type": "error", "detail": f"Expected protocol version {live.PROTOCOL_VERSION}"})
+                continue
+
+            type = message.get("type")
+            if type in ("subscribe", "unsubscribe"):
+                try:
+                    sensor_ids = [int(sensor_id) for sensor_id in message.get("sensors", [])]
+                except (TypeError, ValueError):
+                    await send({"v": live.PROTOCOL_VERSION, "type": "error", "detail": "sensors must be a list of IDs"})
+                    continue
+
+                if type == "subscribe":
+                    after = message.get("after")
+                    await subscribe(sensor_ids, after if isinstance(after, dict) else {})
+                else:
+                    hub.unsubscribe(queue, sensor_ids)
+                    deltas.forget(sensor_ids)
+                    await send({"v": live.PROTOCOL_VERSION, "type": "subscribed", "sensors": sorted(hub.subscriptions(queue)), "denied": []})
+            elif type == "ping":
+                await send({"v": live.PROTOCOL_VERSION, "type": "pong"})
+            elif type != "pong":
+                await send({"v": live.PROTOCOL_VERSION, "type": "error", "detail": f"Unknown message type {type!r}"})
+
+    async def send_updates():
+        while True:
+            try:
+                first = await asyncio.wait_for(queue.get(), live.HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if loop.time() - last_heard > live.IDLE_TIMEOUT_SECONDS:
+                    return
+                if loop.time() - last_sent >= live.HEARTBEAT_SECONDS:
+                    await send({"v": live.PROTOCOL_VERSION, "type": "ping"})
+                continue
+
+            # Gather whatever else arrives shortly after into the same message
+            await asyncio.sleep(live.BATCH_SECONDS)
+            batch = [first]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            for message in deltas.encode(batch):
+                await send(message)
+
+    tasks = [asyncio.create_task(receive_commands()), asyncio.create_task(send_updates())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and task.exception() and not isinstance(task.exception(), WebSocketDisconnect):
+                print(task.exception())
     finally:
-        if websocket.client_state == WebSocketState.CONNECTED:
-            await websocket.close()
-    return
+        for task in tasks:
+            task.cancel()
+        hub.unsubscribe(queue)
+        open_streams["websocket"] -= 1
+        if websocket.client_state == WebSocketState.CONNECTED and websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                await websocket.close()
+            except RuntimeError:
+                # The client closed the socket first
+                pass
+
+
+@app.get("/api/sensors/stream")
+@auth_required
+async def stream_sensors(request: Request, ids: str = Query(..., description="Comma separated sensor IDs")):
+    """
+    Live readings and alerts for the given sensors as Server-Sent Events,
+    for read-only clients that do not need /ws.
+
+    Events are named reading, alert or removed (the sensor was deleted),
+    with the reading, the alert or the sensor ID as JSON data. A client
+    reconnecting with Last-Event-ID first gets the events it missed that
+    are still in the hub's replay buffer. A comment is sent after
+    live.HEARTBEAT_SECONDS of silence to keep proxies from closing the
+    connection.
+    """
+    try:
+        sensor_ids = sorted({int(sensor_id) for sensor_id in ids.split(",") if sensor_id.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma separated sensor IDs")
+    if not sensor_ids:
+        raise HTTPException(status_code=400, detail="No sensor IDs given")
+
+    for sensor_id in sensor_ids:
+        if sensor_registry.get(sensor_id) is None:
+            raise HTTPException(status_code=404, detail=f"Sensor {sensor_id} not found")
+        if not sensor_registry.owns(request.state.userId, sensor_id):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+    try:
+        last_event_id = int(request.headers.get("last-event-id", ""))
+    except ValueError:
+        last_event_id = None
+
+    # Subscribe before replaying so nothing published in between is lost
+    queue = hub.subscribe(sensor_ids)
+
+    async def events():
+        open_streams["sse"] += 1
+        try:
+            yield f"retry: {live.SSE_RETRY_MS}\n\n"
+            replayed = set()
+            if last_event_id is not None:
+                for message in hub.replay(sensor_ids, last_event_id):
+                    replayed.add(message["id"])
+                    yield live.sse_event(message)
+
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), live.HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                # Already replayed
+                if message["id"] in replayed:
+                    continue
+                yield live.sse_event(message)
+        finally:
+            hub.unsubscribe(queue)
+            open_streams["sse"] -= 1
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/api/sensors/{sensor_id}")
@@ -138,10 +465,57 @@ async def get_sensor(request: Request, sensor_id: str):
     
     return sensor
 
+@app.get("/api/sensors/{sensor_id}/recent")
+@auth_required
+async def get_sensor_recent(request: Request, sensor_id: int):
+    """A sensor's last readings, oldest first, served from memory."""
+    if sensor_registry.get(sensor_id) is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if not sensor_registry.owns(request.state.userId, sensor_id):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    readings = await get_recent_readings(sensor_id)
+    for reading in readings:
+        reading["timestamp"] = reading["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
+    return {"sensor_id": sensor_id, "readings": readings}
+
+@app.get("/api/sensors/{sensor_id}/export")
+@auth_required
+async def export_sensor_data(
+    request: Request,
+    sensor_id: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    format: str = Query("csv", pattern="^(csv|ndjson|parquet)$"),
+):
+    sensor = await get_sensor_by_id(sensor_id)
+    if not sensor:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if request.state.userId != sensor.get("user_id"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    chunks = iter_data_by_sensor_id(sensor_id, start, end, export.EXPORT_CHUNK_ROWS)
+
+    # A plain iterator is consumed in Starlette's threadpool, keeping the
+    # blocking database reads and encoding off the event loop
+    return StreamingResponse(
+        export.ENCODERS[format](chunks),
+        media_type=export.EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="sensor-{sensor_id}.{format}"'},
+    )
+
 @app.get("/api/sensors")
 @auth_required
-async def get_sensors(request: Request):
-    return await get_sensors_by_user_id(request.state.userId)
+async def get_sensors(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+    type: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    return await paginate(get_sensors_by_user_id, request.state.userId, limit, after, type, fields)
 
 class SensorModel(BaseModel):
     type: str
@@ -151,7 +525,13 @@ class SensorModel(BaseModel):
 @app.post("/api/sensors")
 @auth_required
 async def post_sensor(request: Request, data: SensorModel):
-    sensor = await add_sensor(request.state.userId, data.type, data.units, data.address)
+    if sensor_registry.resolve(data.address, data.type) is not None:
+        raise HTTPException(status_code=409, detail="A sensor with this address and type already exists")
+
+    try:
+        sensor = await add_sensor(request.state.userId, data.type, data.units, data.address)
+    except SensorExistsError:
+        raise HTTPException(status_code=409, detail="A sensor with this address and type already exists")
     if sensor:
         return JSONResponse(content=sensor, status_code=201)
     else:
@@ -172,8 +552,16 @@ async def put_sensor(request: Request, sensor_id: str, data: UpdateSensorModel):
 
     if request.state.userId != sensor.get("user_id"):
         raise HTTPException(status_code=401, detail="Unauthorized")
+
+    existing = sensor_registry.resolve(data.address or sensor["address"], data.type or sensor["type"])
+    if existing is not None and existing != sensor["id"]:
+        raise HTTPException(status_code=409, detail="A sensor with this address and type already exists")
     
-    if await update_sensor(sensor_id, data.type, data.units, data.address):
+    try:
+        updated = await update_sensor(sensor_id, data.type, data.units, data.address)
+    except SensorExistsError:
+        raise HTTPException(status_code=409, detail="A sensor with this address and type already exists")
+    if updated:
         return Response(content="Success", status_code=200)
     else:
         return Response(content="Server Error", status_code=400)
@@ -193,6 +581,111 @@ async def delete(request: Request, sensor_id: str):
     else:
         return Response(content="Server Error", status_code=400)
 
+@app.get("/api/sensors/{sensor_id}/alert-rules")
+@auth_required
+async def get_sensor_alert_rules(request: Request, sensor_id: str):
+    sensor = await get_sensor_by_id(sensor_id)
+    if not sensor:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if request.state.userId != sensor.get("user_id"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    return await get_alert_rules_by_sensor_id(sensor_id)
+
+class AlertRuleModel(BaseModel):
+    kind: str = Field(pattern="^(" + "|".join(RULE_KINDS) + ")$")
+    threshold: float
+
+@app.post("/api/sensors/{sensor_id}/alert-rules")
+@auth_required
+async def post_sensor_alert_rule(request: Request, sensor_id: str, data: AlertRuleModel):
+    sensor = await get_sensor_by_id(sensor_id)
+    if not sensor:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if request.state.userId != sensor.get("user_id"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    rule = await add_alert_rule(sensor["id"], sensor["user_id"], data.kind, data.threshold)
+    if rule:
+        return JSONResponse(content=rule, status_code=201)
+    else:
+        return Response(content="Error", status_code=400)
+
+@app.delete("/api/alert-rules/{rule_id}")
+@auth_required
+async def delete_sensor_alert_rule(request: Request, rule_id: int):
+    rule = await get_alert_rule_by_id(rule_id)
+    if not rule:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if request.state.userId != rule.get("user_id"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    if await delete_alert_rule(rule_id):
+        return Response(content="Success", status_code=200)
+    else:
+        return Response(content="Server Error", status_code=400)
+
+@app.get("/api/device-keys")
+@auth_required
+async def get_device_keys(request: Request):
+    keys = await get_device_keys_by_user_id(request.state.userId)
+    for key in keys:
+        key["usage"] = device_keys.usage_of(key["id"])
+    return keys
+
+class DeviceKeyModel(BaseModel):
+    address: str
+    name: str = ""
+
+@app.post("/api/device-keys")
+@auth_required
+async def post_device_key(request: Request, data: DeviceKeyModel):
+    if not sensor_registry.owns_address(request.state.userId, data.address):
+        raise HTTPException(status_code=404, detail="No sensor registered at this address")
+
+    key = generate_key()
+    key_id = await add_device_key(request.state.userId, data.address, data.name, hash_key(key), display_prefix(key))
+    if key_id:
+        # The key itself is only ever returned here
+        return JSONResponse(content={"id": key_id, "key": key}, status_code=201)
+    else:
+        return Response(content="Error", status_code=400)
+
+@app.delete("/api/device-keys/{key_id}")
+@auth_required
+async def delete_device_key(request: Request, key_id: int):
+    key = await get_device_key_by_id(key_id)
+    if not key:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if request.state.userId != key.get("user_id"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    if await revoke_device_key(key_id):
+        return Response(content="Success", status_code=200)
+    else:
+        return Response(content="Already revoked", status_code=400)
+
+@app.get("/api/alerts")
+@auth_required
+async def get_alerts(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[int] = None,
+):
+    rows = await get_alerts_by_user_id(request.state.userId, limit=limit + 1, before=before)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["id"]
+
+    for row in rows:
+        row["timestamp"] = row["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
+    return {"items": rows, "next": next_cursor}
+
 
 @app.get("/api/user/{username}")
 @auth_required
@@ -202,6 +695,7 @@ async def get_user(request: Request, username: str):
     
     user = await get_user_by_username(username)
     if user:
+        user.pop("password", None)
         return user
     else:
         return Response(content="Not Found", status_code=404)
@@ -217,10 +711,39 @@ async def get_user(request: Request):
     if not user:
         raise HTTPException(status_code=404, detail="Not Found")
     
+    user.pop("password", None)
     return user
 
 
 
+@app.get("/api/dashboard")
+@auth_required
+async def get_dashboard(request: Request):
+    """
+    Everything the dashboard needs to render in one round trip: the user,
+    their sensors with each one's recent readings and latest reading, and
+    the weather at the user's location (None if it could not be looked up).
+
+    The weather lookup and the sensor queries run concurrently, each
+    query in its own thread (see db_accessor).
+    """
+    user = dict(request.state.user)
+    user.pop("password", None)
+
+    async def load_sensors() -> list[dict]:
+        sensors = await get_sensors_by_user_id(request.state.userId)
+        histories = await asyncio.gather(*(get_recent_readings(sensor["id"]) for sensor in sensors))
+        for sensor, readings in zip(sensors, histories):
+            for reading in readings:
+                reading["timestamp"] = reading["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
+            sensor["recent"] = readings
+            sensor["latest"] = readings[-1] if readings else None
+        return sensors
+
+    sensors, forecast = await asyncio.gather(load_sensors(), weather.get_weather(user.get("location")))
+    return {"user": user, "sensors": sensors, "weather": forecast}
+
+
 class UpdateUserModel(BaseModel):
     new_username: Optional[str] = None
     new_password: Optional[str] = None
@@ -230,7 +753,14 @@ class UpdateUserModel(BaseModel):
 @app.put("/api/user")
 @auth_required
 async def put_user(request: Request, data: UpdateUserModel):
-    if await update_user_by_id(request.state.userId, data.new_username, data.new_password, data.new_email, data.new_location):
+    new_password = None
+    if data.new_password:
+        try:
+            new_password = await passwords.hash_password(data.new_password)
+        except passwords.PasswordBusyError:
+            raise password_busy()
+
+    if await update_user_by_id(request.state.userId, data.new_username, new_password, data.new_email, data.new_location):
         return Response(content="Success", status_code=200)
     else:
         return Response(content="Not Found", status_code=404)
@@ -244,6 +774,41 @@ async def delete_user(request: Request):
         return Response(content="Not Found", status_code=404)
 
 
+@app.get("/api/clothes/search")
+@auth_required
+async def search_clothes(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+):
+    userId = request.state.userId
+    if not clothes_index.is_loaded(userId):
+        with clothes_index.loading(userId) as pending:
+            clothes_index.load(userId, await get_clothes_by_user_id(userId), pending)
+
+    return {"items": clothes_index.search(userId, q, limit)}
+
+@app.get("/api/clothes/export")
+@auth_required
+async def export_clothes(request: Request, format: str = Query("ndjson", pattern="^(csv|json|ndjson)$")):
+    userId = request.state.userId
+
+    async def iter_clothes():
+        after = None
+        while True:
+            page = await get_clothes_by_user_id(userId, limit=MAX_PAGE_SIZE, after=after)
+            for clothes in page:
+                yield clothes
+            if len(page) < MAX_PAGE_SIZE:
+                return
+            after = page[-1]["id"]
+
+    return StreamingResponse(
+        bulk.encode_records(iter_clothes(), format, EXPORT_CLOTHES_FIELDS),
+        media_type=bulk.EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="wardrobe.{format}"'},
+    )
+
 @app.get("/api/clothes/{clothes_id}")
 @auth_required
 async def get_clothes(request: Request, clothes_id: str):
@@ -258,17 +823,20 @@ async def get_clothes(request: Request, clothes_id: str):
 
 @app.get("/api/clothes")
 @auth_required
-async def get_clothes(request: Request):
-    clothes = await get_clothes_by_user_id(request.state.userId)
-    if clothes == None:
-        raise HTTPException(status_code=404, detail="Not Found")
-
-    return clothes
+async def get_clothes(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+    type: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    return await paginate(get_clothes_by_user_id, request.state.userId, limit, after, type, fields)
 
 class ClothesModel(BaseModel):
-    name: str
-    type: str
-    image_address: str
+    # The clothes columns are VARCHAR(255)
+    name: str = Field(max_length=255)
+    type: str = Field(max_length=255)
+    image_address: str = Field(max_length=255)
 
 @app.post("/api/clothes")
 @auth_required
@@ -279,10 +847,65 @@ async def post_clothes(request: Request, data: ClothesModel):
     else:
         return Response(content="Error", status_code=400)
 
+@app.post("/api/clothes/import")
+@auth_required
+async def import_clothes(request: Request):
+    """
+    Import clothes from a CSV, JSON array or NDJSON body.
+
+    Records are validated as they stream in and inserted in batches, each
+    in its own transaction. Invalid records are skipped and reported.
+    """
+    format = bulk.detect_format(request.headers.get("content-type"))
+    if not format:
+        raise HTTPException(status_code=415, detail="Unsupported Media Type")
+
+    userId = request.state.userId
+    imported = 0
+    failed = 0
+    errors = []
+    batch = []
+
+    try:
+        async for position, record in bulk.iter_records(request.stream(), format):
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                if not isinstance(record, dict):
+                    raise ValueError("Expected an object")
+                clothes = ClothesModel(**record)
+            except (ValueError, TypeError) as e:
+                failed += 1
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({"position": position, "error": str(e)})
+                continue
+
+            batch.append((clothes.name, clothes.type, clothes.image_address))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                imported += await add_clothes_batch(userId, batch)
+                batch = []
+    except bulk.ImportFormatError as e:
+        failed += 1
+        errors.append({"position": None, "error": str(e)})
+
+    imported += await add_clothes_batch(userId, batch)
+    return {"imported": imported, "failed": failed, "errors": errors}
+
+@app.post("/api/clothes/images")
+@auth_required
+async def post_clothes_image(request: Request, file: UploadFile):
+    data = await file.read(images.MAX_IMAGE_BYTES + 1)
+    try:
+        stored = await images.store_image(data)
+    except images.InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return JSONResponse(content=stored, status_code=201)
+
 class UpdateClothesModel(BaseModel):
-    name: Optional[str]
-    type: Optional[str]
-    image_address: Optional[str]
+    name: Optional[str] = Field(max_length=255)
+    type: Optional[str] = Field(max_length=255)
+    image_address: Optional[str] = Field(max_length=255)
 
 @app.put("/api/clothes/{clothes_id}")
 @auth_required
@@ -316,20 +939,111 @@ async def delete(request: Request, clothes_id: str):
 
 
 class SensorDataModel(BaseModel):
-    value: float
+    # NaN and infinities cannot be stored, sent as JSON or fed to alert statistics
+    value: float = Field(allow_inf_nan=False)
     type: str
     address: str
     api_key: str
+    # When the device took the reading, and its per-sensor sequence number
+    timestamp: Optional[datetime] = None
+    seq: Optional[int] = Field(None, ge=0)
+
+MAX_BATCH_READINGS = 5000
+
+class SensorReadingModel(BaseModel):
+    value: float = Field(allow_inf_nan=False)
+    type: str
+    address: str
+    timestamp: Optional[datetime] = None
+    seq: Optional[int] = Field(None, ge=0)
+
+class SensorDataBatchModel(BaseModel):
+    readings: list[SensorReadingModel]
+    api_key: str
+
+def local_timestamp(timestamp: Optional[datetime]) -> Optional[datetime]:
+    """Convert a device timestamp to the naive local time the data table stores."""
+    if timestamp is None or timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone().replace(tzinfo=None)
+
+async def verify_device_key(key: str) -> Optional[DeviceKey]:
+    """Verify a device key, through the cache when it has been seen before."""
+    device_key = device_keys.get(key)
+    if device_key is not None:
+        return device_key
+    if device_keys.is_rejected(key) or not key.startswith(KEY_PREFIX):
+        return None
+
+    row = await get_device_key_by_hash(hash_key(key))
+    if row is None:
+        device_keys.reject(key)
+        return None
+
+    device_key = DeviceKey(row["id"], row["user_id"], row["address"], row["tier"])
+    device_keys.add(key, device_key)
+    return device_key
+
+async def submit_readings(api_key: str, readings: list) -> dict:
+    """
+    Authenticate, rate limit and queue readings.
+
+    A shared API key may send readings for any device. A device key may
+    only send readings for its own address's sensors that belong to the
+    key's user, and its usage is counted.
+    """
+    tier = ingest_limiter.tier(api_key)
+    device_key = None
+    if tier is not None:
+        credential = "shared:" + api_key
+    else:
+        device_key = await verify_device_key(api_key)
+        if device_key is None:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if any(reading.address != device_key.address for reading in readings):
+            raise HTTPException(status_code=403, detail="Device key is for another address")
+        # Sensors are unique on address and type, so several users may have sensors at one address
+        for reading in readings:
+            sensor_id = sensor_registry.resolve(reading.address, reading.type)
+            # owns() is False too if the sensor was deleted since it was resolved
+            if sensor_id is None or not sensor_registry.owns(device_key.user_id, sensor_id):
+                raise HTTPException(status_code=403, detail="Device key is not for this sensor")
+        tier = device_key.tier
+        credential = f"device:{device_key.id}"
+        device_keys.record(device_key.id, len(readings))
+
+    try:
+        readings, limited = ingest_limiter.admit(credential, tier, readings)
+    except RateLimitedError as e:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded", headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+    try:
+        counts = ingest_queue.submit([
+            (reading.value, reading.type, reading.address, local_timestamp(reading.timestamp), reading.seq)
+            for reading in readings
+        ])
+    except IngestFullError:
+        raise HTTPException(status_code=503, detail="Ingest queue full", headers={"Retry-After": "1"})
+
+    counts["limited"] = limited
+    return counts
 
 @app.post("/api/data")
 async def post(data: SensorDataModel):
-    if data.api_key != API_KEY:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    
-    if await add_data(data.value, data.type, data.address):
+    counts = await submit_readings(data.api_key, [data])
+    if counts["accepted"] or counts["duplicate"]:
         return Response(content="Success", status_code=200)
+    elif counts["unknown"]:
+        return Response(content="Unknown sensor", status_code=404)
     else:
-        return Response(content="Error", status_code=400)
+        return Response(content="Reading outside the ingest window", status_code=400)
+
+@app.post("/api/data/batch")
+async def post_batch(data: SensorDataBatchModel):
+    if len(data.readings) > MAX_BATCH_READINGS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_READINGS} readings per batch")
+
+    return await submit_readings(data.api_key, data.readings)
 
 
 @app.get("/api/ai-wardrobe-recommendation")
@@ -345,21 +1059,17 @@ async def get(request: Request):
     userLocation = user.get('location')
     clothes = await get_clothes_by_user_id(request.state.userId)
     try:
-        geolocator = Nominatim(user_agent="wardrobify-ece140a")
-        location = geolocator.geocode(userLocation)
-
-        dataResponse = requests.get(f"https://api.weather.gov/points/{location.latitude},{location.longitude}")
-        data = dataResponse.json()
-
-        forecastUrl = data.get('properties').get('forecast')
+        # Only this route talks to the AI service, so workers that never serve it never import requests
+        import requests
 
-        currentForecastResponse = requests.get(forecastUrl)
-        currentForecast = currentForecastResponse.json().get('properties').get('periods')[0]
+        currentForecast = await weather.get_weather(userLocation)
+        if currentForecast is None:
+            raise LookupError(f"No forecast for {userLocation}")
 
         query = f'''
         Pick an outfit for me.
         My wardrobe consists of the following items: {clothes}.
-        The weather conditions today: {currentForecast.get('shortForecast')}, temperature: {currentForecast.get('temperature')}F.
+        The weather conditions today: {currentForecast.get('condition')}, temperature: {currentForecast.get('temperature')}F.
         Do not use markdown for you response, only use plaintext.
         Format your response in the following way (omit lines if there are not that many choices, add lines if there are more):
         [Clothing 1 Name] - [Clothing 1 Type]
@@ -378,7 +1088,7 @@ async def get(request: Request):
         if not EMAIL or not STUDENT_ID:
             return
 
-        recommendationResponse = requests.post('https://ece140-wi25-api.frosty-sky-f43d.workers.dev/api/v1/ai/complete',
+        recommendationResponse = await asyncio.to_thread(requests.post, 'https://ece140-wi25-api.frosty-sky-f43d.workers.dev/api/v1/ai/complete',
                         headers={
                         'accept': 'application/json',
                         'email': EMAIL,
@@ -397,7 +1107,104 @@ async def get(request: Request):
         return {'response': 'Error fetching AI response'}
 
 
+'''Instrumentation Routes'''
+@app.get("/healthz")
+async def get_health():
+    """Liveness: the process is serving and start_up has not failed. Does no I/O."""
+    done, error = startup_state()
+    if error:
+        return JSONResponse({"status": "failed", "detail": error}, status_code=503)
+    return {"status": "ok" if done else "starting"}
+
+@app.get("/readyz")
+async def get_readiness():
+    """
+    Readiness: start_up is done, the database answers, the ingest queue is
+    below its high-water mark and the event loop is keeping up. Failing
+    any of these asks the load balancer to send traffic elsewhere.
+    """
+    done, error = startup_state()
+    checks = {"started": done and error is None}
+    if checks["started"]:
+        try:
+            checks["database"] = await asyncio.wait_for(asyncio.to_thread(ping_database), READY_DB_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            checks["database"] = False
+    checks["ingest_queue"] = len(ingest_queue) < ingest.INGEST_HIGH_WATER
+    checks["event_loop"] = metrics.loop_monitor.max_lag * 1000 < READY_MAX_LOOP_LAG_MS
+
+    ready = all(checks.values()) and "database" in checks
+    return JSONResponse({"status": "ready" if ready else "not ready", "checks": checks}, status_code=200 if ready else 503)
+
+@app.get("/debug/runtime")
+@admin_required
+async def get_runtime(request: Request):
+    """What this worker is busy with: loop lag, database pools, open streams, queues and tasks."""
+    done, error = startup_state()
+    return {
+        "pid": os.getpid(),
+        "started": done and error is None,
+        "startup_error": error,
+        "event_loop": metrics.loop_monitor.summary(),
+        "tasks": len(asyncio.all_tasks()),
+        "threads": threading.active_count(),
+        "db_pool": database.db_pool.stats(),
+        "db_replicas": [pool.stats() for pool in database.replica_pools],
+        "streams": {**open_streams, "live_subscribers": len(hub)},
+        "ingest_queue": {"pending": len(ingest_queue), "retrying": ingest_queue.retrying_readings, "high_water": ingest.INGEST_HIGH_WATER, "max": ingest.INGEST_MAX_PENDING},
+        "password_hashes_pending": passwords.pending_hashes(),
+    }
+
+@app.get("/metrics")
+@admin_required
+async def get_metrics(request: Request):
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/unknown-sensors")
+@admin_required
+async def get_unknown_sensors(request: Request):
+    return sensor_registry.unknown_devices()
+
+@app.get("/debug/device-usage")
+@admin_required
+async def get_device_usage(request: Request):
+    return device_keys.busiest()
+
+@app.get("/debug/queries")
+@admin_required
+async def get_query_stats(request: Request):
+    return querylog.summary()
+
+
+'''Image Routes'''
+@app.get("/images/{name}")
+async def get_image(name: str):
+    match = images.IMAGE_NAME_PATTERN.match(name)
+    if not match:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    path = images.image_path(*match.groups())
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    return FileResponse(path, headers={"Cache-Control": images.IMMUTABLE_CACHE_CONTROL})
+
+@app.get("/images/{digest}/{size}.webp")
+async def get_thumbnail(digest: str, size: int):
+    if not images.DIGEST_PATTERN.match(digest) or size not in images.THUMBNAIL_SIZES:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    path = images.thumbnail_path(digest, size)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    return FileResponse(path, media_type="image/webp", headers={"Cache-Control": images.IMMUTABLE_CACHE_CONTROL})
+
+
 '''Session Routes'''
+def password_busy() -> HTTPException:
+    return HTTPException(status_code=503, detail="Too many password checks in progress", headers={"Retry-After": "1"})
+
 class LoginModel(BaseModel):
     username: str
     password: str
@@ -411,11 +1218,20 @@ async def post(data: LoginModel):
         raise unauthorized
     
     user = await get_user_by_username(data.username)
-    if not user:
-       raise unauthorized
-
-    if data.password != user.get("password"):
-       raise unauthorized
+    stored = user.get("password") if user else None
+    try:
+        # Unknown users are checked against a dummy hash, so they take as long to refuse
+        if not await passwords.verify_password(data.password, stored):
+            raise unauthorized
+    except passwords.PasswordBusyError:
+        raise password_busy()
+
+    if passwords.needs_rehash(stored):
+        # Upgrade legacy plaintext or outdated hashes while the password is at hand
+        try:
+            await update_user_by_id(user.get("id"), None, await passwords.hash_password(data.password), None, None)
+        except passwords.PasswordBusyError:
+            pass
     
     sessionId = str(uuid.uuid4())
     userId = str(user.get("id"))
@@ -439,7 +1255,12 @@ async def post(data: SignupModel):
     if not data.username or not data.password or not data.email or not data.location:
         raise HTTPException(status_code=400, detail="Invalid request")
     
-    userId = await create_user(data.username, data.password, data.email, data.location)
+    try:
+        password = await passwords.hash_password(data.password)
+    except passwords.PasswordBusyError:
+        raise password_busy()
+
+    userId = await create_user(data.username, password, data.email, data.location)
     if not userId:
         raise HTTPException(status_code=409, detail="Unable to create user")
     
@@ -479,15 +1300,6 @@ async def get_html(request: Request) -> HTMLResponse:
 @app.get("/dashboard", response_class=HTMLResponse)
 @auth_required
 async def get_html(request: Request) -> HTMLResponse:
-    session = await get_session(request.cookies.get("sessionId"))
-    if not session:
-        pass
-
-    userId = session.get("user_id")
-    user = await get_user_by_id(userId)
-    if not user:
-        pass
-
     return HTMLResponse(content=serve_content("static/dashboard.html", request.state.username))
   
 @app.get("/wardrobe", response_class=HTMLResponse)
@@ -0,0 +1,441 @@
+import os
+import sys
+import time
+import asyncio
+import bisect
+import logging
+import threading
+import traceback
+
+from collections import deque, Counter
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Optional
+
+import cluster
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+# Opt-in sampling profiler: requests slower than this many milliseconds get
+# their event loop stack samples written out as folded stacks
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# How often event loop lag is sampled, and how far back its recent maximum looks
+LOOP_LAG_INTERVAL_MS = float(os.getenv("LOOP_LAG_INTERVAL_MS", "100"))
+LOOP_LAG_WINDOW_SECONDS = 10.0
+# A loop stalled this long has the stack it is stuck in captured and its call site counted; 0 turns this off
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", "250"))
+
+
+class Histogram:
+    """Cumulative histogram in the shape Prometheus expects."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str = "") -> list[str]:
+        separator = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+class RequestStats:
+    """Database and auth work attributed to the request being handled."""
+    __slots__ = ("db_queries", "db_seconds", "db_connect_seconds", "auth_seconds")
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.db_connect_seconds = 0.0
+        self.auth_seconds = 0.0
+
+
+_current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+_current_accessor: ContextVar[Optional[str]] = ContextVar("current_accessor", default=None)
+
+request_latency: dict[tuple[str, str, str], Histogram] = {}
+request_db_queries: dict[tuple[str, str], Histogram] = {}
+accessor_latency: dict[str, Histogram] = {}
+db_connect_latency = Histogram()
+auth_latency = Histogram()
+
+# Monotonic counters by metric name, then by label set
+counters: dict[str, dict[str, int]] = {}
+counter_help: dict[str, str] = {}
+
+
+def current_request() -> Optional[RequestStats]:
+    return _current_request.get()
+
+
+def current_accessor() -> Optional[str]:
+    """Name of the database accessor currently running, if any."""
+    return _current_accessor.get()
+
+
+def record_query():
+    """Count one executed statement against the current request."""
+    stats = _current_request.get()
+    if stats is not None:
+        stats.db_queries += 1
+
+
+def record_db_connect(seconds: float):
+    """Record the time taken to open a database connection."""
+    db_connect_latency.observe(seconds)
+    stats = _current_request.get()
+    if stats is not None:
+        stats.db_connect_seconds += seconds
+
+
+def record_auth(seconds: float):
+    """Record the time spent authenticating a request."""
+    auth_latency.observe(seconds)
+    stats = _current_request.get()
+    if stats is not None:
+        stats.auth_seconds += seconds
+
+
+def register_counter(name: str, help: str):
+    """Declare a counter so it is rendered, with its help text, even before it is incremented."""
+    counter_help[name] = help
+    counters.setdefault(name, {})
+
+
+def increment(name: str, labels: str = "", amount: int = 1):
+    """
+    Add to a counter registered with register_counter.
+
+    Args:
+        name:   Metric name
+        labels: Prometheus label set without braces, e.g. 'outcome="accepted"'
+        amount: How much to add
+    """
+    series = counters[name]
+    series[labels] = series.get(labels, 0) + amount
+
+
+def db_accessor(func: Callable) -> Callable:
+    """
+    Make a blocking database accessor awaitable: it runs in a worker thread
+    so the event loop carries on meanwhile. Also times it and names it as
+    the source of the statements it runs.
+    """
+    histogram = accessor_latency.setdefault(func.__name__, Histogram())
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        stats = _current_request.get()
+        token = _current_accessor.set(func.__name__)
+        started = time.perf_counter()
+        try:
+            return await cluster.run_in_thread(func, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_accessor.reset(token)
+            histogram.observe(elapsed)
+            if stats is not None:
+                stats.db_seconds += elapsed
+
+    return wrapper
+
+
+def route_name(request) -> str:
+    """The route template a request matched, so /api/sensors/1 and /2 share a series."""
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+async def metrics_middleware(request, call_next):
+    """
+    Time every HTTP request and attribute database and auth work to it.
+
+    The breakdown is also returned in a Server-Timing header so it shows
+    up in browser dev tools.
+    """
+    stats = RequestStats()
+    token = _current_request.set(stats)
+    started = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        response.headers["Server-Timing"] = (
+            f"db;desc=\"{stats.db_queries} queries\";dur={stats.db_seconds * 1000:.1f}, "
+            f"db-connect;dur={stats.db_connect_seconds * 1000:.1f}, "
+            f"auth;dur={stats.auth_seconds * 1000:.1f}"
+        )
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        _current_request.reset(token)
+
+        route = route_name(request)
+        key = (request.method, route, status)
+        if key not in request_latency:
+            request_latency[key] = Histogram()
+        request_latency[key].observe(elapsed)
+
+        queries_key = (request.method, route)
+        if queries_key not in request_db_queries:
+            request_db_queries[queries_key] = Histogram(COUNT_BUCKETS)
+        request_db_queries[queries_key].observe(stats.db_queries)
+
+        if profiler is not None and elapsed * 1000 >= PROFILE_SLOW_MS:
+            end = time.monotonic()
+            await asyncio.to_thread(profiler.dump, f"{request.method} {route}", end - elapsed, end)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render() -> str:
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = [
+        "# HELP http_request_duration_seconds HTTP request latency by route",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for (method, route, status), histogram in sorted(request_latency.items()):
+        lines += histogram.render(
+            "http_request_duration_seconds",
+            f'method="{method}",route="{_escape(route)}",status="{status}"',
+        )
+
+    lines += [
+        "# HELP http_request_db_queries Database statements executed per HTTP request",
+        "# TYPE http_request_db_queries histogram",
+    ]
+    for (method, route), histogram in sorted(request_db_queries.items()):
+        lines += histogram.render("http_request_db_queries", f'method="{method}",route="{_escape(route)}"')
+
+    lines += [
+        "# HELP db_accessor_duration_seconds Database accessor latency including connecting",
+        "# TYPE db_accessor_duration_seconds histogram",
+    ]
+    for name, histogram in sorted(accessor_latency.items()):
+        if histogram.count:
+            lines += histogram.render("db_accessor_duration_seconds", f'accessor="{name}"')
+
+    lines += [
+        "# HELP db_connect_duration_seconds Time to open a database connection",
+        "# TYPE db_connect_duration_seconds histogram",
+        *db_connect_latency.render("db_connect_duration_seconds"),
+        "# HELP auth_duration_seconds Time spent in auth_required before the handler runs",
+        "# TYPE auth_duration_seconds histogram",
+        *auth_latency.render("auth_duration_seconds"),
+        "# HELP event_loop_lag_seconds How late the event loop ran a timer it was given",
+        "# TYPE event_loop_lag_seconds histogram",
+        *loop_monitor.histogram.render("event_loop_lag_seconds"),
+    ]
+
+    for name, series in sorted(counters.items()):
+        lines += [f"# HELP {name} {counter_help[name]}", f"# TYPE {name} counter"]
+        for labels, value in sorted(series.items()):
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread's stack on a background thread.
+
+    Samples are kept for a short window so the ones taken while a slow
+    request was in flight can be written out as folded stacks, ready for
+    flamegraph.pl or speedscope. Concurrent requests share the loop, so a
+    dump shows everything the loop did during that time.
+    """
+
+    def __init__(self, interval: float, window: float = 60.0):
+        self.interval = interval
+        self.thread_id = threading.main_thread().ident
+        self.samples: deque[tuple[float, str]] = deque(maxlen=int(window / interval))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self, thread_id: Optional[int] = None):
+        if thread_id is not None:
+            self.thread_id = thread_id
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.samples.append((time.monotonic(), ";".join(reversed(stack))))
+
+    def dump(self, label: str, start: float, end: float) -> Optional[str]:
+        """Write the stacks sampled between start and end, returning the file path."""
+        stacks = Counter(stack for timestamp, stack in list(self.samples) if start <= timestamp <= end)
+        if not stacks:
+            return None
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = "".join(char if char.isalnum() else "_" for char in label).strip("_")
+        path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{name}.folded")
+        with open(path, "w") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        return path
+
+
+profiler: Optional[SamplingProfiler] = None
+
+
+def start_profiler():
+    """Start the sampling profiler on the calling (event loop) thread if PROFILE_SLOW_MS is set."""
+    global profiler
+    if PROFILE_SLOW_MS <= 0 or profiler is not None:
+        return
+    profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+    profiler.start(threading.get_ident())
+
+
+def stop_profiler():
+    global profiler
+    if profiler is not None:
+        profiler.stop()
+        profiler = None
+
+
+def _blocking_call(frame) -> tuple[str, str]:
+    """
+    Where a stalled event loop is stuck: the innermost app frame, and the
+    function it called that has not returned, e.g. mysql.connector.connect.
+    When the loop is stuck outside app code the innermost frame is both.
+    """
+    site, call = frame, frame
+    while site is not None and not site.f_code.co_filename.startswith(APP_DIR):
+        call, site = site, site.f_back
+    if site is None:
+        site = call = frame
+    code = site.f_code
+    return (
+        f"{os.path.basename(code.co_filename)}:{code.co_name}:{site.f_lineno}",
+        f"{call.f_globals.get('__name__', '?')}.{call.f_code.co_name}",
+    )
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag: how late a timer set on the loop fires. The
+    loop only runs a callback once whatever it is running yields, so lag
+    is how long every request on this worker waits for its turn.
+
+    A watchdog thread catches the loop while it is stalled for longer than
+    the stall threshold and captures the stack it is stuck in. Once the
+    loop resumes the stall is logged and counted by call site in
+    event_loop_stalls_total, so blocking calls in coroutines show up by
+    name and a fix shows up as the count no longer growing.
+    """
+
+    def __init__(self, interval: float, window: float, stall: float):
+        self.interval = interval
+        self.stall = stall
+        self.samples: deque[float] = deque(maxlen=max(1, int(window / interval)))
+        self.histogram = Histogram()
+        self.stalls: deque[dict] = deque(maxlen=20)
+        self._task: Optional[asyncio.Task] = None
+        self._thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        # Monotonic time by which the loop should next have woken, and what the watchdog caught it in
+        self._due = float("inf")
+        self._caught: Optional[tuple] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            self._due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self.samples.append(lag)
+            self.histogram.observe(lag)
+            caught, self._caught = self._caught, None
+            if caught is not None and caught[0] == self._due:
+                self._record_stall(lag, *caught[1:])
+
+    def _watch(self):
+        while not self._stop.wait(self.stall / 2):
+            due = self._due
+            if time.monotonic() < due + self.stall or (self._caught is not None and self._caught[0] == due):
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self._caught = (due, *_blocking_call(frame), traceback.extract_stack(frame, limit=20))
+
+    def _record_stall(self, lag: float, site: str, call: str, stack: traceback.StackSummary):
+        increment("event_loop_stalls_total", f'site="{_escape(site)}",call="{_escape(call)}"')
+        self.stalls.append({"at": time.time(), "lag_ms": round(lag * 1000, 1), "site": site, "call": call})
+        logger.warning(
+            f"Event loop stalled for {lag * 1000:.0f}ms in {call} called from {site}:\n"
+            + "".join(traceback.format_list(stack))
+        )
+
+    def start(self):
+        """Start measuring the running loop. Called on the loop's thread."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            if self.stall > 0:
+                self._thread_id = threading.get_ident()
+                self._stop = threading.Event()
+                threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._stop.set()
+            self._due = float("inf")
+
+    @property
+    def max_lag(self) -> float:
+        """Worst lag over the last LOOP_LAG_WINDOW_SECONDS."""
+        return max(self.samples, default=0.0)
+
+    def summary(self) -> dict:
+        return {
+            "lag_ms": round(self.samples[-1] * 1000, 2) if self.samples else 0.0,
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "window_seconds": LOOP_LAG_WINDOW_SECONDS,
+            "stall_ms": LOOP_STALL_MS,
+            "recent_stalls": list(self.stalls),
+        }
+
+
+register_counter("event_loop_stalls_total", "Event loop stalls longer than LOOP_STALL_MS by the call they were stuck in")
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL_MS / 1000, LOOP_LAG_WINDOW_SECONDS, LOOP_STALL_MS / 1000)
@@ -0,0 +1,138 @@
+import os
+import hmac
+import base64
+import asyncio
+import hashlib
+import secrets
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(os.cpu_count() or 1)))
+# Hashes waiting for a worker beyond this are refused rather than queued
+MAX_PENDING_HASHES = int(os.getenv("MAX_PENDING_HASHES", str(PASSWORD_WORKERS * 8)))
+
+# scrypt cost: 2**14 x 8 blocks is 16 MiB and tens of milliseconds per hash
+SCRYPT_N = int(os.getenv("SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+HASH_SCHEME = "scrypt"
+
+_executor: Optional[ProcessPoolExecutor] = None
+_slots: Optional[asyncio.Semaphore] = None
+_pending = 0
+
+
+class PasswordBusyError(Exception):
+    """Raised when too many password hashes are already waiting"""
+    pass
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=HASH_BYTES)
+
+
+def _hash(password: str) -> str:
+    """Hash a password as scrypt$n$r$p$salt$hash. Runs in a worker process."""
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"{HASH_SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(salt)}${_b64encode(digest)}"
+
+
+def _verify(password: str, stored: str) -> bool:
+    """Check a password against a stored hash. Runs in a worker process."""
+    try:
+        scheme, n, r, p, salt, digest = stored.split("$")
+        expected = _b64decode(digest)
+        actual = _scrypt(password, _b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return scheme == HASH_SCHEME and hmac.compare_digest(actual, expected)
+
+
+def pending_hashes() -> int:
+    """Hashes running or waiting for a worker."""
+    return _pending
+
+
+def is_hashed(stored: str) -> bool:
+    return stored.startswith(HASH_SCHEME + "$")
+
+
+def needs_rehash(stored: str) -> bool:
+    """Whether a stored password is plaintext or hashed with other parameters than now."""
+    return not stored.startswith(f"{HASH_SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS)
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+async def _run(function, *args):
+    """Run a hashing function in the worker pool, at most PASSWORD_WORKERS at a time."""
+    global _slots, _pending
+    if _pending >= MAX_PENDING_HASHES:
+        raise PasswordBusyError(f"{_pending} password hashes already pending")
+
+    if _slots is None:
+        _slots = asyncio.Semaphore(PASSWORD_WORKERS)
+    _pending += 1
+    try:
+        async with _slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_executor(), function, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    """
+    Hash a password for storage.
+
+    Raises:
+        PasswordBusyError: if too many hashes are already waiting
+    """
+    return await _run(_hash, password)
+
+
+# Verified against when a user does not exist, so a login takes as long either way
+_DUMMY_HASH = f"{HASH_SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(bytes(SALT_BYTES))}${_b64encode(bytes(HASH_BYTES))}"
+
+
+async def verify_password(password: str, stored: Optional[str]) -> bool:
+    """
+    Check a password against a stored hash, or against a legacy
+    plaintext password from before passwords were hashed.
+
+    Args:
+        password:   Password to check
+        stored:     Stored hash or plaintext, None if the user does not exist
+
+    Raises:
+        PasswordBusyError: if too many hashes are already waiting
+    """
+    if stored is not None and not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    verified = await _run(_verify, password, stored or _DUMMY_HASH)
+    return verified and stored is not None
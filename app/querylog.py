@@ -0,0 +1,127 @@
+import os
+import re
+import logging
+
+from collections import deque
+from functools import lru_cache
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Statements whose execute time exceeds this many milliseconds are logged with EXPLAIN output
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+# Latest timings kept per fingerprint for percentiles
+SAMPLES_PER_FINGERPRINT = 1024
+MAX_SLOW_QUERIES = 100
+
+_WHITESPACE = re.compile(r"\s+")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"IN \((?:\?, )*\?\)", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(query: str) -> str:
+    """
+    Normalize a statement so every execution of the same query shape
+    shares one entry: literals and placeholders become `?` and
+    whitespace is collapsed.
+    """
+    normalized = _WHITESPACE.sub(" ", query).strip().rstrip(";")
+    normalized = _PLACEHOLDER.sub("?", normalized)
+    normalized = _STRING.sub("?", normalized)
+    normalized = _NUMBER.sub("?", normalized)
+    return _IN_LIST.sub("IN (?+)", normalized)
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of pre-sorted samples."""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class QueryStats:
+    """Timings for one statement fingerprint."""
+
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.accessors: set[str] = set()
+        self.calls = 0
+        self.rows = 0
+        self.total_seconds = 0.0
+        self.connect_seconds: deque[float] = deque(maxlen=SAMPLES_PER_FINGERPRINT)
+        self.execute_seconds: deque[float] = deque(maxlen=SAMPLES_PER_FINGERPRINT)
+
+    def record(self, accessor: Optional[str], rows: int, connect_seconds: float, execute_seconds: float):
+        if accessor:
+            self.accessors.add(accessor)
+        self.calls += 1
+        self.rows += rows
+        self.total_seconds += connect_seconds + execute_seconds
+        self.connect_seconds.append(connect_seconds)
+        self.execute_seconds.append(execute_seconds)
+
+    def summary(self) -> dict:
+        connect = sorted(self.connect_seconds)
+        execute = sorted(self.execute_seconds)
+        return {
+            "fingerprint": self.fingerprint,
+            "accessors": sorted(self.accessors),
+            "calls": self.calls,
+            "rows": self.rows,
+            "total_ms": round(self.total_seconds * 1000, 3),
+            "connect_ms": {
+                name: round(percentile(connect, fraction) * 1000, 3)
+                for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+            },
+            "execute_ms": {
+                name: round(percentile(execute, fraction) * 1000, 3)
+                for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+            },
+        }
+
+
+query_stats: dict[str, QueryStats] = {}
+slow_queries: deque[dict] = deque(maxlen=MAX_SLOW_QUERIES)
+
+
+def record(query: str, accessor: Optional[str], rows: int, connect_seconds: float, execute_seconds: float) -> str:
+    """Record one statement execution, returning its fingerprint."""
+    key = fingerprint(query)
+    stats = query_stats.get(key)
+    if stats is None:
+        stats = query_stats[key] = QueryStats(key)
+    stats.record(accessor, rows, connect_seconds, execute_seconds)
+    return key
+
+
+def is_slow(execute_seconds: float) -> bool:
+    return execute_seconds * 1000 >= SLOW_QUERY_MS
+
+
+def record_slow(key: str, accessor: Optional[str], rows: int, execute_seconds: float, plan: Optional[list]):
+    """Log a slow statement with its query plan and keep it for /debug/queries."""
+    entry = {
+        "fingerprint": key,
+        "accessor": accessor,
+        "rows": rows,
+        "execute_ms": round(execute_seconds * 1000, 3),
+        "explain": plan,
+    }
+    slow_queries.append(entry)
+    logger.warning(f"Slow query ({entry['execute_ms']} ms, {rows} rows) in {accessor}: {key} EXPLAIN: {plan}")
+
+
+def summary() -> dict:
+    """Per-fingerprint percentiles ordered by total time spent, plus recent slow queries."""
+    return {
+        "slow_query_ms": SLOW_QUERY_MS,
+        "queries": [
+            stats.summary()
+            for stats in sorted(query_stats.values(), key=lambda stats: stats.total_seconds, reverse=True)
+        ],
+        "slow": list(slow_queries),
+    }
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+
+from collections import OrderedDict
+from typing import Optional
+from dotenv import load_dotenv
+
+import metrics
+import cluster
+
+load_dotenv()
+
+# Sustained readings per second and burst size allowed per tier, for each
+# API key as a whole and for each device sending through it. INGEST_TIERS
+# may override or add tiers as JSON in the same shape.
+DEFAULT_TIERS = {
+    "standard": {"key_rate": 5000, "key_burst": 20000, "device_rate": 1, "device_burst": 60},
+    "bulk": {"key_rate": 50000, "key_burst": 200000, "device_rate": 10, "device_burst": 600},
+}
+TIERS = {**DEFAULT_TIERS, **json.loads(os.getenv("INGEST_TIERS", "{}"))}
+
+# API_KEY belongs to the standard tier; INGEST_API_KEYS may map further keys to tiers as JSON
+API_KEY_TIERS = {os.getenv("API_KEY"): "standard", **json.loads(os.getenv("INGEST_API_KEYS", "{}"))}
+
+# Bound on device buckets held; the least recently used are dropped first
+MAX_TRACKED_DEVICES = 100_000
+
+metrics.register_counter("ingest_rate_limited_total", "Sensor readings rejected by rate limits")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count: int, now: float) -> float:
+        """Take count tokens if all are available, returning 0, otherwise the seconds until they would be."""
+        self._refill(now)
+        if self.tokens >= count:
+            self.tokens -= count
+            return 0.0
+        return (count - self.tokens) / self.rate
+
+    def take_up_to(self, count: int, now: float) -> int:
+        """Take as many of count tokens as are available, returning how many were taken."""
+        self._refill(now)
+        taken = min(count, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+    def wait(self) -> float:
+        """Seconds until the next token is available."""
+        return max(0.0, 1 - self.tokens) / self.rate
+
+
+class RateLimitedError(Exception):
+    """Raised when readings are refused by a rate limit"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class IngestLimiter:
+    """
+    Token bucket rate limits on ingested readings, per API key and per
+    device address.
+
+    Everything is held in memory, so floods are turned away before they
+    reach the ingest queue or the database. A key over its quota has
+    whole requests refused; a device over its quota only loses its own
+    readings, so one noisy device behind a shared bridge cannot starve
+    the rest.
+
+    Buckets are per process. In a multi-worker server, where requests are
+    spread across workers, each worker allows its share of every limit.
+    """
+
+    def __init__(self, tiers: dict, api_key_tiers: dict):
+        self.tiers = tiers
+        self.api_key_tiers = {key: tier for key, tier in api_key_tiers.items() if key}
+        self.keys: dict[str, TokenBucket] = {}
+        self.devices: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def _quota(self, tier: str) -> dict:
+        """A tier's limits for this process."""
+        workers = cluster.size()
+        return {name: limit / workers for name, limit in self.tiers[tier].items()}
+
+    def tier(self, api_key: str) -> Optional[str]:
+        """The tier of a shared API key, None if it is not one."""
+        return self.api_key_tiers.get(api_key)
+
+    def _device_bucket(self, address: str, quota: dict, now: float) -> TokenBucket:
+        bucket = self.devices.get(address)
+        if bucket is None:
+            bucket = self.devices[address] = TokenBucket(quota["device_rate"], quota["device_burst"], now)
+            if len(self.devices) > MAX_TRACKED_DEVICES:
+                self.devices.popitem(last=False)
+        else:
+            self.devices.move_to_end(address)
+        return bucket
+
+    def admit(self, credential: str, tier: str, readings: list) -> tuple[list, int]:
+        """
+        Charge readings against a credential's and each device's quota.
+
+        Readings need an `address` attribute.
+
+        Args:
+            credential: Identifies the key the readings were sent with
+            tier:       Tier of that key
+            readings:   Readings to admit
+
+        Returns:
+            tuple[list, int]: The readings admitted, and how many were
+                              dropped by device limits
+
+        Raises:
+            RateLimitedError: if the key is over quota, or every reading's device is
+        """
+        quota = self._quota(tier)
+        now = time.monotonic()
+
+        key_bucket = self.keys.get(credential)
+        if key_bucket is None:
+            key_bucket = self.keys[credential] = TokenBucket(quota["key_rate"], quota["key_burst"], now)
+        retry_after = key_bucket.take(len(readings), now)
+        if retry_after:
+            metrics.increment("ingest_rate_limited_total", f'scope="key",tier="{tier}"', len(readings))
+            raise RateLimitedError(retry_after)
+
+        wanted: dict[str, int] = {}
+        for reading in readings:
+            wanted[reading.address] = wanted.get(reading.address, 0) + 1
+
+        allowed = {}
+        retry_after = None
+        for address, count in wanted.items():
+            bucket = self._device_bucket(address, quota, now)
+            allowed[address] = bucket.take_up_to(count, now)
+            if allowed[address] < count:
+                wait = bucket.wait()
+                retry_after = wait if retry_after is None else min(retry_after, wait)
+
+        if retry_after is None:
+            return readings, 0
+
+        admitted = []
+        for reading in readings:
+            if allowed[reading.address]:
+                allowed[reading.address] -= 1
+                admitted.append(reading)
+
+        limited = len(readings) - len(admitted)
+        metrics.increment("ingest_rate_limited_total", f'scope="device",tier="{tier}"', limited)
+        if not admitted:
+            raise RateLimitedError(retry_after)
+        return admitted, limited
+
+
+ingest_limiter = IngestLimiter(TIERS, API_KEY_TIERS)
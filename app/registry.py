@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+# Unregistered (address, type) pairs remembered for inspection
+MAX_UNKNOWN_DEVICES = 1000
+
+
+class Sensor(NamedTuple):
+    id: int
+    user_id: int
+    type: str
+    address: str
+
+
+class SensorRegistry:
+    """
+    In-memory map between sensor IDs, the (address, type) their readings
+    arrive with, and their owners.
+
+    Loaded at startup and kept current by the sensor accessors, so ingest
+    resolves every reading to a sensor ID, and /ws checks who owns the
+    sensors it is asked for, without touching the database.
+    Readings from devices nobody has registered are counted here instead
+    of being stored.
+    """
+
+    def __init__(self):
+        self.sensors: dict[int, Sensor] = {}
+        self.by_key: dict[tuple[str, str], int] = {}
+        self.by_user: dict[int, set[int]] = {}
+        # (address, type) -> [readings refused, last seen], least recently seen first
+        self.unknown: OrderedDict[tuple[str, str], list] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.sensors)
+
+    def clear(self):
+        self.sensors.clear()
+        self.by_key.clear()
+        self.by_user.clear()
+        self.unknown.clear()
+
+    def load(self, sensors: list[dict]):
+        self.sensors.clear()
+        self.by_key.clear()
+        self.by_user.clear()
+        for sensor in sensors:
+            self.add(sensor)
+
+    def add(self, sensor: dict):
+        entry = Sensor(int(sensor["id"]), int(sensor["user_id"]), sensor["type"], sensor["address"])
+        self.sensors[entry.id] = entry
+        self.by_key[(entry.address, entry.type)] = entry.id
+        self.by_user.setdefault(entry.user_id, set()).add(entry.id)
+        self.unknown.pop((entry.address, entry.type), None)
+
+    def update(self, sensor_id: int, type: Optional[str] = None, address: Optional[str] = None):
+        sensor = self.sensors.get(sensor_id)
+        if sensor is None:
+            return
+        self.remove(sensor_id)
+        self.add(sensor._replace(type=type or sensor.type, address=address or sensor.address)._asdict())
+
+    def remove(self, sensor_id: int):
+        sensor = self.sensors.pop(sensor_id, None)
+        if sensor is None:
+            return
+        if self.by_key.get((sensor.address, sensor.type)) == sensor_id:
+            del self.by_key[(sensor.address, sensor.type)]
+        owned = self.by_user.get(sensor.user_id)
+        if owned is not None:
+            owned.discard(sensor_id)
+            if not owned:
+                del self.by_user[sensor.user_id]
+
+    def remove_user(self, user_id: int) -> list[int]:
+        """Remove every sensor a user owns, returning their IDs."""
+        sensor_ids = list(self.by_user.get(user_id, ()))
+        for sensor_id in sensor_ids:
+            self.remove(sensor_id)
+        return sensor_ids
+
+    def get(self, sensor_id: int) -> Optional[Sensor]:
+        return self.sensors.get(sensor_id)
+
+    def owns(self, user_id: int, sensor_id: int) -> bool:
+        return sensor_id in self.by_user.get(user_id, ())
+
+    def owns_address(self, user_id: int, address: str) -> bool:
+        """Whether a user has registered any sensor at this address."""
+        return any(self.sensors[sensor_id].address == address for sensor_id in self.by_user.get(user_id, ()))
+
+    def resolve(self, address: str, type: str) -> Optional[int]:
+        """The ID of the sensor registered for this address and type, None if there is none."""
+        return self.by_key.get((address, type))
+
+    def note_unknown(self, address: str, type: str, count: int = 1):
+        key = (address, type)
+        seen = self.unknown.pop(key, None) or [0, None]
+        seen[0] += count
+        seen[1] = datetime.now()
+        self.unknown[key] = seen
+        if len(self.unknown) > MAX_UNKNOWN_DEVICES:
+            self.unknown.popitem(last=False)
+
+    def unknown_devices(self) -> list[dict]:
+        """Unregistered devices that sent readings, most recently seen first."""
+        return [
+            {"address": address, "type": type, "readings": count, "last_seen": last_seen.strftime("%Y-%m-%d %H:%M:%S")}
+            for (address, type), (count, last_seen) in reversed(self.unknown.items())
+        ]
+
+
+sensor_registry = SensorRegistry()
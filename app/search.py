@@ -0,0 +1,351 @@
+import re
+import heapq
+import bisect
+import itertools
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Per-user indexes kept in memory before the least recently searched is evicted
+MAX_INDEXED_USERS = 256
+
+
+def tokenize(text: Optional[str]) -> list[str]:
+    """Split text into lowercase word tokens."""
+    if not text:
+        return []
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def trigrams(token: str, prefix: bool = False) -> set[str]:
+    """
+    Trigrams of a token padded with `$` markers.
+
+    Args:
+        token:  Token to split
+        prefix: Only pad the start, so the trigrams of a query prefix
+                are a subset of the trigrams of any word it starts
+
+    Returns:
+        set[str]: Trigrams of the token
+    """
+    padded = "$$" + token + ("" if prefix else "$")
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_typos(token: str) -> int:
+    """Number of edits tolerated for a query token of this length."""
+    if len(token) <= 3:
+        return 0
+    if len(token) <= 6:
+        return 1
+    return 2
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Edit distance between two strings counting adjacent transpositions
+    as one edit (optimal string alignment), giving up past `limit`.
+
+    Returns:
+        int: The distance, or limit + 1 if it exceeds limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            distance = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b),
+            )
+            if before and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                distance = min(distance, before[j - 2] + 1)
+            current.append(distance)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+
+    return previous[-1]
+
+
+class UserIndex:
+    """Inverted index over one user's clothes: words -> clothes ids, trigrams -> words."""
+
+    def __init__(self):
+        self.docs: dict[int, dict] = {}
+        self.doc_words: dict[int, set[str]] = {}
+        self.word_docs: dict[str, set[int]] = {}
+        self.trigram_words: dict[str, set[str]] = {}
+        # Sorted vocabulary so prefix matches are a contiguous slice
+        self.vocabulary: list[str] = []
+
+    def add(self, clothes: dict):
+        clothes_id = clothes["id"]
+        self.remove(clothes_id)
+
+        words = set(tokenize(clothes.get("name"))) | set(tokenize(clothes.get("type")))
+        self.docs[clothes_id] = clothes
+        self.doc_words[clothes_id] = words
+
+        for word in words:
+            if word not in self.word_docs:
+                self.word_docs[word] = set()
+                bisect.insort(self.vocabulary, word)
+                for trigram in trigrams(word):
+                    self.trigram_words.setdefault(trigram, set()).add(word)
+            self.word_docs[word].add(clothes_id)
+
+    def remove(self, clothes_id: int):
+        self.docs.pop(clothes_id, None)
+
+        for word in self.doc_words.pop(clothes_id, ()):
+            docs = self.word_docs[word]
+            docs.discard(clothes_id)
+            if docs:
+                continue
+
+            del self.word_docs[word]
+            del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+            for trigram in trigrams(word):
+                words = self.trigram_words[trigram]
+                words.discard(word)
+                if not words:
+                    del self.trigram_words[trigram]
+
+    def prefix_words(self, token: str) -> list[str]:
+        """Indexed words starting with the token."""
+        start = bisect.bisect_left(self.vocabulary, token)
+        end = bisect.bisect_left(self.vocabulary, token + "\uffff", start)
+        return self.vocabulary[start:end]
+
+    def fuzzy_words(self, token: str) -> dict[str, float]:
+        """
+        Indexed words within the token's typo budget, scored below 1 by edit count.
+
+        Candidates must share enough trigrams with the token before the
+        edit distance is computed, since one edit changes at most three.
+        """
+        typos = max_typos(token)
+        if not typos:
+            return {}
+
+        query_trigrams = trigrams(token, prefix=True)
+        required = max(1, len(query_trigrams) - 3 * typos)
+
+        hits: dict[str, int] = {}
+        for trigram in query_trigrams:
+            for word in self.trigram_words.get(trigram, ()):
+                hits[word] = hits.get(word, 0) + 1
+
+        scores = {}
+        for word, count in hits.items():
+            if count < required:
+                continue
+            distance = min(
+                edit_distance(token, word, typos),
+                edit_distance(token, word[:len(token)], typos),
+            )
+            if distance <= typos:
+                scores[word] = 1.0 - distance / (len(token) + 1)
+
+        return scores
+
+    def search(self, query: str, limit: int) -> list[dict]:
+        """
+        Return the best matching clothes containing every query token.
+
+        A token matches words it is a prefix of. Only when it prefixes no
+        indexed word is it treated as a typo and matched fuzzily.
+        """
+        tokens = set(tokenize(query))
+        if not tokens:
+            return []
+
+        matches: list[set[int]] = []
+        tiers: list[list[tuple[float, set[int]]]] = []
+        for token in tokens:
+            words = self.prefix_words(token)
+            if not words:
+                scores = self.fuzzy_words(token)
+                if not scores:
+                    return []
+                by_score: dict[float, set[int]] = {}
+                for word, score in scores.items():
+                    by_score.setdefault(score, set()).update(self.word_docs[word])
+                tiers.append(sorted(by_score.items(), key=lambda tier: tier[0], reverse=True))
+                words = scores
+
+            matches.append(set().union(*(self.word_docs[word] for word in words)))
+
+        matches.sort(key=len)
+        candidates = matches[0].intersection(*matches[1:])
+
+        if not tiers:
+            best = heapq.nsmallest(limit, candidates)
+        else:
+            # Walk combinations of fuzzy score tiers from the highest total down,
+            # so whole tiers are intersected instead of scoring every candidate
+            combinations = sorted(
+                itertools.product(*tiers),
+                key=lambda combination: -sum(score for score, _ in combination),
+            )
+            best = []
+            for combination in combinations:
+                pool = candidates.intersection(*(docs for _, docs in combination))
+                candidates = candidates - pool
+                best.extend(heapq.nsmallest(limit - len(best), pool))
+                if len(best) >= limit or not candidates:
+                    break
+
+        return [self.docs[clothes_id] for clothes_id in best]
+
+
+class PendingLoad:
+    """Changes to a user's clothes made while their index is read from the database."""
+
+    def __init__(self):
+        self.events: list[tuple] = []
+
+
+class ClothesIndex:
+    """
+    Full-text index of clothes names and types, loaded per user on first search
+    and kept up to date by the clothes accessors in database.py.
+    """
+
+    def __init__(self, max_users: int = MAX_INDEXED_USERS):
+        self.max_users = max_users
+        self._users: OrderedDict[int, UserIndex] = OrderedDict()
+        self._owners: dict[int, int] = {}
+        self._loading: dict[int, list[PendingLoad]] = {}
+
+    def is_loaded(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    @contextmanager
+    def loading(self, user_id: int) -> Iterator[PendingLoad]:
+        """
+        Record changes to a user's clothes from before their clothes are
+        read until the index is loaded, for load() to apply afterwards:
+        the read may miss them, and until then there is no index to apply
+        them to.
+        """
+        pending = PendingLoad()
+        loads = self._loading.setdefault(user_id, [])
+        loads.append(pending)
+        try:
+            yield pending
+        finally:
+            loads.remove(pending)
+            if not loads:
+                del self._loading[user_id]
+
+    def load(self, user_id: int, clothes: Iterable[dict], pending: Optional[PendingLoad] = None):
+        """Build the index for a user from all of their clothes, then apply changes recorded meanwhile."""
+        self._discard(user_id)
+
+        index = UserIndex()
+        for item in clothes:
+            index.add(dict(item, user_id=user_id))
+            self._owners[item["id"]] = user_id
+        self._users[user_id] = index
+
+        for kind, *args in pending.events if pending is not None else ():
+            if kind == "drop":
+                # Left for the next search to read again
+                self._discard(user_id)
+                return
+            if kind == "add":
+                self._add(*args)
+            elif args[0] in index.docs:
+                # Changes to other users' clothes are recorded too, since their owner is not known
+                getattr(self, "_" + kind)(*args)
+
+        while len(self._users) > self.max_users:
+            _, evicted = self._users.popitem(last=False)
+            self._forget(evicted)
+
+    def _record(self, user_id: Optional[int], *event):
+        """Record an event for loads under way for a user, or for every user if None."""
+        if user_id is not None:
+            loads = self._loading.get(user_id, ())
+        else:
+            loads = [pending for loads in self._loading.values() for pending in loads]
+        for pending in loads:
+            pending.events.append(event)
+
+    def drop_user(self, user_id: int):
+        self._record(user_id, "drop")
+        self._discard(user_id)
+
+    def _discard(self, user_id: int):
+        index = self._users.pop(user_id, None)
+        if index is not None:
+            self._forget(index)
+
+    def clear(self):
+        self._users.clear()
+        self._owners.clear()
+
+    def _forget(self, index: UserIndex):
+        for clothes_id in index.docs:
+            self._owners.pop(clothes_id, None)
+
+    def add(self, clothes: dict):
+        """Index a new or changed article of clothing if its owner is loaded."""
+        self._record(clothes["user_id"], "add", clothes)
+        self._add(clothes)
+
+    def _add(self, clothes: dict):
+        index = self._users.get(clothes["user_id"])
+        if index is None:
+            return
+        index.add(clothes)
+        self._owners[clothes["id"]] = clothes["user_id"]
+
+    def update(self, clothes_id: int, **changes):
+        """Apply changed columns to an indexed article of clothing."""
+        self._record(None, "update", clothes_id, changes)
+        self._update(clothes_id, changes)
+
+    def _update(self, clothes_id: int, changes: dict):
+        user_id = self._owners.get(clothes_id)
+        if user_id is None:
+            return
+        index = self._users[user_id]
+        updated = dict(index.docs[clothes_id])
+        updated.update({key: value for key, value in changes.items() if value})
+        index.add(updated)
+
+    def remove(self, clothes_id: int):
+        self._record(None, "remove", clothes_id)
+        self._remove(clothes_id)
+
+    def _remove(self, clothes_id: int):
+        user_id = self._owners.pop(clothes_id, None)
+        if user_id is None:
+            return
+        self._users[user_id].remove(clothes_id)
+
+    def search(self, user_id: int, query: str, limit: int = 20) -> list[dict]:
+        """
+        Search a loaded user's clothes.
+
+        Raises:
+            KeyError: if the user's index has not been loaded
+        """
+        index = self._users[user_id]
+        self._users.move_to_end(user_id)
+        return index.search(query, limit)
+
+
+clothes_index = ClothesIndex()
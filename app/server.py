@@ -0,0 +1,307 @@
+"""
+Run the app in production: a supervisor process preforks --workers
+uvicorn workers that share one listening socket.
+
+The app is imported once, in the supervisor, before forking, so workers
+start without importing anything and share those pages copy-on-write.
+The supervisor also sets the database up once; workers only load their
+caches from it. Workers run uvloop and httptools when installed.
+
+Each worker keeps its own in-memory caches, kept in step by events the
+supervisor relays between them (see cluster.py). Device key usage and
+/metrics remain per worker, and each worker enforces an equal share of
+the ingest rate limits.
+
+On SIGTERM or SIGINT workers stop accepting connections, finish requests
+in flight for up to --graceful-timeout seconds, write what they have
+queued and exit. A worker that exits on its own is replaced.
+
+Each worker's startup time and memory are logged once it is ready, and
+with --report written as JSON along with the supervisor's import time.
+
+On the shared port a request reaches whichever worker accepts it first,
+so a probe of /readyz says nothing about the others. With
+--worker-port-base each worker also listens on a port of its own, base
+plus its index, so a load balancer can treat workers as separate
+backends: probe each one's /readyz and send it traffic only while it
+is ready. A replaced worker takes over its predecessor's port.
+
+Usage:
+    python server.py --workers 4 --port 8000
+    python server.py --workers 4 --port 8000 --worker-port-base 8001
+    python server.py --workers 4 --report startup.json
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+import selectors
+import importlib.util
+
+from typing import Optional
+
+import uvicorn
+
+logger = logging.getLogger("server")
+
+# A worker this far behind on relayed events is replaced rather than buffered for
+MAX_OUTBOX_BYTES = 64 * 1024 * 1024
+# Extra time given to draining workers before they are killed
+KILL_GRACE_SECONDS = 10
+
+LOOP = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+HTTP = "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+
+def memory_usage(pid: int) -> dict:
+    """Resident and proportional set size of a process in MiB; PSS splits shared pages between their users."""
+    usage = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as file:
+            for line in file:
+                name, _, value = line.partition(":")
+                if name in ("Rss", "Pss"):
+                    usage[f"{name.lower()}_mib"] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        pass
+    return usage
+
+
+def bind(host: str, port: int, backlog: int) -> socket.socket:
+    """A listening socket workers inherit across fork."""
+    listener = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    listener.set_inheritable(True)
+    return listener
+
+
+class Worker:
+    def __init__(self, pid: int, index: int, channel: socket.socket):
+        self.pid = pid
+        self.index = index
+        self.channel = channel
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.startup_seconds: Optional[float] = None
+
+
+class Supervisor:
+    def __init__(self, app, args, listener: socket.socket, worker_listeners: list[socket.socket]):
+        self.app = app
+        self.args = args
+        self.listener = listener
+        self.worker_listeners = worker_listeners
+        self.selector = selectors.DefaultSelector()
+        self.workers: dict[int, Worker] = {}
+        self.stopping = False
+        self.reported = False
+
+    def spawn(self, index: int):
+        parent, child = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent.close()
+            self.selector.close()
+            for worker in self.workers.values():
+                worker.channel.close()
+            self.run_worker(child, index)
+
+        child.close()
+        parent.setblocking(False)
+        worker = self.workers[pid] = Worker(pid, index, parent)
+        self.selector.register(parent, selectors.EVENT_READ, worker)
+
+    def run_worker(self, channel: socket.socket, index: int):
+        """Serve the app in a freshly forked worker. Never returns."""
+        import cluster
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        cluster.attach(channel, self.args.workers)
+        config = uvicorn.Config(
+            self.app,
+            loop=LOOP,
+            http=HTTP,
+            lifespan="on",
+            log_level=self.args.log_level,
+            timeout_graceful_shutdown=self.args.graceful_timeout,
+        )
+        sockets = [self.listener]
+        if self.worker_listeners:
+            sockets.append(self.worker_listeners[index])
+        code = 0
+        try:
+            uvicorn.Server(config).run(sockets=sockets)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception("Worker failed")
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def remove(self, worker: Worker):
+        self.selector.unregister(worker.channel)
+        worker.channel.close()
+        del self.workers[worker.pid]
+
+    def read(self, worker: Worker):
+        try:
+            data = worker.channel.recv(1 << 16)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            return
+
+        worker.inbox += data
+        *lines, rest = worker.inbox.split(b"\n")
+        worker.inbox = bytearray(rest)
+        for line in lines:
+            if line.startswith(b'["ready"'):
+                _, fields = json.loads(line)
+                self.ready(worker, fields["startup_seconds"])
+                continue
+            for other in list(self.workers.values()):
+                if other is not worker:
+                    self.queue(other, bytes(line) + b"\n")
+
+    def queue(self, worker: Worker, data: bytes):
+        if len(worker.outbox) + len(data) > MAX_OUTBOX_BYTES:
+            logger.error(f"Worker {worker.pid} is not keeping up with events, replacing it")
+            os.kill(worker.pid, signal.SIGKILL)
+            return
+        if not worker.outbox:
+            self.selector.modify(worker.channel, selectors.EVENT_READ | selectors.EVENT_WRITE, worker)
+        worker.outbox += data
+
+    def write(self, worker: Worker):
+        try:
+            sent = worker.channel.send(worker.outbox)
+        except BlockingIOError:
+            return
+        except OSError:
+            worker.outbox.clear()
+            sent = 0
+        del worker.outbox[:sent]
+        if not worker.outbox:
+            self.selector.modify(worker.channel, selectors.EVENT_READ, worker)
+
+    def ready(self, worker: Worker, startup_seconds: float):
+        worker.startup_seconds = startup_seconds
+        logger.info(f"Worker {worker.pid} ready in {startup_seconds:.2f}s, memory {memory_usage(worker.pid)}")
+        if not self.reported and all(worker.startup_seconds is not None for worker in self.workers.values()):
+            self.reported = True
+            self.report()
+
+    def report(self):
+        report = {
+            "workers": len(self.workers),
+            "loop": LOOP,
+            "http": HTTP,
+            "preload_seconds": self.args.preload_seconds,
+            "supervisor": memory_usage(os.getpid()),
+            "per_worker": [
+                {"pid": worker.pid, "index": worker.index, "startup_seconds": worker.startup_seconds, **memory_usage(worker.pid)}
+                for worker in self.workers.values()
+            ],
+        }
+        logger.info(f"All {len(self.workers)} workers ready: {json.dumps(report)}")
+        if self.args.report:
+            with open(self.args.report, "w") as file:
+                json.dump(report, file, indent=2)
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.get(pid)
+            if worker is None:
+                continue
+            self.remove(worker)
+            if not self.stopping:
+                logger.warning(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, replacing it")
+                self.spawn(worker.index)
+
+    def stop(self, signum, frame):
+        if not self.stopping:
+            logger.info(f"Draining {len(self.workers)} workers")
+            self.stopping = True
+            self.stop_deadline = time.monotonic() + self.args.graceful_timeout + KILL_GRACE_SECONDS
+            for pid in self.workers:
+                os.kill(pid, signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.args.workers):
+            self.spawn(index)
+
+        while self.workers:
+            for key, events in self.selector.select(timeout=0.5):
+                worker = key.data
+                if worker.pid not in self.workers:
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.read(worker)
+                if events & selectors.EVENT_WRITE and worker.pid in self.workers:
+                    self.write(worker)
+            self.reap()
+
+            if self.stopping and time.monotonic() > self.stop_deadline:
+                for pid in self.workers:
+                    logger.error(f"Worker {pid} did not drain in time, killing it")
+                    os.kill(pid, signal.SIGKILL)
+                self.stop_deadline = float("inf")
+        logger.info("All workers stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))))
+    parser.add_argument("--graceful-timeout", type=float, default=30.0, help="Seconds workers get to finish requests on shutdown")
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--worker-port-base", type=int, help="Also serve worker i alone on this port plus i, for per-worker probes and routing")
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--report", help="Write startup time and memory per worker as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    listener = bind(args.host, args.port, args.backlog)
+    worker_listeners = []
+    if args.worker_port_base is not None:
+        worker_listeners = [bind(args.host, args.worker_port_base + index, args.backlog) for index in range(args.workers)]
+
+    # Preload: workers are forked with the app already imported
+    started = time.perf_counter()
+    from main import app, initialize_database
+    args.preload_seconds = round(time.perf_counter() - started, 3)
+
+    # Set the database up before any worker loads from it
+    asyncio.run(initialize_database())
+    import database
+    database.db_pool.clear()
+
+    logger.info(f"Imported the app in {args.preload_seconds}s, starting {args.workers} workers on {args.host}:{args.port} ({LOOP}, {HTTP})")
+    Supervisor(app, args, listener, worker_listeners).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,43 @@
 // Dashboard data loading and displaying
 
-const ws = new WebSocket('wss://' + location.host + '/ws');
+// Version of the /ws message protocol
+const PROTOCOL_VERSION = 1;
 
-loadWeatherData();
+const ws = new WebSocket('wss://' + location.host + '/ws');
 
-ws.addEventListener('open', (event) => {
+const wsOpen = new Promise(resolve => ws.addEventListener('open', (event) => {
   console.log('WebSocket connection established!');
-  loadSensors();
-});
+  resolve();
+}));
+
+loadDashboard();
 
 ws.onmessage = (event) => {
-  const data = JSON.parse(event.data);
-  console.log(data);
-  for (let sensor_id in data) {
-    if (data[sensor_id]) {
-      updateChartData(data[sensor_id], sensor_id);
-    }
+  const message = JSON.parse(event.data);
+  switch (message.type) {
+    case 'readings':
+      for (let sensor_id in message.readings) {
+        for (let reading of message.readings[sensor_id]) {
+          updateChartData(reading, sensor_id);
+        }
+      }
+      break;
+    case 'alerts':
+      showAlerts(message.alerts);
+      break;
+    case 'ping':
+      wsSend({ type: 'pong' });
+      break;
+    case 'error':
+      console.error('WebSocket error:', message.detail);
+      break;
   }
 }
 
+function wsSend(message) {
+  ws.send(JSON.stringify({ v: PROTOCOL_VERSION, ...message }));
+}
+
 ws.onerror = (event) => {
   console.error("WebSocket error:", event);
 };
@@ -38,82 +57,111 @@ document.getElementById('ai-prompt-button').addEventListener('click', (e) => {
 
 const charts = {};
 
+const maxAlerts = 20;
+
+function showAlerts(alerts) {
+  const alertsElement = document.getElementById('alerts');
+  for (let alert of alerts) {
+    const item = document.createElement('li');
+    item.textContent = `${alert.timestamp} sensor ${alert.sensor_id}: ${alert.kind} ${alert.threshold} (value ${alert.value.toFixed(2)})`;
+    alertsElement.prepend(item);
+  }
+  while (alertsElement.children.length > maxAlerts) {
+    alertsElement.lastChild.remove();
+  }
+}
+
 const maxDataPoints = 20;
 
 
 
-function loadSensors() {
+function loadDashboard() {
   sensorDataElement = document.getElementById("sensor-data");
+  weatherDataElement = document.getElementById("weather-data");
 
   sensorDataElement.innerHTML = 'Loading...';
+  weatherDataElement.innerHTML = 'Loading...';
 
-  fetch("/api/sensors")
+  fetch('/api/dashboard')
   .then(res => res.json())
-  .then(data => {
-    let sensorIds = [];
-
-    sensorDataElement.innerHTML = '';
-    for (let sensor of data) {
-      sensorIds.push(sensor.id);
-
-      sensorDataElement.innerHTML += `
-        <div class="sensor">
-          <div>Type: ${sensor.type}</div>
-          <div>Units: ${sensor.units}</div>
-          <div>Address: ${sensor.address}</div>
-          <div class="chart-container">
-            <canvas id="chart-${sensor.id}"></canvas>
-          <div>
-        </div>
-      `;
-      const ctx = document.getElementById(`chart-${sensor.id}`).getContext('2d');
-      const chart = new Chart(ctx, {
-        type: 'line',
-        data: {
-            labels: [],
-            datasets: [
-                {
-                    label: `(${sensor.type}) (${sensor.units})`,
-                    data: [],
-                    borderColor: '#2196f3',
-                    tension: 0.4
-                }
-            ]
-        },
-        options: {
-            responsive: true,
-            maintainAspectRatio: false,
-            interaction: {
-                intersect: false,
-                mode: 'index'
-            },
-            scales: {
-                y: {
-                    beginAtZero: false
-                }
-            }
-        }
-      });
-
-      charts[sensor.id] = chart;
-      console.log(sensorIds);
-      ws.send(JSON.stringify(sensorIds));
-    }
-
+  .then(dashboard => {
+    showWeather(dashboard.weather);
+    showSensors(dashboard.sensors);
   }).catch((e) => {
     console.error(e);
-    sensorDataElement.innerHTML += `
+    sensorDataElement.innerHTML = `
       <div>Failed to load sensor data<div>
     `;
   })
 }
 
+function showSensors(sensors) {
+  let sensorIds = [];
+  let after = {};
+
+  sensorDataElement.innerHTML = '';
+  for (let sensor of sensors) {
+    sensorIds.push(sensor.id);
+
+    sensorDataElement.innerHTML += `
+      <div class="sensor">
+        <div>Type: ${sensor.type}</div>
+        <div>Units: ${sensor.units}</div>
+        <div>Address: ${sensor.address}</div>
+        <div class="chart-container">
+          <canvas id="chart-${sensor.id}"></canvas>
+        <div>
+      </div>
+    `;
+  }
+
+  // Charts are created once all the markup is in place, since appending to innerHTML replaces earlier canvases
+  for (let sensor of sensors) {
+    const ctx = document.getElementById(`chart-${sensor.id}`).getContext('2d');
+    const chart = new Chart(ctx, {
+      type: 'line',
+      data: {
+          labels: [],
+          datasets: [
+              {
+                  label: `(${sensor.type}) (${sensor.units})`,
+                  data: [],
+                  borderColor: '#2196f3',
+                  tension: 0.4
+              }
+          ]
+      },
+      options: {
+          responsive: true,
+          maintainAspectRatio: false,
+          interaction: {
+              intersect: false,
+              mode: 'index'
+          },
+          scales: {
+              y: {
+                  beginAtZero: false
+              }
+          }
+      }
+    });
+
+    charts[sensor.id] = chart;
+    for (let reading of sensor.recent) {
+      updateChartData(reading, sensor.id);
+    }
+    if (sensor.latest) {
+      after[sensor.id] = { timestamp: sensor.latest.timestamp, seq: sensor.latest.seq };
+    }
+  }
+
+  // Only ask for the readings the dashboard did not already include
+  wsOpen.then(() => wsSend({ type: 'subscribe', sensors: sensorIds, after: after }));
+}
+
 function updateChartData(data, sensor_id) {
   const chart = charts[sensor_id];
   const parsed_timestamp = data.timestamp.split(' ')[1]
-  if (chart.data.labels.at(-1) == parsed_timestamp) {
-    return;
-  }
   chart.data.labels.push(parsed_timestamp);
   
   // Remove old data points if we exceed maxDataPoints
@@ -129,47 +177,16 @@ function updateChartData(data, sensor_id) {
   chart.update();
 }
 
-function loadWeatherData() {
-  weatherDataElement = document.getElementById("weather-data");
-
-  weatherDataElement.innerHTML = 'Loading...';
+function showWeather(weatherData) {
+  if (!weatherData) {
+    weatherDataElement.innerHTML = 'Weather unavailable';
+    return;
+  }
 
-  fetchWeather().then(weatherData => {
-    weatherDataElement.innerHTML = `
-        <h3>Location: ${weatherData.location}</h3>
-        <span>Condition: ${weatherData.condition}</span>
-        <span>Temperature: ${weatherData.temperature} °F</span>
-        <img src=${weatherData.iconUrl} width="50px" height="50px">
-    `;
-  });
+  weatherDataElement.innerHTML = `
+      <h3>Location: ${weatherData.location}</h3>
+      <span>Condition: ${weatherData.condition}</span>
+      <span>Temperature: ${weatherData.temperature} °F</span>
+      <img src=${weatherData.iconUrl} width="50px" height="50px">
+  `;
 }
-
-async function fetchWeather() {
-  const userLocation = await fetch('/api/user').then(res => res.json()).then(user => user.location);
-
-  const location = await fetch(`https://nominatim.openstreetmap.org/search?q=${userLocation.replace(' ', '%20')}&format=json`)
-    .then(res => res.json())
-    .then(locations => {
-      if (!locations || locations.length == 0) {
-        return;
-      }
-
-      return locations[0];
-    });
-
-  const data = await fetch(`https://api.weather.gov/points/${location.lat},${location.lon}`)
-    .then(res => res.json());
-
-  const forecastUrl = data.properties.forecast;
-
-  const currentForecast = await fetch(forecastUrl)
-  .then(res => res.json())
-  .then(forecast => forecast.properties.periods[0]);
-
-  return {
-    location: location.name,
-    condition: currentForecast.shortForecast,
-    temperature: currentForecast.temperature,
-    iconUrl: currentForecast.icon
-  };
-}
\ No newline at end of file
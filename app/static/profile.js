@@ -1,3 +1,6 @@
+const pageSize = 50;
+let nextCursor = null;
+
 loadSensors();
 
 document.getElementById('add-sensor-form').addEventListener('submit', (e) => {
@@ -23,16 +26,25 @@ document.getElementById('add-sensor-form').addEventListener('submit', (e) => {
   })
 });
 
-function loadSensors() {
+function loadSensors(after = null) {
   sensorDataElement = document.getElementById("sensor-data");
 
-  sensorDataElement.innerHTML = 'Loading...';
+  if (after === null) {
+    sensorDataElement.innerHTML = 'Loading...';
+  }
+
+  const params = new URLSearchParams({ limit: pageSize });
+  if (after !== null) {
+    params.set('after', after);
+  }
 
-  fetch("/api/sensors")
+  fetch(`/api/sensors?${params}`)
   .then(res => res.json())
-  .then(data => {
-    sensorDataElement.innerHTML = '';
-    for (let sensor of data) {
+  .then(page => {
+    if (after === null) {
+      sensorDataElement.innerHTML = '';
+    }
+    for (let sensor of page.items) {
       sensorDataElement.innerHTML += `
         <div class="sensor">
           <div>Type: ${sensor.type}</div>
@@ -63,6 +75,9 @@ function loadSensors() {
         </div>
       `;
     }
+
+    nextCursor = page.next;
+    document.getElementById('load-more-sensors').classList.toggle('hidden', nextCursor === null);
   }).catch(() => {
     sensorDataElement.innerHTML += `
       <div>Failed to load sensor data<div>
@@ -1,12 +1,49 @@
+const pageSize = 50;
+let nextCursor = null;
+
 loadWardrobe();
 
-document.getElementById('add-clothes-form').addEventListener('submit', (e) => {
+let searchTimeout = null;
+// Incremented per search so responses to earlier queries are ignored
+let latestSearch = 0;
+
+document.getElementById('clothes-search').addEventListener('input', (e) => {
+  clearTimeout(searchTimeout);
+  searchTimeout = setTimeout(() => searchWardrobe(e.target.value), 200);
+});
+
+document.getElementById('add-clothes-form').addEventListener('submit', async (e) => {
   e.preventDefault();
+  showAddError(null);
+
+  let imageAddress = document.getElementById('new-clothes-image-address').value;
+
+  const imageFile = document.getElementById('new-clothes-image-file').files[0];
+  if (imageFile) {
+    const formData = new FormData();
+    formData.append('file', imageFile);
+
+    let uploadResponse;
+    try {
+      uploadResponse = await fetch("/api/clothes/images", {
+        method: "POST",
+        body: formData
+      });
+    } catch (error) {
+      showAddError(`Image upload failed: ${error.message}`);
+      return;
+    }
+    if (!uploadResponse.ok) {
+      showAddError(`Image upload failed: ${await errorDetail(uploadResponse)}`);
+      return;
+    }
+    imageAddress = (await uploadResponse.json()).image_address;
+  }
 
   const requestBody = {
     name: document.getElementById('new-clothes-name').value,
     type: document.getElementById('new-clothes-type').value,
-    image_address: document.getElementById('new-clothes-image-address').value
+    image_address: imageAddress
   }
 
   fetch("/api/clothes", {
@@ -16,70 +53,141 @@ document.getElementById('add-clothes-form').addEventListener('submit', (e) => {
     },
     body: JSON.stringify(requestBody)
   })
-  .then(response => {
+  .then(async response => {
     if (response.ok) {
       loadWardrobe();
+    } else {
+      showAddError(`Could not add clothes: ${await errorDetail(response)}`);
     }
   })
 });
 
-function loadWardrobe() {
-  wardrobeElement = document.getElementById("wardrobe-data");
+// The server's reason for an error response, which is JSON with a detail string for most errors
+async function errorDetail(response) {
+  try {
+    const body = await response.json();
+    if (typeof body.detail === 'string') {
+      return body.detail;
+    }
+  } catch (error) {
+    // Not JSON, such as a proxy's error page
+  }
+  return `${response.status} ${response.statusText}`;
+}
 
-  wardrobeElement.innerHTML = 'Loading...';
+function showAddError(message) {
+  const errorElement = document.getElementById('add-clothes-error');
+  errorElement.textContent = message || '';
+  errorElement.classList.toggle('hidden', !message);
+}
 
-  fetch("/api/clothes")
-  .then(res => res.json())
-  .then(data => {
-    wardrobeElement.innerHTML = '';
-    for (let clothing of data) {
-      wardrobeElement.innerHTML += `
-        <div class="clothing">
-          <div>Name: ${clothing.name}</div>
-          <div>Type: ${clothing.type}</div>
-          <div><img src="${clothing.image_address}" width="240px" title="${clothing.name}"></div>
-          <div id="edit-clothes-${clothing.id}" class="hidden">
-                <h3>Edit Clothes</h3>
-                <form class="edit-form">
-                    <input type="text" id="edit-clothes-name-${clothing.id}" placeholder="Name" value="${clothing.name}">                    
-                    <input type="text" id="edit-clothes-type-${clothing.id}" placeholder="Type" value="${clothing.type}">
-                    <input type="text" id="edit-clothes-image-address-${clothing.id}" placeholder="Image Address" value="${clothing.image_address}">
-                    <button type="button" id="submit-edit-clothes-${clothing.id}"
-                    onclick="
-                      editClothes(
-                        ${clothing.id},
-                        document.getElementById('edit-clothes-name-${clothing.id}').value,
-                        document.getElementById('edit-clothes-type-${clothing.id}').value,
-                        document.getElementById('edit-clothes-image-address-${clothing.id}').value
-                      )
-                    ">Submit</button>
-                </form>
-            </div>
-          <button type="button" class="edit-button" onclick="toggleVisibility('edit-clothes-${clothing.id}')">Edit</button>
-          <button type="button" class="delete-button" onclick="removeClothes(${clothing.id})">
-            <img src="/static/delete.svg" width="15px" title="delete">
-          </button>
-        </div>
-      `;
+function loadWardrobe(after = null) {
+  wardrobeElement = document.getElementById("wardrobe-data");
 
-      document.getElementById(`submit-edit-clothes-${clothing.id}`).addEventListener('submit', (e) => {
-        e.preventDefault();
+  if (after === null) {
+    wardrobeElement.innerHTML = 'Loading...';
+  }
 
-        editClothes(
-          clothing.id,
-          document.getElementById(`edit-clothes-name-${clothing.id}`).value,
-          document.getElementById(`edit-clothes-type-${clothing.id}`).value,
-          document.getElementById(`edit-clothes-image-address-${clothing.id}`).value
-        )
-      });
+  const params = new URLSearchParams({ limit: pageSize });
+  if (after !== null) {
+    params.set('after', after);
+  }
+
+  fetch(`/api/clothes?${params}`)
+  .then(res => res.json())
+  .then(page => {
+    if (after === null) {
+      wardrobeElement.innerHTML = '';
     }
+    for (let clothing of page.items) {
+      renderClothing(clothing);
+    }
+
+    nextCursor = page.next;
+    document.getElementById('load-more-clothes').classList.toggle('hidden', nextCursor === null);
   }).catch(() => {
-    sensorDataElement.innerHTML += `
+    wardrobeElement.innerHTML += `
       <div>Failed to load sensor data<div>
     `;
   })
 }
 
+function searchWardrobe(query) {
+  wardrobeElement = document.getElementById("wardrobe-data");
+  const search = ++latestSearch;
+
+  if (!query.trim()) {
+    loadWardrobe();
+    return;
+  }
+
+  fetch(`/api/clothes/search?${new URLSearchParams({ q: query })}`)
+  .then(res => res.json())
+  .then(page => {
+    if (search !== latestSearch) {
+      return;
+    }
+    wardrobeElement.innerHTML = '';
+    for (let clothing of page.items) {
+      renderClothing(clothing);
+    }
+
+    document.getElementById('load-more-clothes').classList.add('hidden');
+  });
+}
+
+// Uploaded images are content addressed and have pre-generated WebP thumbnails
+function thumbnailSources(imageAddress) {
+  const match = /^\/images\/([0-9a-f]{64})\.\w+$/.exec(imageAddress || '');
+  if (!match) {
+    return `src="${imageAddress}"`;
+  }
+
+  return `src="/images/${match[1]}/240.webp" srcset="/images/${match[1]}/240.webp 1x, /images/${match[1]}/480.webp 2x"`;
+}
+
+function renderClothing(clothing) {
+  wardrobeElement.innerHTML += `
+    <div class="clothing">
+      <div>Name: ${clothing.name}</div>
+      <div>Type: ${clothing.type}</div>
+      <div><img ${thumbnailSources(clothing.image_address)} width="240px" loading="lazy" title="${clothing.name}"></div>
+      <div id="edit-clothes-${clothing.id}" class="hidden">
+            <h3>Edit Clothes</h3>
+            <form class="edit-form">
+                <input type="text" id="edit-clothes-name-${clothing.id}" placeholder="Name" value="${clothing.name}">                    
+                <input type="text" id="edit-clothes-type-${clothing.id}" placeholder="Type" value="${clothing.type}">
+                <input type="text" id="edit-clothes-image-address-${clothing.id}" placeholder="Image Address" value="${clothing.image_address}">
+                <button type="button" id="submit-edit-clothes-${clothing.id}"
+                onclick="
+                  editClothes(
+                    ${clothing.id},
+                    document.getElementById('edit-clothes-name-${clothing.id}').value,
+                    document.getElementById('edit-clothes-type-${clothing.id}').value,
+                    document.getElementById('edit-clothes-image-address-${clothing.id}').value
+                  )
+                ">Submit</button>
+            </form>
+        </div>
+      <button type="button" class="edit-button" onclick="toggleVisibility('edit-clothes-${clothing.id}')">Edit</button>
+      <button type="button" class="delete-button" onclick="removeClothes(${clothing.id})">
+        <img src="/static/delete.svg" width="15px" title="delete">
+      </button>
+    </div>
+  `;
+
+  document.getElementById(`submit-edit-clothes-${clothing.id}`).addEventListener('submit', (e) => {
+    e.preventDefault();
+
+    editClothes(
+      clothing.id,
+      document.getElementById(`edit-clothes-name-${clothing.id}`).value,
+      document.getElementById(`edit-clothes-type-${clothing.id}`).value,
+      document.getElementById(`edit-clothes-image-address-${clothing.id}`).value
+    )
+  });
+}
+
 function removeClothes(id) {
   fetch(`/api/clothes/${id}`, {
     method: 'DELETE',
@@ -0,0 +1,87 @@
+import os
+import time
+import asyncio
+import logging
+
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# How long a location's forecast is served from memory before it is looked up again
+WEATHER_CACHE_SECONDS = float(os.getenv("WEATHER_CACHE_SECONDS", "900"))
+# Failed lookups are not retried for this long, so an outage does not cost every page load
+WEATHER_FAILURE_SECONDS = 60
+WEATHER_TIMEOUT_SECONDS = 10
+# Locations held at once; the least recently used are evicted beyond this
+WEATHER_CACHE_MAX = int(os.getenv("WEATHER_CACHE_MAX", "1000"))
+
+USER_AGENT = "wardrobify-ece140a"
+
+# location -> (monotonic expiry, forecast or None if the lookup failed), least recently used first
+_cache: "OrderedDict[str, tuple[float, Optional[dict]]]" = OrderedDict()
+# Lookups under way, so concurrent requests for a location share one
+_pending: dict[str, asyncio.Future] = {}
+
+
+def _lookup(location: str) -> dict:
+    """Geocode a location and fetch its current forecast. Blocks on the network."""
+    # Slow to import and only needed here, so left out of startup
+    import requests
+    from geopy.geocoders import Nominatim
+
+    place = Nominatim(user_agent=USER_AGENT, timeout=WEATHER_TIMEOUT_SECONDS).geocode(location)
+    if place is None:
+        raise LookupError(f"Unknown location {location!r}")
+
+    headers = {"User-Agent": USER_AGENT}
+    points = requests.get(f"https://api.weather.gov/points/{place.latitude},{place.longitude}", headers=headers, timeout=WEATHER_TIMEOUT_SECONDS)
+    points.raise_for_status()
+    forecast = requests.get(points.json()["properties"]["forecast"], headers=headers, timeout=WEATHER_TIMEOUT_SECONDS)
+    forecast.raise_for_status()
+    current = forecast.json()["properties"]["periods"][0]
+
+    return {
+        "location": place.address,
+        "condition": current.get("shortForecast"),
+        "temperature": current.get("temperature"),
+        "iconUrl": current.get("icon"),
+    }
+
+
+async def get_weather(location: Optional[str]) -> Optional[dict]:
+    """
+    The current forecast for a location, cached for WEATHER_CACHE_SECONDS.
+
+    Returns:
+        Optional[dict]: location, condition, temperature (F) and iconUrl,
+                        or None if the location is unknown or the lookup failed
+    """
+    if not location:
+        return None
+
+    cached = _cache.get(location)
+    if cached is not None and cached[0] > time.monotonic():
+        _cache.move_to_end(location)
+        return cached[1]
+
+    pending = _pending.get(location)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    future = _pending[location] = asyncio.get_running_loop().create_future()
+    weather, ttl = None, WEATHER_FAILURE_SECONDS
+    try:
+        weather = await asyncio.to_thread(_lookup, location)
+        ttl = WEATHER_CACHE_SECONDS
+    except Exception as e:
+        logger.warning(f"Weather lookup for {location!r} failed: {e}")
+    finally:
+        del _pending[location]
+        future.set_result(weather)
+
+    _cache[location] = (time.monotonic() + ttl, weather)
+    _cache.move_to_end(location)
+    while len(_cache) > WEATHER_CACHE_MAX:
+        _cache.popitem(last=False)
+    return weather
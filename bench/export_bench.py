@@ -0,0 +1,219 @@
+"""
+Benchmark the sensor history export.
+
+Seeds a sensor with --rows readings, then streams them back through
+database.iter_data_by_sensor_id into each encoder in app/export.py, the
+same way GET /api/sensors/{id}/export does. Reports read and encode
+throughput, and peak RSS both after reading every row on its own and
+after the full export. Each format runs in its own process so peak
+memory is measured independently.
+
+--source picks where the rows come from:
+
+  * standin (default): the SQLite stand-in (see bench/standin.py). SQLite
+    cursors always stream, so this only checks that the app side of the
+    export, chunked fetching and encoding, keeps memory flat.
+  * mysql: the server from bench/docker-compose.yml, or the usual MYSQL_*
+    environment variables. Only this shows whether the unbuffered cursor
+    keeps the client from holding the whole result. Seeding recreates the
+    app's tables, so never point it at a database you want to keep.
+  * synthetic: generated chunks straight into the encoders, leaving the
+    database out entirely.
+
+Usage:
+    python bench/export_bench.py --rows 10000000
+    python bench/export_bench.py --rows 10000000 --format parquet --output results.json
+    docker compose -f bench/docker-compose.yml up -d
+    python bench/export_bench.py --rows 10000000 --source mysql
+    python bench/export_bench.py --rows 10000000 --source synthetic
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from datetime import datetime, timedelta
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from export import ENCODERS, EXPORT_CHUNK_ROWS
+
+# Readings are written to the stand-in in batches of this many
+SEED_BATCH_ROWS = 50_000
+
+
+def synthetic_chunks(rows: int, chunk_size: int):
+    """Yield rows in database sized chunks without ever holding more than one."""
+    timestamp = datetime(2025, 1, 1)
+    step = timedelta(seconds=5)
+    value = 20.0
+    produced = 0
+    while produced < rows:
+        size = min(chunk_size, rows - produced)
+        chunk = []
+        for _ in range(size):
+            value += random.gauss(0, 0.05)
+            chunk.append((timestamp, value))
+            timestamp += step
+        produced += size
+        yield chunk
+
+
+def peak_rss_megabytes() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def use_database(source: str, path: Optional[str]):
+    """
+    Point the app's database module at the stand-in file at `path`, or at
+    MySQL, and return it.
+    """
+    if source == "mysql":
+        from serve import MYSQL_DEFAULTS
+        for name, value in MYSQL_DEFAULTS.items():
+            os.environ.setdefault(name, value)
+
+    import database
+
+    if source == "standin":
+        import standin
+        standin.install(path)
+    return database
+
+
+def seed(source: str, path: Optional[str], rows: int) -> int:
+    """
+    Create the schema and give one sensor `rows` readings through the
+    app's own accessors.
+
+    Returns:
+        int: ID of the seeded sensor
+    """
+    database = use_database(source, path)
+
+    async def seed_sensor() -> int:
+        await database.setup_database([("bench", "bench", "bench@example.com", "San Diego")])
+        sensor_id = await database.add_sensor(1, "Temperature", "Celsius", "00:00:00:00:00:01")
+        for chunk in synthetic_chunks(rows, SEED_BATCH_ROWS):
+            await database.add_data_batch([(sensor_id, value, timestamp, None) for timestamp, value in chunk])
+        return sensor_id
+
+    return asyncio.run(seed_sensor())
+
+
+def run_format(format: str, rows: int, chunk_size: int, source: str, path: Optional[str], sensor_id: Optional[int]) -> dict:
+    """Export `rows` readings of a seeded sensor as `format`, or generated ones with --source synthetic."""
+    if source == "synthetic":
+        chunks = lambda: synthetic_chunks(rows, chunk_size)
+    else:
+        database = use_database(source, path)
+        chunks = lambda: database.iter_data_by_sensor_id(sensor_id, chunk_size=chunk_size)
+
+    # Time reading separately so it can be subtracted from encoding
+    started = time.perf_counter()
+    read_rows = 0
+    for chunk in chunks():
+        read_rows += len(chunk)
+    read_seconds = max(time.perf_counter() - started, 1e-9)
+    read_peak_rss = peak_rss_megabytes()
+    if read_rows != rows:
+        raise RuntimeError(f"Expected {rows} rows, read {read_rows}")
+
+    output_bytes = 0
+    started = time.perf_counter()
+    for data in ENCODERS[format](chunks()):
+        output_bytes += len(data)
+    total_seconds = time.perf_counter() - started
+    encode_seconds = max(total_seconds - read_seconds, 1e-9)
+
+    return {
+        "format": format,
+        "source": source,
+        "rows": rows,
+        "chunk_rows": chunk_size,
+        "output_bytes": output_bytes,
+        "read_seconds": round(read_seconds, 3),
+        "read_rows_per_second": round(rows / read_seconds),
+        "read_peak_rss_megabytes": read_peak_rss,
+        "encode_seconds": round(encode_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "rows_per_second": round(rows / encode_seconds),
+        "megabytes_per_second": round(output_bytes / encode_seconds / 1e6, 2),
+        "peak_rss_megabytes": peak_rss_megabytes(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--chunk-rows", type=int, default=EXPORT_CHUNK_ROWS)
+    parser.add_argument("--format", choices=sorted(ENCODERS), help="Run a single format in this process")
+    parser.add_argument("--source", choices=("standin", "mysql", "synthetic"), default="standin")
+    parser.add_argument("--database", help="Stand-in database file to use, a temporary one if not given")
+    parser.add_argument("--sensor-id", type=int, help="Read this already seeded sensor instead of seeding one")
+    parser.add_argument("--seed-only", action="store_true", help="Only seed, printing the sensor ID")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    database_path, sensor_id = args.database, args.sensor_id
+    if args.source == "standin" and database_path is None:
+        database_path = os.path.join(tempfile.mkdtemp(prefix="wardrobify-export-"), "bench.sqlite3")
+
+    if args.seed_only:
+        print(seed(args.source, database_path, args.rows))
+        return
+
+    if args.source != "synthetic" and sensor_id is None:
+        started = time.perf_counter()
+        if args.format:
+            sensor_id = seed(args.source, database_path, args.rows)
+        else:
+            # Seeded in a child so it does not count towards this process's memory
+            command = [sys.executable, __file__, "--rows", str(args.rows), "--source", args.source, "--seed-only"]
+            if database_path is not None:
+                command += ["--database", database_path]
+            completed = subprocess.run(command, check=True, capture_output=True, text=True)
+            sensor_id = int(completed.stdout.split()[-1])
+        print(f"Seeded {args.rows:,} rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    if args.format:
+        results = [run_format(args.format, args.rows, args.chunk_rows, args.source, database_path, sensor_id)]
+    else:
+        results = []
+        for format in sorted(ENCODERS):
+            command = [sys.executable, __file__, "--rows", str(args.rows), "--chunk-rows", str(args.chunk_rows),
+                       "--format", format, "--source", args.source]
+            if sensor_id is not None:
+                command += ["--sensor-id", str(sensor_id)]
+            if database_path is not None:
+                command += ["--database", database_path]
+            completed = subprocess.run(command, check=True, capture_output=True, text=True)
+            results.append(json.loads(completed.stdout))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.format:
+        print(json.dumps(results[0]))
+    else:
+        for result in results:
+            print(
+                f"{result['format']:>8}: read {result['read_rows_per_second']:>10,} rows/s  "
+                f"peak RSS {result['read_peak_rss_megabytes']} MB  |  encode "
+                f"{result['rows_per_second']:>10,} rows/s  "
+                f"{result['megabytes_per_second']:>7} MB/s  "
+                f"{result['output_bytes'] / 1e6:>8.1f} MB out  "
+                f"peak RSS {result['peak_rss_megabytes']} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""
+Simulate a fleet of ESP32 sensor boards publishing over MQTT.
+
+Each virtual device has an Espressif MAC address and a temperature and a
+pressure sensor that drift slowly with gaussian noise. Every --period
+seconds it publishes `{"value": ..., "timestamp": ..., "seq": ...}` to
+<BASE_TOPIC>/<MAC>/temperature|pressure like IOT/src/main.cpp does, or
+with --payload binary one frame holding both readings to
+<BASE_TOPIC>/<MAC>/frames (see mqtt/frames.py). Devices share a small
+pool of MQTT connections, since the topic rather than the connection
+identifies the device to the bridge.
+
+--burstiness controls how publishes are spread over a period: 0 gives
+every device a random phase (smooth load), 1 has every device publish at
+the same instant (e.g. a fleet reconnecting after a broker restart).
+
+With --app-url, a sample of --probe-devices devices is registered as
+sensors in the app, and end-to-end latency from publish until the
+reading is visible is measured either through /ws pushes (--observe ws)
+or by polling get_recent_data directly (--observe db, needs the MYSQL_*
+environment). The MQTT bridge (mqtt/mqtt.py) must be running against the
+same broker and app.
+
+Usage:
+    docker compose -f bench/docker-compose.yml up -d
+    MQTT_BROKER=127.0.0.1 BASE_TOPIC=sim/fleet/v1 DATA_URL=http://127.0.0.1:8765/api/data python mqtt/mqtt.py
+    python bench/fleet_sim.py --devices 20000 --period 5 --duration 60 \\
+        --broker 127.0.0.1 --base-topic sim/fleet/v1 --app-url http://127.0.0.1:8765
+"""
+import os
+import sys
+import json
+import heapq
+import random
+import asyncio
+import argparse
+import threading
+import time
+
+from collections import Counter, deque
+
+import paho.mqtt.client as mqtt
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, "..", "app")
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "mqtt"))
+
+from querylog import percentile
+from frames import encode_frame
+
+# Organizationally unique identifiers assigned to Espressif
+ESPRESSIF_OUIS = (
+    "24:0A:C4", "24:6F:28", "30:AE:A4", "3C:71:BF", "7C:9E:BD",
+    "8C:4F:00", "A4:CF:12", "C4:4F:33", "E8:DB:84", "FC:F5:C4",
+)
+
+# (subtopic, app sensor type, units, typical value, spread between devices, drift per reading, noise, decimals)
+SENSORS = (
+    ("temperature", "Temperature", "Celsius", 21.0, 3.0, 0.02, 0.05, 2),
+    ("pressure", "Pressure", "Pascals", 101325.0, 400.0, 2.0, 5.0, 1),
+)
+
+
+def mac_addresses(count: int, rng: random.Random) -> list[str]:
+    """Unique, realistic ESP32 station MAC addresses."""
+    addresses = set()
+    while len(addresses) < count:
+        suffix = rng.getrandbits(24)
+        addresses.add(f"{rng.choice(ESPRESSIF_OUIS)}:{suffix >> 16:02X}:{(suffix >> 8) & 0xFF:02X}:{suffix & 0xFF:02X}")
+    return sorted(addresses)
+
+
+class VirtualSensor:
+    """A slowly drifting, noisy reading from one sensor on one device."""
+    __slots__ = ("subtopic", "type", "level", "drift", "noise", "step", "decimals", "last")
+
+    def __init__(self, spec: tuple, rng: random.Random):
+        subtopic, type, _, typical, spread, drift, noise, decimals = spec
+        self.subtopic = subtopic
+        self.type = type
+        self.level = rng.gauss(typical, spread)
+        self.drift = drift
+        self.noise = noise
+        self.decimals = decimals
+        self.step = 10 ** -decimals
+        self.last = None
+
+    def read(self, rng: random.Random) -> float:
+        self.level += rng.gauss(0, self.drift)
+        value = round(self.level + rng.gauss(0, self.noise), self.decimals)
+        # Consecutive readings always differ so a probe can tell them apart
+        if self.last is not None and abs(value - self.last) < self.step:
+            value = round(self.last + self.step, self.decimals)
+        self.last = value
+        return value
+
+
+class Device:
+    __slots__ = ("address", "sensors", "probe", "seq")
+
+    def __init__(self, address: str, rng: random.Random):
+        self.address = address
+        self.sensors = [VirtualSensor(spec, rng) for spec in SENSORS]
+        self.probe = False
+        self.seq = 0
+
+
+class LatencyProbe:
+    """
+    Publish times of readings from probe sensors, matched against the
+    values later seen through the app.
+
+    A reading overwritten by a newer one before it was observed counts as
+    superseded rather than as a latency sample.
+    """
+
+    def __init__(self):
+        self.pending: dict[tuple[str, str], deque] = {}
+        self.sensor_ids: dict[tuple[str, str], int] = {}
+        self.keys: dict[int, tuple[str, str]] = {}
+        self.latencies: list[float] = []
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def add_sensor(self, address: str, subtopic: str, sensor_id: int):
+        self.sensor_ids[(address, subtopic)] = sensor_id
+        self.keys[sensor_id] = (address, subtopic)
+        self.pending[(address, subtopic)] = deque()
+
+    def published(self, address: str, subtopic: str, value: float, at: float):
+        pending = self.pending.get((address, subtopic))
+        if pending is not None:
+            with self.lock:
+                pending.append((value, at))
+
+    def observed(self, key: tuple[str, str], value: float, at: float):
+        pending = self.pending.get(key)
+        if not pending:
+            return
+        # Stored values are single precision, so match approximately
+        tolerance = max(1e-4, abs(value) * 2e-7)
+        with self.lock:
+            for index, (published_value, published_at) in enumerate(pending):
+                if abs(published_value - value) <= tolerance:
+                    self.latencies.append(at - published_at)
+                    self.counts["observed"] += 1
+                    self.counts["superseded"] += index
+                    for _ in range(index + 1):
+                        pending.popleft()
+                    return
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "observed": self.counts["observed"],
+            "superseded": self.counts["superseded"],
+            "unobserved": sum(len(pending) for pending in self.pending.values()),
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+            "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        }
+
+
+class Publisher:
+    """A pool of MQTT connections publishing round robin."""
+
+    def __init__(self, broker: str, port: int, connections: int, qos: int):
+        self.qos = qos
+        self.clients = []
+        self.counts = Counter()
+        self._next = 0
+        for index in range(connections):
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"fleet-sim-{os.getpid()}-{index}")
+            client.max_queued_messages_set(0)
+            client.connect(broker, port, 60)
+            client.loop_start()
+            self.clients.append(client)
+
+    def publish(self, topic: str, payload: str):
+        client = self.clients[self._next]
+        self._next = (self._next + 1) % len(self.clients)
+        info = client.publish(topic, payload, qos=self.qos)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.counts["published"] += 1
+        else:
+            self.counts[f"error_{info.rc}"] += 1
+
+    def close(self):
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+
+
+def run_fleet(
+    devices: list[Device],
+    publisher: Publisher,
+    probe: LatencyProbe,
+    base_topic: str,
+    period: float,
+    burstiness: float,
+    jitter: float,
+    duration: float,
+    seed: int,
+    binary: bool,
+    duplicates: float,
+    stop: threading.Event,
+):
+    """
+    Publish every device's readings on schedule until the duration is up.
+
+    A single heap of due times drives the whole fleet, so tens of
+    thousands of devices cost one thread rather than one each.
+    """
+    rng = random.Random(seed)
+    started = time.monotonic()
+    deadline = started + duration
+
+    schedule = []
+    for index in range(len(devices)):
+        phase = 0.0 if rng.random() < burstiness else rng.uniform(0, period)
+        schedule.append((started + phase, index))
+    heapq.heapify(schedule)
+
+    while schedule and not stop.is_set():
+        due, index = schedule[0]
+        if due >= deadline:
+            break
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(min(delay, 0.05))
+            continue
+
+        heapq.heappop(schedule)
+        device = devices[index]
+        readings = [(sensor, sensor.read(rng)) for sensor in device.sensors]
+        timestamp = int(time.time())
+        device.seq += 1
+        if binary:
+            # Every sensor on the board in one frame
+            messages = [(
+                f"{base_topic}/{device.address}/frames",
+                encode_frame((sensor.type, timestamp, value, device.seq) for sensor, value in readings),
+            )]
+        else:
+            messages = [
+                (
+                    f"{base_topic}/{device.address}/{sensor.subtopic}",
+                    json.dumps({"value": value, "timestamp": timestamp, "seq": device.seq}),
+                )
+                for sensor, value in readings
+            ]
+
+        published_at = time.monotonic()
+        for topic, payload in messages:
+            publisher.publish(topic, payload)
+            # A delivery retried after a lost acknowledgement
+            if duplicates and rng.random() < duplicates:
+                publisher.publish(topic, payload)
+        if device.probe:
+            for sensor, value in readings:
+                probe.published(device.address, sensor.subtopic, value, published_at)
+
+        next_due = due + period + (rng.gauss(0, jitter) if jitter else 0.0)
+        heapq.heappush(schedule, (max(next_due, due + period / 10), index))
+
+
+async def provision(app_url: str, devices: list[Device], probe: LatencyProbe, username: str):
+    """Sign up a user and register each probe device's sensors to it."""
+    import httpx
+
+    client = httpx.AsyncClient(base_url=app_url, timeout=30)
+    response = await client.post("/signup", json={
+        "username": username, "password": "fleet-sim", "email": f"{username}@bench.invalid", "location": "San Diego",
+    })
+    if response.status_code != 302:
+        raise RuntimeError(f"Signup failed: {response.status_code} {response.text}")
+
+    for device in devices:
+        for subtopic, type, units, *_ in SENSORS:
+            response = await client.post("/api/sensors", json={"type": type, "units": units, "address": device.address})
+            response.raise_for_status()
+
+    after = None
+    while True:
+        params = {"limit": 500, **({"after": after} if after else {})}
+        page = (await client.get("/api/sensors", params=params)).json()
+        for sensor in page["items"]:
+            subtopic = next(spec[0] for spec in SENSORS if spec[1] == sensor["type"])
+            probe.add_sensor(sensor["address"], subtopic, sensor["id"])
+        after = page["next"]
+        if after is None:
+            break
+    for device in devices:
+        device.probe = True
+    return client
+
+
+async def observe_ws(app_url: str, cookies, probe: LatencyProbe, deadline: float):
+    import websockets
+
+    headers = {"Cookie": "; ".join(f"{name}={value}" for name, value in cookies.items())}
+    async with websockets.connect(app_url.replace("http", "ws", 1) + "/ws", additional_headers=headers) as websocket:
+        await websocket.send(json.dumps({"v": 1, "type": "subscribe", "sensors": list(probe.sensor_ids.values())}))
+        while time.monotonic() < deadline:
+            try:
+                message = json.loads(await asyncio.wait_for(websocket.recv(), deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+            received_at = time.monotonic()
+            if message["type"] == "ping":
+                await websocket.send(json.dumps({"v": 1, "type": "pong"}))
+            if message["type"] != "readings":
+                continue
+            for sensor_id, readings in message["readings"].items():
+                key = probe.keys.get(int(sensor_id))
+                for reading in readings if key else ():
+                    probe.observed(key, reading["value"], received_at)
+
+
+async def observe_db(probe: LatencyProbe, deadline: float, interval: float = 0.05):
+    os.chdir(APP_DIR)
+    from database import get_recent_data
+
+    while time.monotonic() < deadline:
+        for key, sensor_id in probe.sensor_ids.items():
+            reading = await get_recent_data(sensor_id)
+            if reading:
+                probe.observed(key, reading["value"], time.monotonic())
+        await asyncio.sleep(interval)
+
+
+async def simulate(args) -> dict:
+    rng = random.Random(args.seed)
+    devices = [Device(address, rng) for address in mac_addresses(args.devices, rng)]
+    probe = LatencyProbe()
+
+    period = args.period
+    if args.rate:
+        period = len(devices) * len(SENSORS) / args.rate
+
+    client = None
+    if args.app_url and args.probe_devices:
+        client = await provision(
+            args.app_url, rng.sample(devices, min(args.probe_devices, len(devices))), probe,
+            f"fleet{int(time.time()) % 100000}",
+        )
+
+    publisher = Publisher(args.broker, args.port, args.connections, args.qos)
+    stop = threading.Event()
+    started = time.monotonic()
+    # Observers keep listening a little past the end for readings still in flight
+    observe_deadline = started + args.duration + args.drain
+    try:
+        fleet = asyncio.to_thread(
+            run_fleet, devices, publisher, probe, args.base_topic, period,
+            args.burstiness, args.jitter, args.duration, args.seed,
+            args.payload == "binary", args.duplicates, stop,
+        )
+        tasks = [fleet]
+        if client is not None:
+            tasks.append(observe_ws(args.app_url, client.cookies, probe, observe_deadline) if args.observe == "ws"
+                         else observe_db(probe, observe_deadline))
+        await asyncio.gather(*tasks)
+    finally:
+        stop.set()
+        publisher.close()
+        if client is not None:
+            await client.aclose()
+
+    elapsed = min(time.monotonic() - started, args.duration)
+    return {
+        "devices": len(devices),
+        "period_seconds": round(period, 3),
+        "target_readings_per_second": round(len(devices) * len(SENSORS) / period, 1),
+        "published": publisher.counts["published"],
+        "publish_errors": {name: count for name, count in publisher.counts.items() if name != "published"},
+        "achieved_readings_per_second": round(publisher.counts["published"] / elapsed, 1),
+        "end_to_end": probe.summary() if client is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--period", type=float, default=5.0, help="Seconds between publishes per device")
+    parser.add_argument("--rate", type=float, help="Total readings per second, overrides --period")
+    parser.add_argument("--burstiness", type=float, default=0.0, help="Fraction of devices publishing in lockstep, 0 to 1")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Standard deviation of each period in seconds")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="Fraction of messages published twice")
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--drain", type=float, default=5.0, help="Seconds to keep observing after publishing stops")
+    parser.add_argument("--broker", default=os.getenv("MQTT_BROKER", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("MQTT_PORT", "1883")))
+    parser.add_argument("--base-topic", default=os.getenv("BASE_TOPIC", "sim/fleet/v1"))
+    parser.add_argument("--connections", type=int, default=8, help="MQTT connections shared by the fleet")
+    parser.add_argument("--payload", choices=("json", "binary"), default="json",
+                        help="JSON per reading like the firmware, or one binary frame per device")
+    parser.add_argument("--qos", type=int, choices=(0, 1), default=0)
+    parser.add_argument("--app-url", help="App to register probe sensors with and observe")
+    parser.add_argument("--probe-devices", type=int, default=20)
+    parser.add_argument("--observe", choices=("ws", "db"), default="ws")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    if not 0 <= args.burstiness <= 1:
+        parser.error("--burstiness must be between 0 and 1")
+
+    result = asyncio.run(simulate(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+"""
+Load test the app with a realistic mix of traffic.
+
+Boots app/main.py (see bench/serve.py) against the SQLite stand-in or a
+local MySQL, signs up one account per virtual user, seeds each with
+sensors and clothes, then for --duration seconds runs:
+
+  * --users closed-loop virtual users picking from login, dashboard
+    load (page, /api/dashboard and a /ws subscription), /api/sensors
+    and /api/clothes by --mix weight
+  * open-loop ingest of --ingest-rate readings/s through /api/data,
+    timed from when each reading was due so a slow server cannot hide
+    its own backlog
+  * --ws subscribers holding /ws open on their user's sensors
+
+Throughput, p50/p99 latency and database statements per request (read
+from the Server-Timing header) are reported per scenario, along with the
+server's busiest query fingerprints. --output writes everything as JSON
+and --compare prints the change against an earlier run.
+
+Usage:
+    python bench/load_bench.py --duration 30 --users 20 --ingest-rate 200 --ws 50
+    docker compose -f bench/docker-compose.yml up -d
+    python bench/load_bench.py --db mysql --output results.json --compare baseline.json
+    python bench/load_bench.py --url http://127.0.0.1:8000   # an already running server
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+import websockets
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+
+from querylog import percentile
+
+DEFAULT_MIX = "login=1,dashboard=4,sensors=10,clothes=10"
+SERVER_TIMING_QUERIES = re.compile(r'db;desc="(\d+) queries"')
+SENSOR_TYPES = (("Temperature", "Celsius"), ("Pressure", "Pascals"), ("Humidity", "Percent"))
+CLOTHES_TYPES = ("shirt", "pants", "jacket", "shoes", "hat", "dress", "sweater")
+
+
+class Recorder:
+    """Latency, status and statement counts per scenario."""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.queries: dict[str, list[int]] = defaultdict(list)
+        self.errors: dict[str, Counter] = defaultdict(Counter)
+        self.recording = False
+
+    def record(self, name: str, seconds: float, responses: list[httpx.Response]):
+        if not self.recording:
+            return
+        failed = [response.status_code for response in responses if response.status_code >= 400]
+        if failed:
+            self.errors[name][str(failed[0])] += 1
+            return
+        self.latencies[name].append(seconds)
+        self.queries[name].append(sum(statement_count(response) for response in responses))
+
+    def record_error(self, name: str, error: Exception):
+        if self.recording:
+            self.errors[name][type(error).__name__] += 1
+
+    def summary(self, duration: float) -> dict:
+        results = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies[name])
+            queries = self.queries[name]
+            results[name] = {
+                "requests": len(latencies),
+                "errors": dict(self.errors[name]),
+                "throughput_per_second": round(len(latencies) / duration, 1),
+                "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+                "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+                "db_queries_per_request": round(sum(queries) / len(queries), 2) if queries else 0.0,
+            }
+        return results
+
+
+def statement_count(response: httpx.Response) -> int:
+    match = SERVER_TIMING_QUERIES.search(response.headers.get("server-timing", ""))
+    return int(match.group(1)) if match else 0
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name!r}, expected one of {', '.join(SCENARIOS)}")
+        weights[name.strip()] = int(weight or 1)
+    return weights
+
+
+class VirtualUser:
+    """One signed up account with its own session cookie and seeded data."""
+
+    def __init__(self, client: httpx.AsyncClient, username: str):
+        self.client = client
+        self.username = username
+        self.password = "bench-password"
+        self.sensors: list[dict] = []
+
+    async def signup(self):
+        response = await self.client.post("/signup", json={
+            "username": self.username,
+            "password": self.password,
+            "email": f"{self.username}@bench.invalid",
+            "location": "San Diego",
+        })
+        if response.status_code != 302:
+            raise RuntimeError(f"Signup failed for {self.username}: {response.status_code} {response.text}")
+
+    async def seed(self, sensors: int, clothes: int):
+        for index in range(sensors):
+            type, units = SENSOR_TYPES[index % len(SENSOR_TYPES)]
+            address = ":".join(f"{random.randrange(256):02X}" for _ in range(6))
+            response = await self.client.post("/api/sensors", json={"type": type, "units": units, "address": address})
+            response.raise_for_status()
+
+        if clothes:
+            body = "".join(
+                json.dumps({"name": f"Item {index}", "type": random.choice(CLOTHES_TYPES), "image_address": ""}) + "\n"
+                for index in range(clothes)
+            )
+            response = await self.client.post(
+                "/api/clothes/import", content=body, headers={"Content-Type": "application/x-ndjson"}
+            )
+            response.raise_for_status()
+
+        response = await self.client.get("/api/sensors", params={"limit": 500})
+        response.raise_for_status()
+        self.sensors = response.json()["items"]
+
+
+async def scenario_login(user: VirtualUser) -> list[httpx.Response]:
+    return [await user.client.post("/login", json={"username": user.username, "password": user.password})]
+
+
+def cookie_header(cookies: httpx.Cookies) -> dict:
+    return {"Cookie": "; ".join(f"{name}={value}" for name, value in cookies.items())}
+
+
+async def scenario_dashboard(user: VirtualUser) -> list[httpx.Response]:
+    """
+    The page plus what dashboard.js does on load: fetch /api/dashboard
+    while /ws connects, then subscribe to every sensor after its latest
+    reading and wait for the subscription to be acknowledged.
+    """
+    page = await user.client.get("/dashboard")
+    ws_url = str(user.client.base_url).replace("http", "ws", 1) + "/ws"
+    websocket, dashboard = await asyncio.gather(
+        websockets.connect(ws_url, additional_headers=cookie_header(user.client.cookies)),
+        user.client.get("/api/dashboard"),
+    )
+    try:
+        if dashboard.status_code == 200:
+            sensors = dashboard.json()["sensors"]
+            after = {
+                str(sensor["id"]): {"timestamp": sensor["latest"]["timestamp"], "seq": sensor["latest"]["seq"]}
+                for sensor in sensors if sensor["latest"]
+            }
+            await websocket.send(json.dumps({"v": 1, "type": "subscribe", "sensors": [sensor["id"] for sensor in sensors], "after": after}))
+            # Readings may arrive ahead of the acknowledgement
+            while json.loads(await websocket.recv())["type"] != "subscribed":
+                pass
+    finally:
+        await websocket.close()
+    return [page, dashboard]
+
+
+async def scenario_sensors(user: VirtualUser) -> list[httpx.Response]:
+    return [await user.client.get("/api/sensors")]
+
+
+async def scenario_clothes(user: VirtualUser) -> list[httpx.Response]:
+    return [await user.client.get("/api/clothes")]
+
+
+SCENARIOS = {
+    "login": scenario_login,
+    "dashboard": scenario_dashboard,
+    "sensors": scenario_sensors,
+    "clothes": scenario_clothes,
+}
+
+
+async def run_user(user: VirtualUser, mix: dict[str, int], recorder: Recorder, deadline: float):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while time.monotonic() < deadline:
+        name = random.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+            responses = await SCENARIOS[name](user)
+        except (httpx.HTTPError, OSError, websockets.WebSocketException) as e:
+            recorder.record_error(name, e)
+            continue
+        recorder.record(name, time.perf_counter() - started, responses)
+
+
+async def run_ingest(
+    client: httpx.AsyncClient,
+    sensors: list[dict],
+    rate: float,
+    api_key: str,
+    recorder: Recorder,
+    deadline: float,
+    max_in_flight: int = 1000,
+):
+    """Post readings on a fixed schedule, however long the server takes to answer."""
+    in_flight = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+
+    async def send(due: float, sensor: dict):
+        try:
+            response = await client.post("/api/data", json={
+                "value": round(random.gauss(20, 2), 2),
+                "type": sensor["type"],
+                "address": sensor["address"],
+                "api_key": api_key,
+            })
+        except httpx.HTTPError as e:
+            recorder.record_error("ingest", e)
+        else:
+            recorder.record("ingest", time.perf_counter() - due, [response])
+        finally:
+            in_flight.release()
+
+    interval = 1 / rate
+    due = time.perf_counter()
+    while time.monotonic() < deadline:
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await in_flight.acquire()
+        task = asyncio.create_task(send(due, random.choice(sensors)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        due += interval
+
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def run_subscriber(url: str, cookies: httpx.Cookies, sensor_ids: list[int], counts: Counter, deadline: float):
+    try:
+        async with websockets.connect(url, additional_headers=cookie_header(cookies)) as websocket:
+            counts["connected"] += 1
+            await websocket.send(json.dumps({"v": 1, "type": "subscribe", "sensors": sensor_ids}))
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(websocket.recv(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                counts["messages"] += 1
+                counts["bytes"] += len(message)
+                if json.loads(message)["type"] == "ping":
+                    await websocket.send(json.dumps({"v": 1, "type": "pong"}))
+    except (OSError, websockets.WebSocketException):
+        counts["failed"] += 1
+
+
+async def wait_until_ready(base_url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/login")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"Server at {base_url} did not become ready within {timeout}s")
+
+
+async def benchmark(args) -> dict:
+    await wait_until_ready(args.url)
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(30.0)
+    run_id = f"{int(time.time()) % 100000}{random.randrange(1000):03d}"
+    clients = [
+        httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout)
+        for _ in range(args.users)
+    ]
+    ingest_client = httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout)
+    try:
+        users = [VirtualUser(client, f"bench{run_id}u{index}") for index, client in enumerate(clients)]
+        for user in users:
+            await user.signup()
+        await asyncio.gather(*(user.seed(args.sensors_per_user, args.clothes_per_user) for user in users))
+        sensors = [sensor for user in users for sensor in user.sensors]
+
+        recorder = Recorder()
+        ws_counts = Counter()
+        ws_url = args.url.replace("http", "ws", 1) + "/ws"
+
+        # Warm up connections and caches before measuring
+        warmup_deadline = time.monotonic() + args.warmup
+        await asyncio.gather(*(run_user(user, args.mix, recorder, warmup_deadline) for user in users))
+
+        recorder.recording = True
+        started = time.monotonic()
+        deadline = started + args.duration
+        tasks = [run_user(user, args.mix, recorder, deadline) for user in users]
+        if args.ingest_rate and sensors:
+            tasks.append(run_ingest(ingest_client, sensors, args.ingest_rate, args.api_key, recorder, deadline))
+        for index in range(args.ws):
+            user = users[index % len(users)]
+            tasks.append(run_subscriber(ws_url, user.client.cookies, [sensor["id"] for sensor in user.sensors], ws_counts, deadline))
+        await asyncio.gather(*tasks)
+        duration = time.monotonic() - started
+
+        # The app only serves its debug routes to local clients, or to ones holding its ADMIN_TOKEN
+        admin_token = os.getenv("ADMIN_TOKEN")
+        headers = {"Authorization": f"Bearer {admin_token}"} if admin_token else None
+        query_stats = (await ingest_client.get("/debug/queries", headers=headers)).json()
+    finally:
+        for client in clients + [ingest_client]:
+            await client.aclose()
+
+    results = recorder.summary(duration)
+    completed = sum(result["requests"] for result in results.values())
+    return {
+        "duration_seconds": round(duration, 2),
+        "total_throughput_per_second": round(completed / duration, 1),
+        "scenarios": results,
+        "ws": {
+            "subscribers": args.ws,
+            "connected": ws_counts["connected"],
+            "failed": ws_counts["failed"],
+            "messages": ws_counts["messages"],
+            "messages_per_second": round(ws_counts["messages"] / duration, 1),
+            "bytes_per_second": round(ws_counts["bytes"] / duration, 1),
+        },
+        "top_queries": query_stats["queries"][:10],
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, check=True, capture_output=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(db: str, port: int, api_key: str) -> subprocess.Popen:
+    return subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "serve.py"),
+        "--db", db, "--port", str(port), "--api-key", api_key,
+    ])
+
+
+def print_report(report: dict, baseline: Optional[dict]):
+    print(f"{report['total_throughput_per_second']} req/s over {report['duration_seconds']}s at commit {report['commit']}")
+    print(f"{'scenario':>10} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'queries':>8} {'errors':>7}")
+    for name, result in report["scenarios"].items():
+        line = (
+            f"{name:>10} {result['throughput_per_second']:>9} {result['p50_ms']:>9} "
+            f"{result['p99_ms']:>9} {result['db_queries_per_request']:>8} {sum(result['errors'].values()):>7}"
+        )
+        previous = (baseline or {}).get("scenarios", {}).get(name)
+        if previous:
+            line += (
+                f"   vs {baseline.get('commit')}: req/s {change(previous['throughput_per_second'], result['throughput_per_second'])}"
+                f" p99 {change(previous['p99_ms'], result['p99_ms'])}"
+                f" queries {previous['db_queries_per_request']} -> {result['db_queries_per_request']}"
+            )
+        print(line)
+    ws = report["ws"]
+    print(f"ws: {ws['connected']}/{ws['subscribers']} connected, {ws['messages_per_second']} messages/s, {ws.get('bytes_per_second', 0)} bytes/s")
+
+
+def change(before: float, after: float) -> str:
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", choices=("standin", "mysql"), default="standin")
+    parser.add_argument("--url", help="Benchmark an already running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--api-key", default="bench", help="API key the server accepts on /api/data")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument("--ingest-rate", type=float, default=100.0, help="Readings per second sent to /api/data")
+    parser.add_argument("--ws", type=int, default=20, help="Concurrent /ws subscribers")
+    parser.add_argument("--sensors-per-user", type=int, default=5)
+    parser.add_argument("--clothes-per-user", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Print the change against a previous --output file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    server = None
+    if not args.url:
+        args.url = f"http://127.0.0.1:{args.port}"
+        server = start_server(args.db, args.port, args.api_key)
+
+    try:
+        report = {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "config": {
+                "db": args.db if server else "external",
+                "duration": args.duration,
+                "users": args.users,
+                "mix": args.mix,
+                "ingest_rate": args.ingest_rate,
+                "ws": args.ws,
+                "sensors_per_user": args.sensors_per_user,
+                "clothes_per_user": args.clothes_per_user,
+            },
+            **asyncio.run(benchmark(args)),
+        }
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
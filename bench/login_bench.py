@@ -0,0 +1,174 @@
+"""
+Benchmark /login now that passwords are hashed with scrypt.
+
+Boots app/main.py (see bench/serve.py), signs up --users accounts, then
+for --duration seconds runs --concurrency closed-loop clients logging in
+as random accounts. Alongside them a probe fetches the login page, which
+does no hashing, every --probe-interval seconds: since hashing runs in a
+process pool, probe latency should stay flat however busy logins are.
+
+Login throughput, p50/p99 and refusals (503 once MAX_PENDING_HASHES
+hashes are waiting) are reported with the probe's p50/p99. With
+--max-login-p99-ms or --max-probe-p99-ms the run fails when either is
+exceeded, so it can gate a change.
+
+Usage:
+    python bench/login_bench.py --duration 20 --concurrency 32
+    python bench/login_bench.py --max-login-p99-ms 500 --max-probe-p99-ms 50 --output login.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+
+from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+
+from querylog import percentile
+from load_bench import git_commit, start_server, wait_until_ready
+
+PASSWORD = "bench-password"
+
+
+def latency_summary(latencies: list[float], duration: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput_per_second": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+async def signup(client: httpx.AsyncClient, username: str):
+    response = await client.post("/signup", json={
+        "username": username, "password": PASSWORD, "email": f"{username}@bench.invalid", "location": "San Diego",
+    })
+    if response.status_code != 302:
+        raise RuntimeError(f"Signup failed for {username}: {response.status_code} {response.text}")
+
+
+async def run_logins(client: httpx.AsyncClient, usernames: list[str], latencies: list, statuses: Counter, deadline: float):
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            response = await client.post("/login", json={"username": random.choice(usernames), "password": PASSWORD})
+        except httpx.HTTPError as e:
+            statuses[type(e).__name__] += 1
+            continue
+        statuses[str(response.status_code)] += 1
+        if response.status_code == 302:
+            latencies.append(time.perf_counter() - started)
+        elif response.status_code == 503:
+            await asyncio.sleep(float(response.headers.get("retry-after", 1)))
+
+
+async def run_probe(client: httpx.AsyncClient, interval: float, latencies: list, deadline: float):
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        response = await client.get("/login")
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(max(0.0, interval - (time.perf_counter() - started)))
+
+
+async def benchmark(args) -> dict:
+    await wait_until_ready(args.url)
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    run_id = f"{int(time.time()) % 100000}{random.randrange(1000):03d}"
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client, \
+            httpx.AsyncClient(base_url=args.url, timeout=60) as probe_client:
+        usernames = [f"login{run_id}u{index}" for index in range(args.users)]
+        for username in usernames:
+            await signup(client, username)
+
+        # Warm up the worker processes before measuring
+        await run_logins(client, usernames, [], Counter(), time.monotonic() + args.warmup)
+
+        login_latencies, probe_latencies = [], []
+        statuses = Counter()
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(
+            run_probe(probe_client, args.probe_interval, probe_latencies, deadline),
+            *(run_logins(client, usernames, login_latencies, statuses, deadline) for _ in range(args.concurrency)),
+        )
+        duration = time.monotonic() - started
+
+    return {
+        "duration_seconds": round(duration, 2),
+        "login": {**latency_summary(login_latencies, duration), "statuses": dict(statuses)},
+        "probe": latency_summary(probe_latencies, duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", choices=("standin", "mysql"), default="standin")
+    parser.add_argument("--url", help="Benchmark an already running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients logging in")
+    parser.add_argument("--probe-interval", type=float, default=0.05)
+    parser.add_argument("--max-login-p99-ms", type=float, help="Fail if login p99 exceeds this")
+    parser.add_argument("--max-probe-p99-ms", type=float, help="Fail if probe p99 exceeds this")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    server = None
+    if not args.url:
+        args.url = f"http://127.0.0.1:{args.port}"
+        server = start_server(args.db, args.port, "bench")
+
+    try:
+        report = {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "config": {
+                "db": args.db if server else "external",
+                "duration": args.duration,
+                "users": args.users,
+                "concurrency": args.concurrency,
+            },
+            **asyncio.run(benchmark(args)),
+        }
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    login, probe = report["login"], report["probe"]
+    print(f"login: {login['throughput_per_second']} req/s p50 {login['p50_ms']} ms p99 {login['p99_ms']} ms, statuses {login['statuses']}")
+    print(f"probe: p50 {probe['p50_ms']} ms p99 {probe['p99_ms']} ms over {probe['requests']} requests")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    failures = []
+    if args.max_login_p99_ms is not None and login["p99_ms"] > args.max_login_p99_ms:
+        failures.append(f"login p99 {login['p99_ms']} ms exceeds {args.max_login_p99_ms} ms")
+    if args.max_probe_p99_ms is not None and probe["p99_ms"] > args.max_probe_p99_ms:
+        failures.append(f"probe p99 {probe['p99_ms']} ms exceeds {args.max_probe_p99_ms} ms")
+    if failures:
+        sys.exit("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Run the app for benchmarking.
+
+With --db standin the app runs against an in-process SQLite stand-in
+(see bench/standin.py), so no database server is needed. With --db mysql
+it connects using the usual MYSQL_* environment variables, e.g. to the
+server started by bench/docker-compose.yml.
+
+With --workers above 1 it runs under the multi-worker server in
+app/server.py instead of a single uvicorn process.
+
+Usage:
+    python bench/serve.py --db standin --port 8765
+    python bench/serve.py --db mysql --port 8765
+    python bench/serve.py --workers 4 --port 8765
+"""
+import os
+import json
+import sys
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, "..", "app")
+
+# Defaults matching bench/docker-compose.yml
+MYSQL_DEFAULTS = {
+    "MYSQL_HOST": "127.0.0.1",
+    "MYSQL_PORT": "3307",
+    "MYSQL_USER": "wardrobify",
+    "MYSQL_PASSWORD": "wardrobify",
+    "MYSQL_DATABASE": "wardrobify",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", choices=("standin", "mysql"), default="standin")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--api-key", default="bench", help="API key accepted by /api/data")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--worker-port-base", type=int, help="See app/server.py")
+    args = parser.parse_args()
+
+    os.environ.setdefault("API_KEY", args.api_key)
+    # Synthetic devices report faster than real ones, so the bench key gets the bulk quota
+    os.environ.setdefault("INGEST_API_KEYS", json.dumps({args.api_key: "bulk"}))
+    if args.db == "mysql":
+        for name, value in MYSQL_DEFAULTS.items():
+            os.environ.setdefault(name, value)
+
+    # The app loads static files and modules relative to app/
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    sys.path.insert(0, BENCH_DIR)
+
+    if args.db == "standin":
+        import standin
+        standin.install(os.path.join(tempfile.mkdtemp(prefix="wardrobify-bench-"), "bench.sqlite3"))
+
+    if args.workers > 1:
+        import server
+        sys.argv = [server.__file__, "--host", args.host, "--port", str(args.port), "--workers", str(args.workers)]
+        if args.worker_port_base is not None:
+            sys.argv += ["--worker-port-base", str(args.worker_port_base)]
+        server.main()
+        return
+
+    import uvicorn
+    from main import app
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
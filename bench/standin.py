@@ -0,0 +1,146 @@
+"""
+In-process SQLite stand-in for the MySQL server.
+
+Replaces `database.get_db_connection` with connections to a local SQLite
+file, translating the handful of MySQL specific constructs the app uses
+on the way through. Every accessor still runs through the real query
+executor, so per-request query counts and the query log behave exactly
+as they do against MySQL; only absolute database latency differs.
+
+This is for benchmarks only. The app itself always talks to MySQL.
+"""
+import re
+import time
+import sqlite3
+
+_PARAMETER = re.compile(r"%\((\w+)\)s|%s")
+_INLINE_INDEX = re.compile(r",\s*(UNIQUE\s+)?(?:INDEX|KEY)\s+(\w+)\s*\(([^)]*)\)", re.IGNORECASE)
+_CREATE_TABLE = re.compile(r"CREATE TABLE (\w+)", re.IGNORECASE)
+_REPLACEMENTS = (
+    (re.compile(r"\bINT AUTO_INCREMENT PRIMARY KEY\b", re.IGNORECASE), "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    (re.compile(r"\bBIGINT AUTO_INCREMENT PRIMARY KEY\b", re.IGNORECASE), "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    (re.compile(r"\bON UPDATE CURRENT_TIMESTAMP\b", re.IGNORECASE), ""),
+    (re.compile(r"^\s*EXPLAIN\b", re.IGNORECASE), "EXPLAIN QUERY PLAN"),
+    (re.compile(r"\bINSERT IGNORE\b", re.IGNORECASE), "INSERT OR IGNORE"),
+)
+
+
+def translate(query: str) -> list[str]:
+    """
+    Rewrite one MySQL statement as the SQLite statements that implement it.
+
+    Indexes declared inside CREATE TABLE become separate CREATE INDEX
+    statements, and placeholders become SQLite's `?` and `:name` forms.
+    """
+    query = _PARAMETER.sub(lambda match: f":{match.group(1)}" if match.group(1) else "?", query)
+    for pattern, replacement in _REPLACEMENTS:
+        query = pattern.sub(replacement, query)
+
+    table = _CREATE_TABLE.search(query)
+    if not table:
+        return [query]
+
+    indexes = []
+    for unique, name, columns in _INLINE_INDEX.findall(query):
+        indexes.append(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table.group(1)} ({columns})")
+    return [_INLINE_INDEX.sub("", query)] + indexes
+
+
+class StandInCursor:
+    """The subset of the mysql-connector cursor API the app uses."""
+
+    def __init__(self, connection: sqlite3.Connection, dictionary: bool):
+        self._connection = connection
+        self._cursor = connection.cursor()
+        self._dictionary = dictionary
+
+    @property
+    def with_rows(self) -> bool:
+        return self._cursor.description is not None
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def execute(self, query: str, params=None):
+        statement, *indexes = translate(query)
+        self._cursor.execute(statement, params or ())
+        for index in indexes:
+            self._connection.execute(index)
+
+    def executemany(self, query: str, params):
+        self._cursor.executemany(translate(query)[0], params)
+
+    def _convert(self, rows: list) -> list:
+        if not self._dictionary:
+            return [tuple(row) for row in rows]
+        columns = [column[0] for column in self._cursor.description]
+        return [dict(zip(columns, row)) for row in rows]
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        return self._convert([row])[0] if row is not None else None
+
+    def fetchall(self) -> list:
+        return self._convert(self._cursor.fetchall())
+
+    def fetchmany(self, size: int) -> list:
+        return self._convert(self._cursor.fetchmany(size))
+
+    def close(self):
+        self._cursor.close()
+
+
+class StandInConnection:
+    """A per-call SQLite connection shaped like a mysql-connector connection."""
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(
+            path,
+            timeout=30,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+        )
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._open = True
+
+    def cursor(self, dictionary: bool = False, buffered: bool = True) -> StandInCursor:
+        return StandInCursor(self._connection, dictionary)
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def ping(self, **kwargs):
+        pass
+
+    def is_connected(self) -> bool:
+        return self._open
+
+    def close(self):
+        self._open = False
+        self._connection.close()
+
+
+def install(path: str):
+    """Point the app's database module at a SQLite file instead of MySQL."""
+    import database
+    from metrics import record_db_connect
+
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.close()
+
+    def get_db_connection(*args, **kwargs) -> StandInConnection:
+        started = time.perf_counter()
+        connection = StandInConnection(path)
+        record_db_connect(time.perf_counter() - started)
+        return connection
+
+    database.get_db_connection = get_db_connection
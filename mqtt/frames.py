@@ -0,0 +1,97 @@
+import math
+import struct
+
+from typing import Iterable, Optional
+
+# Binary payloads start with this byte, which can never begin a JSON document
+FRAME_MAGIC = 0xB5
+FRAME_VERSION = 2
+
+# magic, version, reading count
+HEADER = struct.Struct("<BBH")
+# Reading layout per frame version:
+#   1: sensor type id, unix timestamp in seconds (0 if the device has no clock), value
+#   2: as 1, plus a per-sensor sequence number after the timestamp
+READINGS = {
+    1: struct.Struct("<BIf"),
+    2: struct.Struct("<BIIf"),
+}
+
+MAX_READINGS = 0xFFFF
+
+SENSOR_TYPES = {
+    1: "Temperature",
+    2: "Pressure",
+}
+SENSOR_TYPE_IDS = {name: type_id for type_id, name in SENSOR_TYPES.items()}
+
+
+class FrameError(ValueError):
+    """Raised when a binary payload is not a valid frame"""
+    pass
+
+
+def is_frame(payload: bytes) -> bool:
+    return payload[:1] == bytes((FRAME_MAGIC,))
+
+
+def encode_frame(readings: Iterable[tuple[str, Optional[float], float, int]]) -> bytes:
+    """
+    Pack (type, timestamp, value, seq) readings into one binary frame.
+
+    Values are stored as float32, the precision the ESP32 reads them at.
+    A timestamp of None is sent as 0, meaning the receiver's clock applies.
+    """
+    reading = READINGS[FRAME_VERSION]
+    body = b"".join(
+        reading.pack(SENSOR_TYPE_IDS[type], int(timestamp or 0), seq, value)
+        for type, timestamp, value, seq in readings
+    )
+    count = len(body) // reading.size
+    if count > MAX_READINGS:
+        raise FrameError(f"A frame holds at most {MAX_READINGS} readings")
+    return HEADER.pack(FRAME_MAGIC, FRAME_VERSION, count) + body
+
+
+def decode_frame(payload: bytes) -> list[tuple[str, Optional[int], float, Optional[int]]]:
+    """
+    Unpack every reading in a binary frame of any supported version in one pass.
+
+    Readings whose value is NaN or infinite, as a sensor may report when a
+    read fails, are left out: the app refuses them.
+
+    Returns:
+        list[tuple[str, Optional[int], float, Optional[int]]]: (type, unix
+        timestamp or None, value, sequence number or None)
+
+    Raises:
+        FrameError: if the frame is truncated, of an unknown version, or
+                    holds an unknown sensor type
+    """
+    if len(payload) < HEADER.size:
+        raise FrameError("Frame shorter than its header")
+
+    magic, version, count = HEADER.unpack_from(payload)
+    if magic != FRAME_MAGIC:
+        raise FrameError("Not a binary frame")
+    reading = READINGS.get(version)
+    if reading is None:
+        raise FrameError(f"Unsupported frame version {version}")
+    if len(payload) != HEADER.size + count * reading.size:
+        raise FrameError(f"Frame length does not match its {count} readings")
+
+    body = memoryview(payload)[HEADER.size:]
+    if version == 1:
+        fields = ((type_id, timestamp, value, None) for type_id, timestamp, value in reading.iter_unpack(body))
+    else:
+        fields = ((type_id, timestamp, value, seq) for type_id, timestamp, seq, value in reading.iter_unpack(body))
+
+    readings = []
+    for type_id, timestamp, value, seq in fields:
+        type = SENSOR_TYPES.get(type_id)
+        if type is None:
+            raise FrameError(f"Unknown sensor type id {type_id}")
+        if not math.isfinite(value):
+            continue
+        readings.append((type, timestamp or None, value, seq))
+    return readings
@@ -1,5 +1,7 @@
 import paho.mqtt.client as mqtt
 import json
+import math
+import threading
 from datetime import datetime
 from collections import deque
 import numpy as np
@@ -8,14 +10,154 @@ import requests
 from dotenv import load_dotenv
 import time
 
+from frames import FrameError, decode_frame, is_frame
+
 load_dotenv()
 
 # MQTT Broker settings
-BROKER = "broker.emqx.io"
-PORT = 1883
+BROKER = os.getenv('MQTT_BROKER', "broker.emqx.io")
+PORT = int(os.getenv('MQTT_PORT', "1883"))
 BASE_TOPIC = os.getenv('BASE_TOPIC')
 TOPIC = BASE_TOPIC + "/#"
 
+# Where readings are forwarded to
+DATA_URL = os.getenv('DATA_URL', 'http://localhost:8000/api/data')
+BATCH_URL = DATA_URL.rstrip('/') + '/batch'
+
+# Readings are forwarded in batches of up to BATCH_SIZE, at least every FLUSH_INTERVAL seconds
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', "500"))
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', "0.2"))
+
+# While the app is unreachable or backed up readings are held, up to MAX_PENDING; beyond that the oldest are dropped
+MAX_PENDING = int(os.getenv('MAX_PENDING', "50000"))
+RETRY_SECONDS = float(os.getenv('RETRY_SECONDS', "1"))
+
+TOPIC_TYPES = {
+    'temperature': 'Temperature',
+    'pressure': 'Pressure',
+}
+
+
+class Forwarder:
+    """
+    Buffers readings from the MQTT thread and posts them to the app in
+    batches from a background thread, so one slow request never stalls
+    the MQTT loop and HTTP overhead is paid per batch rather than per
+    reading.
+    """
+
+    def __init__(self, url: str, api_key: str, batch_size: int, interval: float, max_pending: int):
+        self.url = url
+        self.api_key = api_key
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.session = requests.Session()
+        self.pending = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='forwarder', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.ready.set()
+        self.thread.join()
+
+    def add(self, readings: list):
+        with self.lock:
+            self.pending.extend(readings)
+            self._trim()
+            if len(self.pending) >= self.batch_size:
+                self.ready.set()
+
+    def _requeue(self, readings: list):
+        """Put readings that could not be sent back ahead of those that arrived since."""
+        with self.lock:
+            self.pending[:0] = readings
+            self._trim()
+
+    def _trim(self):
+        # Called with the lock held
+        excess = len(self.pending) - self.max_pending
+        if excess > 0:
+            del self.pending[:excess]
+            self.dropped += excess
+            print(f'Buffer full, dropped the {excess} oldest readings ({self.dropped} so far)')
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.ready.wait(self.interval)
+            self.ready.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            readings, self.pending = self.pending, []
+
+        for start in range(0, len(readings), self.batch_size):
+            batch = readings[start:start + self.batch_size]
+            try:
+                response = self.session.post(self.url, json={'readings': batch, 'api_key': self.api_key}, timeout=10)
+                if response.status_code in (429, 503):
+                    # Rate limited or the app is backed up: keep what is left and back off
+                    retry_after = float(response.headers.get('Retry-After', 1))
+                    print(f'App asked to retry in {retry_after}s, holding {len(readings) - start} readings')
+                    self._requeue(readings[start:])
+                    self.stopped.wait(retry_after)
+                    return
+                if response.status_code != 200:
+                    print(f'Batch of {len(batch)} readings rejected: {response.status_code} {response.text}')
+            except requests.RequestException as e:
+                # The app drops repeats of readings with a seq or device timestamp, so those are safe to resend
+                print(f'Request could not be made, holding {len(readings) - start} readings: {e}')
+                self._requeue(readings[start:])
+                self.stopped.wait(RETRY_SECONDS)
+                return
+
+
+forwarder = Forwarder(BATCH_URL, os.getenv('API_KEY'), BATCH_SIZE, FLUSH_INTERVAL, MAX_PENDING)
+
+
+def parse_message(topic: str, payload: bytes) -> list:
+    """
+    Turn one MQTT message into readings for the app.
+
+    Topics are <BASE_TOPIC>/<MAC>/<sensor> for JSON payloads such as
+    {"value": 21.5, "timestamp": 1735689600, "seq": 42}, where timestamp
+    and seq are optional, or <BASE_TOPIC>/<MAC>/frames for binary frames
+    holding any number of readings (see frames.py).
+    """
+    # However many levels BASE_TOPIC has, the MAC is the second to last
+    address, subtopic = topic.rsplit('/', 2)[-2:]
+
+    if is_frame(payload):
+        return [
+            {'value': value, 'type': type, 'address': address, 'timestamp': timestamp, 'seq': seq}
+            for type, timestamp, value, seq in decode_frame(payload)
+        ]
+
+    type = TOPIC_TYPES.get(subtopic)
+    if type is None:
+        raise ValueError(f'invalid topic {topic}')
+
+    message = json.loads(payload)
+    value = float(message['value'])
+    if not math.isfinite(value):
+        raise ValueError(f'value {value} is not finite')
+    reading = {'value': value, 'type': type, 'address': address}
+    # Optional unix timestamp and sequence number from the device
+    if message.get('timestamp') is not None:
+        reading['timestamp'] = int(message['timestamp'])
+    if message.get('seq') is not None:
+        reading['seq'] = int(message['seq'])
+    return [reading]
+
 
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the broker."""
@@ -30,36 +172,17 @@ def on_connect(client, userdata, flags, rc):
 
 def on_message(client, userdata, msg):
     """Callback for when a message is received."""
-    try:
-        # Parse JSON message
-        payload = json.loads(msg.payload.decode())
-        
-        if msg.topic.startswith(BASE_TOPIC):
-            print(payload)
-
-            type = None
-            if msg.topic.endswith("/temperature"):
-                type = 'Temperature'
-            elif msg.topic.endswith("/pressure"):
-                type = 'Pressure'
-            else:
-                print('invalid topic')
-                return
-            
-            value = payload['value']
-            
-            address = msg.topic.split('/')[3]
+    if not msg.topic.startswith(BASE_TOPIC):
+        return
 
-            try:
-                requests.post('http://localhost:8000/api/data', json={'value': float(value), 'type': type, 'address': address, 'api_key': os.getenv('API_KEY')})
-            except:
-                print('Request could not be made')
-
-            
-            
-    except json.JSONDecodeError:
-        print(f"\nReceived non-JSON message on {msg.topic}:")
-        print(f"Payload: {msg.payload.decode()}")
+    try:
+        forwarder.add(parse_message(msg.topic, msg.payload))
+    except FrameError as e:
+        print(f"\nReceived invalid frame on {msg.topic}: {e}")
+    except (ValueError, KeyError, TypeError) as e:
+        # json.JSONDecodeError and UnicodeDecodeError are ValueErrors too
+        print(f"\nReceived invalid message on {msg.topic}: {e}")
+        print(f"Payload: {msg.payload!r}")
 
 
 
@@ -78,19 +201,21 @@ def main():
         # Connect to broker
         print("Connecting to broker...")
         client.connect(BROKER, PORT, 60)
-        
+        forwarder.start()
+
         # Start the MQTT loop
         print("Starting MQTT loop...")
         client.loop_forever()
-        
+
     except KeyboardInterrupt:
         print("\nDisconnecting from broker...")
         # make sure to stop the loop and disconnect from the broker
         client.loop_stop()
         client.disconnect()
+        forwarder.stop()
         print("Exited successfully")
     except Exception as e:
         print(f"Error: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()